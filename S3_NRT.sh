@@ -55,36 +55,192 @@ cd "${0%/*}"
 
 LD_LIBRARY_PATH=. # SNAP requirement
 
+# Incremental mosaic: update the daily mosaic scene by scene (dm_stream.py)
+# instead of rebuilding it with GRASS (dm.sh)
+stream=false
+
+# In-memory processing of all the regions at once (S3_pipeline.py), run
+# after the download of the scenes of every region
+pipeline=false
+
+# Shared granule store (S3_granule_store.py): one copy of the scenes fetched
+# for overlapping regions, each scene being read once and resampled on the
+# grids of all the regions it intersects (S3_reader.py instead of gpt)
+shared_store=false
+granule_store=/sice-data/SICE/granules
+
+# Pre-screening of the scenes (S3_prescreen.py): scenes outside the region,
+# with SZA > 75 or fully clouded are skipped before processing
+prescreen=false
+
+# Cloud-optimized GeoTIFF outputs (cog.py): tiled, with internal overviews
+cog=false
+
+# Codecs of the SICE outputs (sice_codecs.py): default (DEFLATE), nrt or
+# archive, chosen with codec_benchmark.py. tif_codec: codec of the GRASS
+# mosaics (dm.grass.sh)
+codec=default
+tif_codec=COMPRESS=DEFLATE,PREDICTOR=2
+
+# Time-series cube of the daily products of each region (sice_cube.py):
+# /sice-data/SICE/{region}/SICE.zarr
+cube=false
+
+# Local archive catalog (S3_catalog.py): the scenes of each region are
+# selected and paired with indexed queries instead of data hub queries
+catalog=false
+export SICE_CATALOG=./S3_catalog.sqlite
+
+# Long-lived worker (sice_worker.py): the Python steps of post_proc run as
+# jobs of a warm worker process instead of one new process each
+worker=false
+worker_spool=/sice-data/SICE/worker
+
 date=$(date -d '-2days' "+%Y-%m-%d")
 year=$(date "+%Y")
 
 declare -a regions=("Greenland" "Iceland" "Svalbard" "NovayaZemlya" "SevernayaZemlya" "FransJosefLand" "NorthernArcticCanada" "SouthernArcticCanada" "JanMayen" "Norway" "Beaufort")
 
+# runs a Python step of the chain, in the worker if enabled
+run_py() {
+	local script=${1}
+	shift
+	if [ "${worker}" = true ]; then
+		python ./sice_worker.py submit --wait "${worker_spool}" "${script}" "${@}"
+	else
+		python ./"${script}" "${@}"
+	fi
+}
+
+# SCDA, mosaic and SICE of a region-day, once its scenes are processed
+post_proc() {
+	local proc_root=/sice-data/SICE/"${1}"/proc
+	local mosaic_root=/sice-data/SICE/"${1}"/mosaic
+
+	# Run the Simple Cloud Detection Algorithm (SCDA)
+	run_py SCDA.py "${proc_root}"/"${date}"
+
+	# Mosaic
+	if [ "${stream}" = true ]; then
+		run_py dm_stream.py "${date}" "${proc_root}"/"${date}" "${mosaic_root}"
+	else
+		./dm.sh "${date}" "${proc_root}"/"${date}" "${mosaic_root}"
+	fi
+
+	# zonal statistics on the land cover classes of the region mask
+	local zones_opt=""
+	if [ -f ./masks/"${1}"_300m.tif ]; then
+		zones_opt="--zones ./masks/${1}_300m.tif"
+	fi
+
+	# SICE, only on the tiles of the mosaic that changed since the last run
+	# shellcheck disable=SC2086
+	run_py sice_incremental.py "${mosaic_root}"/"${date}" ${cog_opt} ${zones_opt} \
+		--codec ${codec}
+
+	append_cube "${1}"
+}
+
+# appends the SICE products of a region-day to the region cube
+append_cube() {
+	if [ "${cube}" = true ]; then
+		run_py sice_cube.py append /sice-data/SICE/"${1}"/mosaic/"${date}" \
+			/sice-data/SICE/"${1}"/SICE.zarr
+	fi
+}
+
+if [ "${prescreen}" = true ]; then
+	proc_opt="-S"
+	prescreen_opt="--prescreen"
+else
+	proc_opt=""
+	prescreen_opt=""
+fi
+
+export SICE_TIF_CODEC=${tif_codec}
+
+if [ "${cog}" = true ]; then
+	# GRASS mosaics converted by dm.grass.sh
+	export SICE_COG=1
+	cog_opt="--cog"
+else
+	cog_opt=""
+fi
+
+if [ "${worker}" = true ]; then
+	# started once, then kept running for the next NRT runs
+	if ! pgrep -f "sice_worker.py serve ${worker_spool}" > /dev/null; then
+		mkdir -p "${worker_spool}"
+		nohup python ./sice_worker.py serve "${worker_spool}" \
+			>> "${worker_spool}"/worker.log 2>&1 &
+	fi
+fi
+
+if [ "${catalog}" = true ]; then
+	# incremental: only the products of the date not indexed yet are parsed
+	python ./S3_catalog.py index /eodata/Sentinel-3 --date "${date}" --db "${SICE_CATALOG}"
+else
+	unset SICE_CATALOG
+fi
+
 for region in "${regions[@]}"; do
 
 	# CREODIAS
 	SEN3_local=/eodata/Sentinel-3
 	SEN3_source=/sice-data/SICE/"${region}"/S3
 	proc_root=/sice-data/SICE/"${region}"/proc
-	mosaic_root=/sice-data/SICE/"${region}"/mosaic
 
 	mkdir -p /sice-data/SICE/"${region}"
 
 	### Fetch one day of OLCI & SLSTR scenes over Greenland
 	## Use local files (PTEP, DIAS, etc.)
-	./dsget_wrapper.sh -d "${date}" -l "${SEN3_local}" -o "${SEN3_source}"/"${year}"/"${date}" \
-		-f "${region}" -u "${username}" -p "${password}"
+	if [ "${catalog}" = true ]; then
+		python ./S3_catalog.py link --db "${SICE_CATALOG}" --date "${date}" \
+			--mask ./masks/"${region}"_300m.tif --direction descending \
+			--out "${SEN3_source}"/"${year}"/"${date}"
+	else
+		./dsget_wrapper.sh -d "${date}" -l "${SEN3_local}" -o "${SEN3_source}"/"${year}"/"${date}" \
+			-f "${region}" -u "${username}" -p "${password}"
+	fi
+
+	if [ "${pipeline}" = true ]; then
+		continue
+	fi
+
+	if [ "${shared_store}" = true ]; then
+		# granules already fetched for another region are replaced by links
+		python ./S3_granule_store.py ingest "${SEN3_source}"/"${year}"/"${date}" \
+			--store "${granule_store}"
+		continue
+	fi
 
 	# SNAP: Reproject, calculate reflectance, extract bands, etc.
-	./S3_proc.sh -i "${SEN3_source}"/"${year}"/"${date}" -o "${proc_root}"/"${date}" -X S3_fast.xml -t
+	# shellcheck disable=SC2086
+	./S3_proc.sh -i "${SEN3_source}"/"${year}"/"${date}" -o "${proc_root}"/"${date}" -X S3_fast.xml -t ${proc_opt}
 
-	# Run the Simple Cloud Detection Algorithm (SCDA)
-	python ./SCDA.py "${proc_root}"/"${date}"
-
-	# Mosaic
-	./dm.sh "${date}" "${proc_root}"/"${date}" "${mosaic_root}"
-
-	# SICE
-	python ./sice.py "${mosaic_root}"/"${date}"
+	post_proc "${region}"
 
 done
+
+if [ "${shared_store}" = true ] && [ "${pipeline}" != true ]; then
+	# each scene is read once for all the regions
+	python ./S3_granule_store.py process "${date}" --store "${granule_store}" \
+		--regions "${regions[@]}" --inpath /sice-data/SICE/{region}/S3/"${year}"/"${date}" \
+		--proc /sice-data/SICE/{region}/proc --mask ./masks/{region}_300m.tif \
+		--res 1000 ${SICE_CATALOG:+--catalog "${SICE_CATALOG}"}
+
+	for region in "${regions[@]}"; do
+		post_proc "${region}"
+	done
+fi
+
+if [ "${pipeline}" = true ]; then
+	python ./S3_pipeline.py "${date}" /sice-data/SICE/{region}/S3/"${year}"/"${date}" \
+		/sice-data/SICE/{region}/mosaic --mask ./masks/{region}_300m.tif \
+		--regions "${regions[@]}" -j 4 \
+		${SICE_CATALOG:+--catalog "${SICE_CATALOG}"} ${prescreen_opt} ${cog_opt}
+
+	for region in "${regions[@]}"; do
+		append_cube "${region}"
+	done
+fi
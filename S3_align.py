@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Alignment of the SNAP outputs of a scene on the region grid, without GRASS.
+Replaces G_align.sh: all the {band}_x.tif files of a scene are cropped to the
+valid SZA extent within the region mask and resampled (nearest neighbour) on
+the mask grid at the requested resolution.
+
+The source pixel of each destination pixel is computed once per source grid
+and cached, so that all the bands of a scene (and scenes sharing the same
+SNAP output grid) are resampled by simple indexing. Bands are written in
+parallel.
+
+INPUTS:
+    folder: Path to the scene folder containing the {band}_x.tif files. [string]
+    mask: Path to the region mask. [string]
+    resize: Output resolution in meters. [float]
+
+OUTPUTS:
+    {folder}/{band}.tif: aligned bands. [.tif]
+    {folder}/mask.tif: region mask over the scene extent. [.tif]
+    Exit status 1 if no band was aligned (missing SZA, scene outside of the
+    region), the {band}_x.tif files being then kept by S3_proc.sh.
+
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from dm_stream import region_grid, window_grid, bounds_window, read_on_grid
+
+tifopts = dict(driver='GTiff', dtype='float32', nodata=np.nan, count=1,
+               compress='DEFLATE', predictor=2, tiled=True,
+               blockxsize=256, blockysize=256)
+
+
+@lru_cache(maxsize=None)
+def region_mask(mask_file, res):
+    '''
+    Region mask on the region grid, True inside the region.
+    '''
+
+    mask = read_on_grid(mask_file, region_grid(mask_file, res))
+
+    return ~np.isnan(mask) & (mask != 0)
+
+
+@lru_cache(maxsize=32)
+def nearest_index(src_transform, src_width, src_height,
+                  dst_transform, dst_width, dst_height):
+    '''
+    Nearest neighbour source pixel of each pixel of a destination grid with
+    the same coordinate reference system.
+
+    INPUTS:
+        src_transform, src_width, src_height: Source grid.
+        dst_transform, dst_width, dst_height: Destination grid.
+
+    OUTPUTS:
+        rows, cols: Source row and column of each destination pixel. [arrays]
+        inside: True where the destination pixel is within the source. [array]
+    '''
+
+    cols, rows = np.meshgrid(np.arange(dst_width) + 0.5,
+                             np.arange(dst_height) + 0.5)
+    x, y = dst_transform * (cols, rows)
+    src_cols, src_rows = ~src_transform * (x, y)
+
+    src_cols = np.floor(src_cols).astype('int32')
+    src_rows = np.floor(src_rows).astype('int32')
+
+    inside = (src_cols >= 0) & (src_cols < src_width) \
+        & (src_rows >= 0) & (src_rows < src_height)
+
+    return src_rows[inside], src_cols[inside], inside
+
+
+def resample(filename, grid):
+    '''
+    Reads a raster and resamples it on a grid (nearest neighbour) with a
+    cached index. Nodata pixels are set to NaN.
+
+    INPUTS:
+        filename: Path to the raster. [string]
+        grid: Destination grid (see dm_stream.region_grid). [dict]
+
+    OUTPUTS:
+        data: raster on the grid. [array]
+    '''
+
+    with rasterio.open(filename) as src:
+
+        if src.crs != grid['crs']:
+            # reprojection needed: no cached index
+            return read_on_grid(filename, grid)
+
+        rows, cols, inside = nearest_index(src.transform, src.width,
+                                           src.height, grid['transform'],
+                                           grid['width'], grid['height'])
+        src_data = src.read(1).astype('float32')
+        nodata = src.nodata
+
+    if nodata is not None and not np.isnan(nodata):
+        src_data[src_data == nodata] = np.nan
+
+    data = np.full((grid['height'], grid['width']), np.nan, dtype='float32')
+    data[inside] = src_data[rows, cols]
+
+    return data
+
+
+def write_band(data, filename, grid):
+
+    with rasterio.open(filename, 'w', crs=grid['crs'],
+                       transform=grid['transform'], width=grid['width'],
+                       height=grid['height'], **tifopts) as dst:
+        dst.write(data.astype('float32'), 1)
+
+
+def align_scene(folder, mask_file, resize, n_threads=4):
+    '''
+    Aligns all the {band}_x.tif files of a scene on the region grid.
+
+    INPUTS:
+        folder: Path to the scene folder. [string]
+        mask_file: Path to the region mask. [string]
+        resize: Output resolution in meters. [float]
+        n_threads: Number of bands written in parallel. [int]
+
+    OUTPUTS:
+        list of the aligned files, empty if the scene does not overlap
+        the region. [list]
+    '''
+
+    grid = region_grid(mask_file, resize)
+    mask = region_mask(mask_file, resize)
+
+    sza_file = folder + os.sep + 'SZA_x.tif'
+    if not os.path.isfile(sza_file):
+        print('ERROR: %s is missing' % sza_file)
+        return []
+
+    # window of the region covered by the scene
+    with rasterio.open(sza_file) as src:
+        window = bounds_window(src.bounds, src.crs, grid)
+    if window is None:
+        print('ERROR: %s outside of region' % folder)
+        return []
+
+    # zoom on the valid SZA within the region mask ("g.region zoom=SZA")
+    sza = resample(sza_file, window_grid(grid, window))
+    mask_window = mask[window.toslices()]
+    sza[~mask_window] = np.nan
+
+    valid = ~np.isnan(sza)
+    if not valid.any():
+        print('ERROR: %s: no valid SZA within region' % folder)
+        return []
+    rows = np.where(valid.any(axis=1))[0]
+    cols = np.where(valid.any(axis=0))[0]
+    zoom = Window(window.col_off + cols[0], window.row_off + rows[0],
+                  cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+    zoom_grid = window_grid(grid, zoom)
+    zoom_mask = mask[zoom.toslices()]
+
+    def align_band(filename):
+        band = os.path.basename(filename)[:-len('_x.tif')]
+        data = resample(filename, zoom_grid)
+        data[~zoom_mask] = np.nan
+        out_file = folder + os.sep + band + '.tif'
+        write_band(data, out_file, zoom_grid)
+        return out_file
+
+    files = sorted(glob.glob(folder + os.sep + '*_x.tif'))
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        out_files = list(executor.map(align_band, files))
+
+    mask_out = np.where(zoom_mask, read_on_grid(mask_file, zoom_grid), np.nan)
+    write_band(mask_out, folder + os.sep + 'mask.tif', zoom_grid)
+
+    return out_files + [folder + os.sep + 'mask.tif']
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('folder')
+    parser.add_argument('mask')
+    parser.add_argument('resize', type=float)
+    parser.add_argument('-j', '--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    start_time = time.time()
+
+    out_files = align_scene(args.folder, args.mask, args.resize,
+                            n_threads=args.threads)
+
+    print('End S3_align.py %s --- %s seconds ---'
+          % (args.folder, time.time() - start_time))
+
+    if not out_files:
+        sys.exit(1)
@@ -0,0 +1,526 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Catalog of a local Sentinel-3 archive (e.g. /eodata/Sentinel-3) in a SQLite
+database, for the discovery and pairing of OLCI EFR and SLSTR RBT products
+without querying the data hub or listing folders.
+
+The archive is scanned once, then incrementally: products already in the
+catalog are only parsed again if their xfdumanifest.xml changed. For each
+product, the catalog holds the platform, sensor, sensing start and stop,
+absolute and relative orbit, orbit direction and footprint (from
+xfdumanifest.xml, or from the product name if the manifest is missing).
+Sensing times are indexed, and footprint bounding boxes are in an R*Tree
+index, so that:
+    - the scenes of a (region, date) are an indexed query, refined by the
+      intersection of the footprint with the region mask,
+    - an OLCI product is paired with the SLSTR product of the same platform
+      whose sensing start is the closest, within a tolerance (180 s by
+      default) instead of the same minute or the minute before or after.
+
+Usage:
+    python S3_catalog.py index /eodata/Sentinel-3 [--date 2020-07-01]
+    python S3_catalog.py select --date 2020-07-01 --mask masks/Iceland_1km.tif
+    python S3_catalog.py link --date 2020-07-01 --mask ... --out folder
+    python S3_catalog.py pair --olci S3A_OL_1_EFR____...SEN3 [--within folder]
+    python S3_catalog.py pairs --date 2020-07-01 [--mask ...] [--within folder]
+
+OUTPUTS:
+    {db}: SQLite catalog. [.sqlite]
+
+"""
+
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+from rasterio.features import rasterize
+from rasterio.warp import transform as transform_coords
+
+from S3_align import region_mask
+from dm_stream import region_grid
+
+schema = '''
+CREATE TABLE IF NOT EXISTS products (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    path TEXT UNIQUE NOT NULL,
+    platform TEXT,
+    sensor TEXT,
+    start REAL,
+    stop REAL,
+    orbit INTEGER,
+    relative_orbit INTEGER,
+    direction TEXT,
+    footprint TEXT,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS products_time ON products (sensor, start);
+CREATE INDEX IF NOT EXISTS products_name ON products (name);
+CREATE VIRTUAL TABLE IF NOT EXISTS footprints
+    USING rtree(id, min_lon, max_lon, min_lat, max_lat);
+'''
+
+name_pattern = (r'(S3[AB])_(OL_1_EFR|SL_1_RBT)____(\d{8}T\d{6})_(\d{8}T\d{6})_'
+                r'\d{8}T\d{6}_\d{4}_(\d{3})_(\d{3})_.*\.SEN3$')
+
+# sub-folders of the archive, as in dhusget_wrapper.sh
+archive_subfolders = {'OL_1_EFR': 'OLCI/OL_1_EFR___',
+                      'SL_1_RBT': 'SLSTR/SL_1_RBT___'}
+
+# resolution of the region masks for the footprint intersection, in meters
+footprint_res = 5000
+
+pair_tolerance = 180
+
+epoch = datetime(1970, 1, 1)
+
+
+def connect(db_file):
+    '''
+    Opens the catalog, creating it if needed.
+    '''
+
+    con = sqlite3.connect(db_file, timeout=60)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.executescript(schema)
+
+    return con
+
+
+def to_seconds(timestamp):
+    '''
+    Seconds since epoch of a UTC timestamp (YYYYmmddTHHMMSS or ISO).
+    '''
+
+    timestamp = timestamp.rstrip('Z').replace('-', '').replace(':', '')
+    fmt = '%Y%m%dT%H%M%S.%f' if '.' in timestamp else '%Y%m%dT%H%M%S'
+
+    return (datetime.strptime(timestamp, fmt) - epoch).total_seconds()
+
+
+def parse_name(name):
+    '''
+    Product attributes from its name, None if it is not an OLCI EFR or SLSTR
+    RBT product.
+    '''
+
+    match = re.match(name_pattern, name)
+    if not match:
+        return None
+
+    return dict(platform=match.group(1), sensor=match.group(2),
+                start=to_seconds(match.group(3)),
+                stop=to_seconds(match.group(4)),
+                relative_orbit=int(match.group(6)), orbit=None,
+                direction=None, footprint=None)
+
+
+def parse_manifest(text):
+    '''
+    Sensing times, orbit and footprint from the text of xfdumanifest.xml.
+
+    OUTPUTS:
+        attributes found in the manifest. [dict]
+    '''
+
+    attributes = {}
+
+    for key, tag in [('start', 'startTime'), ('stop', 'stopTime')]:
+        match = re.search(r'<sentinel-safe:%s>([^<]+)<' % tag, text)
+        if match:
+            attributes[key] = to_seconds(match.group(1))
+
+    match = re.search(r'<sentinel-safe:orbitNumber([^>]*)>(\d+)<', text)
+    if match:
+        attributes['orbit'] = int(match.group(2))
+        direction = re.search(r'groundTrackDirection="(\w+)"', match.group(1))
+        if direction:
+            attributes['direction'] = direction.group(1).lower()
+
+    match = re.search(r'<sentinel-safe:relativeOrbitNumber[^>]*>(\d+)<', text)
+    if match:
+        attributes['relative_orbit'] = int(match.group(1))
+
+    match = re.search(r'<sentinel-safe:footPrint>.*?<gml:posList>([^<]+)<',
+                      text, re.S)
+    if match:
+        values = [float(v) for v in match.group(1).split()]
+        # posList is lat lon
+        attributes['footprint'] = [[values[i + 1], values[i]]
+                                   for i in range(0, len(values) - 1, 2)]
+
+    return attributes
+
+
+def bounding_box(footprint):
+    '''
+    min_lon, max_lon, min_lat, max_lat of a footprint. Footprints crossing
+    the antimeridian, or unknown, span all the longitudes.
+    '''
+
+    if not footprint:
+        return -180., 180., -90., 90.
+
+    lon = [p[0] for p in footprint]
+    lat = [p[1] for p in footprint]
+
+    if max(lon) - min(lon) > 180:
+        return -180., 180., min(lat), max(lat)
+
+    return min(lon), max(lon), min(lat), max(lat)
+
+
+def product_folders(root, dates=None):
+    '''
+    SEN3 folders of an archive. With dates, only the {sensor}/YYYY/MM/DD
+    sub-folders of these dates are listed (and the SEN3 folders directly in
+    root, as in the region folders of S3_NRT.sh).
+    '''
+
+    folders = [root + os.sep + f for f in os.listdir(root)
+               if f.endswith('.SEN3')]
+
+    if dates is not None:
+        for date in dates:
+            for subfolder in archive_subfolders.values():
+                folder = os.sep.join([root, subfolder] + date.split('-'))
+                if os.path.isdir(folder):
+                    folders += [folder + os.sep + f
+                                for f in os.listdir(folder)
+                                if f.endswith('.SEN3')]
+        return sorted(folders)
+
+    for path, subfolders, _ in os.walk(root, followlinks=False):
+        # no need to go into the products
+        products = [f for f in subfolders if f.endswith('.SEN3')]
+        if path != root:
+            folders += [path + os.sep + f for f in products]
+        subfolders[:] = [f for f in subfolders if not f.endswith('.SEN3')]
+
+    return sorted(set(folders))
+
+
+def index(con, folders):
+    '''
+    Adds the products of folders to the catalog, or updates them if their
+    manifest changed. A product found in several folders (archive and
+    region folders linking to it) has one record per folder.
+
+    OUTPUTS:
+        number of products added or updated. [int]
+    '''
+
+    known = {row[0]: row[1] for row in
+             con.execute('SELECT path, mtime_ns FROM products')}
+    n = 0
+
+    for folder in folders:
+        name = os.path.basename(folder)
+        attributes = parse_name(name)
+        if attributes is None:
+            continue
+
+        manifest = folder + os.sep + 'xfdumanifest.xml'
+        try:
+            mtime_ns = os.stat(manifest).st_mtime_ns
+        except OSError:
+            mtime_ns = None
+
+        path = os.path.abspath(folder)
+        if path in known and known[path] == mtime_ns:
+            continue
+
+        if mtime_ns is not None:
+            with open(manifest) as f:
+                attributes.update(parse_manifest(f.read()))
+
+        with con:
+            con.execute('DELETE FROM footprints WHERE id IN '
+                        '(SELECT id FROM products WHERE path=?)', (path,))
+            con.execute('DELETE FROM products WHERE path=?', (path,))
+            cursor = con.execute(
+                'INSERT INTO products (name, path, platform, sensor, start, '
+                'stop, orbit, relative_orbit, direction, footprint, '
+                'mtime_ns) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (name, path, attributes['platform'], attributes['sensor'],
+                 attributes['start'], attributes['stop'], attributes['orbit'],
+                 attributes['relative_orbit'], attributes['direction'],
+                 json.dumps(attributes['footprint']), mtime_ns))
+            con.execute('INSERT INTO footprints VALUES (?, ?, ?, ?, ?)',
+                        (cursor.lastrowid,)
+                        + bounding_box(attributes['footprint']))
+        n += 1
+
+    return n
+
+
+def prune(con):
+    '''
+    Removes the products whose folder no longer exists.
+    '''
+
+    missing = [row for row in con.execute('SELECT id, path FROM products')
+               if not os.path.isdir(row[1])]
+
+    with con:
+        for product_id, _ in missing:
+            con.execute('DELETE FROM footprints WHERE id=?', (product_id,))
+            con.execute('DELETE FROM products WHERE id=?', (product_id,))
+
+    return len(missing)
+
+
+@lru_cache(maxsize=None)
+def region_footprint(mask_file):
+    '''
+    Region mask on a coarse grid and bounding box of the region in lon/lat.
+
+    OUTPUTS:
+        mask: Region mask. [boolean array]
+        grid: Grid of the mask (see dm_stream.region_grid). [dict]
+        bbox: min_lon, max_lon, min_lat, max_lat. [tuple]
+    '''
+
+    grid = region_grid(mask_file, footprint_res)
+    mask = region_mask(mask_file, footprint_res)
+
+    rows, cols = np.nonzero(mask)
+    # pixel corners, not to miss footprints touching the edge pixels
+    x, y = [], []
+    for dr, dc in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+        xs, ys = grid['transform'] * (cols + dc, rows + dr)
+        x.append(xs)
+        y.append(ys)
+    lon, lat = transform_coords(grid['crs'], 'EPSG:4326',
+                                np.concatenate(x).tolist(),
+                                np.concatenate(y).tolist())
+
+    bbox = bounding_box(list(zip(lon, lat)))
+
+    return mask, grid, bbox
+
+
+def intersects(footprint, mask_file):
+    '''
+    True if a footprint covers at least one pixel of the region mask.
+    '''
+
+    if not footprint:
+        return True
+
+    mask, grid, _ = region_footprint(mask_file)
+
+    # projected on the region grid: no issue with the antimeridian
+    x, y = transform_coords('EPSG:4326', grid['crs'],
+                            [p[0] for p in footprint],
+                            [p[1] for p in footprint])
+    polygon = {'type': 'Polygon', 'coordinates': [list(zip(x, y))]}
+    burned = rasterize([(polygon, 1)], out_shape=mask.shape,
+                       transform=grid['transform'], all_touched=True,
+                       dtype='uint8')
+
+    return bool((burned.astype(bool) & mask).any())
+
+
+def day_range(date):
+    '''
+    Start and end in seconds since epoch of a day (YYYY-MM-DD).
+    '''
+
+    day_start = to_seconds(date.replace('-', '') + 'T000000')
+
+    return day_start, day_start + 86400
+
+
+def select(con, date, mask_file=None, sensor=None, direction=None,
+           within=None):
+    '''
+    Products sensed on a date, intersecting a region.
+
+    INPUTS:
+        date: Date (YYYY-MM-DD). [string]
+        mask_file: Path to the region mask, all products if None. [string]
+        sensor: 'OL_1_EFR' or 'SL_1_RBT', both if None. [string]
+        direction: 'descending' or 'ascending', both if None. Products with
+                   an unknown direction are kept. [string]
+        within: Only products in this folder. [string]
+
+    OUTPUTS:
+        products: (name, path, platform, sensor, start) sorted by start,
+                  each product once. [list of tuples]
+    '''
+
+    day_start, day_end = day_range(date)
+
+    query = ('SELECT p.name, p.path, p.platform, p.sensor, p.start, '
+             'p.footprint FROM products p')
+    conditions = ['p.start >= ?', 'p.start < ?']
+    values = [day_start, day_end]
+
+    if mask_file is not None:
+        min_lon, max_lon, min_lat, max_lat = region_footprint(mask_file)[2]
+        query += ' JOIN footprints f ON f.id = p.id'
+        conditions += ['f.max_lon >= ?', 'f.min_lon <= ?',
+                       'f.max_lat >= ?', 'f.min_lat <= ?']
+        values += [min_lon, max_lon, min_lat, max_lat]
+    if sensor is not None:
+        conditions.append('p.sensor = ?')
+        values.append(sensor)
+    if direction is not None:
+        conditions.append('(p.direction = ? OR p.direction IS NULL)')
+        values.append(direction)
+    if within is not None:
+        conditions.append('p.path LIKE ?')
+        values.append(os.path.abspath(within) + os.sep + '%')
+
+    rows = con.execute(query + ' WHERE ' + ' AND '.join(conditions)
+                       + ' ORDER BY p.start, p.name, p.path', values)
+
+    products = []
+    names = set()
+    for row in rows:
+        if row[0] in names:
+            continue
+        if mask_file is None or intersects(json.loads(row[5]), mask_file):
+            products.append(row[:5])
+            names.add(row[0])
+
+    return products
+
+
+def pair(con, olci_name, tolerance=pair_tolerance, within=None):
+    '''
+    SLSTR product of an OLCI product: same platform, closest sensing start
+    within the tolerance.
+
+    INPUTS:
+        olci_name: Name of the OLCI product. [string]
+        tolerance: Maximum difference of sensing start in seconds. [float]
+        within: Only SLSTR products in this folder. [string]
+
+    OUTPUTS:
+        (name, path) of the SLSTR product, None if not found. [tuple]
+    '''
+
+    row = con.execute('SELECT platform, start FROM products WHERE name=? '
+                      'LIMIT 1', (os.path.basename(olci_name),)).fetchone()
+    if row is None:
+        return None
+    platform, start = row
+
+    query = ('SELECT name, path FROM products WHERE sensor=? AND platform=? '
+             'AND start BETWEEN ? AND ?')
+    values = ['SL_1_RBT', platform, start - tolerance, start + tolerance]
+    if within is not None:
+        query += ' AND path LIKE ?'
+        values.append(os.path.abspath(within) + os.sep + '%')
+
+    return con.execute(query + ' ORDER BY abs(start - ?), name, path LIMIT 1',
+                       values + [start]).fetchone()
+
+
+def pairs(con, date, mask_file=None, tolerance=pair_tolerance, within=None):
+    '''
+    OLCI/SLSTR pairs of a date.
+
+    OUTPUTS:
+        pairs: (scene, olci path, slstr path or None) sorted by acquisition
+               time, scene being the OLCI sensing start. [list of tuples]
+    '''
+
+    result = []
+
+    for name, path, _, _, _ in select(con, date, mask_file, 'OL_1_EFR',
+                                      within=within):
+        slstr = pair(con, name, tolerance, within)
+        if slstr is None:
+            print('ERROR: No nearby SLSTR scene found for %s' % name)
+        result.append((re.match(name_pattern, name).group(3), path,
+                       slstr[1] if slstr is not None else None))
+
+    return result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=['index', 'select', 'link', 'pair',
+                                           'pairs'])
+    parser.add_argument('roots', nargs='*', help='folders to index')
+    parser.add_argument('--db', default='S3_catalog.sqlite')
+    parser.add_argument('--date', nargs='+', default=None,
+                        help='date(s) to index, or date of the products to '
+                        'select (YYYY-MM-DD)')
+    parser.add_argument('--prune', action='store_true',
+                        help='remove the products that no longer exist')
+    parser.add_argument('--mask', default=None, help='region mask')
+    parser.add_argument('--sensor', default=None,
+                        choices=['OL_1_EFR', 'SL_1_RBT'])
+    parser.add_argument('--direction', default=None,
+                        choices=['ascending', 'descending'])
+    parser.add_argument('--olci', default=None, help='OLCI product to pair')
+    parser.add_argument('--within', default=None,
+                        help='only the products in this folder')
+    parser.add_argument('--tolerance', type=float, default=pair_tolerance,
+                        help='pairing tolerance in seconds')
+    parser.add_argument('--out', default=None,
+                        help='folder where the selected products are linked')
+    parser.add_argument('--names', action='store_true',
+                        help='print the product names instead of the paths')
+    args = parser.parse_args()
+
+    start_time = time.time()
+
+    con = connect(args.db)
+
+    if args.action == 'index':
+        n = sum(index(con, product_folders(root, args.date))
+                for root in args.roots)
+        n_pruned = prune(con) if args.prune else 0
+        print('End S3_catalog.py index, %d products indexed, %d removed '
+              '--- %s seconds ---' % (n, n_pruned, time.time() - start_time))
+        sys.exit(0)
+
+    if args.action == 'pair':
+        slstr = pair(con, args.olci, args.tolerance, args.within)
+        if slstr is None:
+            sys.exit(1)
+        print(slstr[0] if args.names else slstr[1])
+        sys.exit(0)
+
+    if args.date is None:
+        print('ERROR: --date is missing')
+        sys.exit(2)
+    date = args.date[0]
+
+    if args.action == 'pairs':
+        for scene, olci, slstr in pairs(con, date, args.mask, args.tolerance,
+                                        args.within):
+            print(scene, olci, slstr)
+        sys.exit(0)
+
+    products = select(con, date, args.mask, args.sensor, args.direction,
+                      args.within)
+
+    if args.action == 'select':
+        for name, path, _, _, _ in products:
+            print(name if args.names else path)
+
+    else:
+        os.makedirs(args.out, exist_ok=True)
+        for name, path, _, _, _ in products:
+            link = args.out + os.sep + name
+            if not os.path.lexists(link):
+                os.symlink(path, link)
+        print('End S3_catalog.py link %s, %d products --- %s seconds ---'
+              % (args.out, len(products), time.time() - start_time))
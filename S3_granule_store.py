@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Shared store of the Sentinel-3 granules (SEN3 products) of multi-region
+NRT runs.
+
+The regions of S3_NRT.sh overlap (Greenland, JanMayen, Svalbard, ...), so
+the same granule is fetched and processed once per region. The store keeps
+a single copy of each granule, keyed by product name:
+    - ingest: moves the SEN3 folders fetched for a region into the store
+      (or deletes them if the store already has the granule) and replaces
+      them by symbolic links. Links to a local archive (e.g. /eodata) are
+      kept as links, nothing is copied.
+    - process: reads each OLCI/SLSTR pair of the store once (S3_reader.py)
+      and resamples it on the grid of every region it intersects, writing
+      the same scene folders as S3_proc.sh -P.
+
+INPUTS:
+    ingest folder: Path to the SEN3 folder of a region-day. [string]
+    process date: Date to process (YYYY-MM-DD). [string]
+    --store: Path to the granule store. [string]
+    --regions: Regions to process. [list]
+    --inpath: SEN3 folder of the regions, {region} is replaced by the region
+              name. Only the granules linked there are processed for a
+              region. [string]
+    --proc: Processing folder of the regions. [string]
+    --mask: Region mask. [string]
+    --res: Output resolution in meters. [float]
+    --catalog: Path to the S3_catalog.py database, to pair the scenes from
+               the catalog. [string]
+
+OUTPUTS:
+    {store}/{date}/{product}.SEN3: granules. [folders]
+    {proc}/{date}/{scene}/{band}.tif: same files as S3_proc.sh. [.tif]
+
+"""
+
+import argparse
+import os
+import re
+import shutil
+import time
+
+import S3_reader
+from S3_pipeline import pair_scenes
+
+product_pattern = r'S3._(OL_1_EFR|SL_1_RBT)____(\d{8})T\d{6}_.*\.SEN3$'
+
+
+def store_folder(store, product):
+    '''
+    Folder of a granule in the store, by sensing date.
+    '''
+
+    yyyymmdd = re.match(product_pattern, product).group(2)
+    date = '%s-%s-%s' % (yyyymmdd[:4], yyyymmdd[4:6], yyyymmdd[6:])
+
+    return store + os.sep + date + os.sep + product
+
+
+def ingest(folder, store):
+    '''
+    Moves the granules of a region folder into the store and links them
+    back.
+
+    INPUTS:
+        folder: Path to the SEN3 folder of a region-day. [string]
+        store: Path to the granule store. [string]
+
+    OUTPUTS:
+        number of granules moved into the store. [int]
+    '''
+
+    moved = 0
+
+    for product in sorted(os.listdir(folder)):
+        if not re.match(product_pattern, product):
+            continue
+
+        path = folder + os.sep + product
+        stored = store_folder(store, product)
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+
+        if os.path.islink(path):
+            target = os.path.realpath(path)
+            if target == os.path.realpath(stored):
+                continue
+            # product of a local archive: the store links to it as well
+            if not os.path.lexists(stored):
+                os.symlink(target, stored)
+        elif os.path.lexists(stored):
+            print('%s already in store, duplicate removed' % product)
+            shutil.rmtree(path)
+        else:
+            shutil.move(path, stored)
+            moved += 1
+
+        if os.path.lexists(path):
+            os.remove(path)
+        os.symlink(os.path.abspath(stored), path)
+
+    return moved
+
+
+def process(date, store, regions, proc, mask, res, inpath=None,
+            cache_dir=None, catalog=None):
+    '''
+    Processes the granules of a date on the grids of all the regions, each
+    pair being read once.
+
+    INPUTS:
+        date: Date to process (YYYY-MM-DD). [string]
+        store: Path to the granule store. [string]
+        regions: Region names. [list]
+        proc, mask, inpath: Paths where {region} is replaced by the region
+                            name (see module docstring). [strings]
+        res: Output resolution in meters. [float]
+        cache_dir: Folder of the cached reprojection indices. [string]
+        catalog: Path to the catalog database used for pairing. [string]
+
+    OUTPUTS:
+        number of scene folders written. [int]
+    '''
+
+    date_folder = store + os.sep + date
+    if not os.path.isdir(date_folder):
+        print('ERROR: no granule in store for %s' % date)
+        return 0
+
+    written = 0
+
+    for scene, olci_folder, slstr_folder in pair_scenes(date_folder, date,
+                                                         catalog):
+
+        if slstr_folder is None:
+            continue
+
+        product = os.path.basename(olci_folder)
+
+        todo = []
+        for region in regions:
+            dest = proc.format(region=region) + os.sep + date + os.sep + scene
+            if os.path.isfile(dest + os.sep + 'r_TOA_01.tif'):
+                print('%s already exists, scene skipped' % dest)
+                continue
+            if inpath is not None and not os.path.lexists(
+                    inpath.format(region=region) + os.sep + product):
+                continue
+            todo.append((region, dest))
+
+        if not todo:
+            continue
+
+        results = S3_reader.read_scenes(
+            olci_folder, slstr_folder,
+            [(mask.format(region=region), res) for region, _ in todo],
+            cache_dir=cache_dir)
+
+        for (region, dest), (bands, grid) in zip(todo, results):
+            if grid is None:
+                continue
+            # written in a temporary folder, not to leave a partial scene
+            tmp_dest = dest + '.tmp'
+            if os.path.isdir(tmp_dest):
+                shutil.rmtree(tmp_dest)
+            S3_reader.write_scene(bands, grid, tmp_dest)
+            if os.path.isdir(dest):
+                shutil.rmtree(dest)
+            os.replace(tmp_dest, dest)
+            written += 1
+            print('%s %s: %s' % (region, scene, dest))
+
+    return written
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=['ingest', 'process'])
+    parser.add_argument('target', help='SEN3 folder (ingest) or date '
+                        '(process)')
+    parser.add_argument('--store', default='/sice-data/SICE/granules')
+    parser.add_argument('--regions', nargs='+', default=[])
+    parser.add_argument('--inpath', default=None)
+    parser.add_argument('--proc', default='/sice-data/SICE/{region}/proc')
+    parser.add_argument('--mask', default='./masks/{region}_300m.tif')
+    parser.add_argument('--res', type=float, default=1000)
+    parser.add_argument('--cache', default=None,
+                        help='folder where reprojection indices are cached, '
+                        'for scenes read again (not pruned)')
+    parser.add_argument('--catalog', default=None,
+                        help='S3_catalog.py database, to pair the scenes')
+    args = parser.parse_args()
+
+    start_time = time.time()
+
+    if args.action == 'ingest':
+        n = ingest(args.target, args.store)
+        print('End S3_granule_store.py ingest %s, %d granules moved '
+              '--- %s seconds ---' % (args.target, n, time.time() - start_time))
+    else:
+        n = process(args.target, args.store, args.regions, args.proc,
+                    args.mask, args.res, args.inpath, args.cache,
+                    args.catalog)
+        print('End S3_granule_store.py process %s, %d scenes '
+              '--- %s seconds ---' % (args.target, n, time.time() - start_time))
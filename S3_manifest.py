@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Job-state manifest of the processing stages, in a local SQLite database.
+
+For each (region, date, scene, stage), the manifest records the fingerprint
+of the inputs (checksums of the input files, of the code and of the command),
+the checksums of the outputs, the status and the timing. A stage is skipped
+only if it is done with the same fingerprint and all its outputs are
+verified. Reruns after a failure (status "running" or "failed") or a code
+update therefore redo the stages concerned only, and a half-written output
+folder is never taken for a finished one.
+
+File checksums (sha1) are cached by path, size and modification time, so
+unchanged files are hashed once. Since the fingerprints are computed from
+the file contents, a stage rewriting identical outputs does not trigger
+the downstream stages.
+
+Usage from the shell scripts:
+    python S3_manifest.py run --db manifest.sqlite --region R --date D
+        --stage sice --inputs {files, folders or globs} --outputs {...}
+        --code sice.py -- python ./sice.py {mosaic}
+    python S3_manifest.py check|start|done|fail ... (same arguments)
+    python S3_manifest.py status --db manifest.sqlite [--region R --date D]
+
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+schema = '''
+CREATE TABLE IF NOT EXISTS stages (
+    region TEXT NOT NULL,
+    date TEXT NOT NULL,
+    scene TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    fingerprint TEXT,
+    outputs TEXT,
+    status TEXT,
+    start REAL,
+    end REAL,
+    seconds REAL,
+    PRIMARY KEY (region, date, scene, stage)
+);
+CREATE TABLE IF NOT EXISTS checksums (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    sha1 TEXT
+);
+'''
+
+
+def connect(db_file):
+    '''
+    Opens the manifest, creating it if needed.
+    '''
+
+    con = sqlite3.connect(db_file, timeout=60)
+    # concurrent readers and one writer (S3_scheduler.py jobs)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.executescript(schema)
+
+    return con
+
+
+def list_files(paths):
+    '''
+    Expands globs and folders (recursively) into a sorted list of files.
+    Missing paths are ignored.
+    '''
+
+    files = set()
+
+    for path in paths:
+        for match in glob.glob(path):
+            if os.path.isdir(match):
+                for root, _, names in os.walk(match):
+                    files.update(os.path.join(root, n) for n in names)
+            elif os.path.isfile(match):
+                files.add(match)
+
+    return sorted(os.path.abspath(f) for f in files)
+
+
+def checksum(con, path):
+    '''
+    sha1 of a file, from the cache if its size and modification time are
+    unchanged.
+    '''
+
+    stat = os.stat(path)
+    row = con.execute('SELECT size, mtime_ns, sha1 FROM checksums '
+                      'WHERE path=?', (path,)).fetchone()
+
+    if row is not None and row[0] == stat.st_size \
+            and row[1] == stat.st_mtime_ns:
+        return row[2]
+
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+
+    with con:
+        con.execute('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?)',
+                    (path, stat.st_size, stat.st_mtime_ns, sha.hexdigest()))
+
+    return sha.hexdigest()
+
+
+def fingerprint(con, inputs, code=(), command=(), after=()):
+    '''
+    Fingerprint of a stage.
+
+    INPUTS:
+        con: Manifest connection. [sqlite3.Connection]
+        inputs: Input files, folders or globs. [list]
+        code: Code files of the stage. [list]
+        command: Command line of the stage. [list]
+        after: Outputs (JSON) of the upstream stages. [list]
+
+    OUTPUTS:
+        sha1 of the inputs and code checksums, command and upstream
+        outputs. [string]
+    '''
+
+    sha = hashlib.sha1()
+
+    for path in list_files(inputs) + list_files(code):
+        sha.update(('%s %s\n' % (path, checksum(con, path))).encode())
+
+    sha.update(' '.join(command).encode())
+
+    for outputs in after:
+        sha.update((outputs or '').encode())
+
+    return sha.hexdigest()
+
+
+def get_record(con, key):
+
+    row = con.execute('SELECT fingerprint, outputs, status FROM stages '
+                      'WHERE region=? AND date=? AND scene=? AND stage=?',
+                      key).fetchone()
+
+    if row is None:
+        return None
+
+    return dict(fingerprint=row[0], outputs=row[1], status=row[2])
+
+
+def outputs_verified(con, outputs):
+    '''
+    True if all the recorded outputs exist with the recorded checksums.
+
+    INPUTS:
+        outputs: Recorded outputs, JSON of {path: sha1}. [string]
+    '''
+
+    if not outputs:
+        return False
+
+    for path, sha1 in json.loads(outputs).items():
+        if not os.path.isfile(path) or checksum(con, path) != sha1:
+            return False
+
+    return True
+
+
+def is_done(con, key, fp):
+    '''
+    True if a stage is done with the fingerprint fp and verified outputs.
+
+    INPUTS:
+        key: region, date, scene, stage. [tuple]
+        fp: Fingerprint of the stage (see fingerprint). [string]
+    '''
+
+    record = get_record(con, key)
+
+    return (record is not None and record['status'] == 'done'
+            and record['fingerprint'] == fp
+            and outputs_verified(con, record['outputs']))
+
+
+def start(con, key, fp):
+
+    with con:
+        con.execute('INSERT OR REPLACE INTO stages VALUES '
+                    '(?, ?, ?, ?, ?, NULL, ?, ?, NULL, NULL)',
+                    key + (fp, 'running', time.time()))
+
+
+def done(con, key, outputs):
+    '''
+    Marks a stage as done and records the checksums of its outputs.
+
+    INPUTS:
+        key: region, date, scene, stage. [tuple]
+        outputs: Output files, folders or globs. [list]
+    '''
+
+    checksums = {path: checksum(con, path) for path in list_files(outputs)}
+    end = time.time()
+
+    with con:
+        con.execute('UPDATE stages SET outputs=?, status=?, end=?, '
+                    'seconds=? - start WHERE region=? AND date=? '
+                    'AND scene=? AND stage=?',
+                    (json.dumps(checksums), 'done', end, end) + key)
+
+
+def fail(con, key):
+
+    end = time.time()
+
+    with con:
+        con.execute('UPDATE stages SET status=?, end=?, seconds=? - start '
+                    'WHERE region=? AND date=? AND scene=? AND stage=?',
+                    ('failed', end, end) + key)
+
+
+def run(con, key, inputs, outputs, code=(), command=(), after=()):
+    '''
+    Runs the command of a stage unless it is already done with the same
+    fingerprint.
+
+    OUTPUTS:
+        returncode: 0 if the stage is done or skipped. [int]
+    '''
+
+    fp = fingerprint(con, inputs, code, command, upstream(con, key, after))
+
+    if is_done(con, key, fp):
+        print('%s %s %s %s already done, stage skipped' % key)
+        return 0
+
+    start(con, key, fp)
+    returncode = subprocess.call(command)
+
+    if returncode == 0:
+        done(con, key, outputs)
+    else:
+        fail(con, key)
+
+    return returncode
+
+
+def upstream(con, key, after):
+    '''
+    Recorded outputs of the upstream stages of the same region, date and
+    scene.
+    '''
+
+    records = [get_record(con, key[:3] + (stage,)) for stage in after]
+
+    return [r['outputs'] if r is not None else None for r in records]
+
+
+def print_status(con, region=None, date=None):
+
+    query = 'SELECT region, date, scene, stage, status, seconds FROM stages'
+    conditions, values = [], []
+    if region is not None:
+        conditions.append('region=?')
+        values.append(region)
+    if date is not None:
+        conditions.append('date=?')
+        values.append(date)
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+
+    for row in con.execute(query + ' ORDER BY region, date, scene, start',
+                           values):
+        seconds = '%.1f s' % row[5] if row[5] is not None else ''
+        print('%s %s %s %s %s %s' % (row[:5] + (seconds,)))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=['run', 'check', 'start', 'done',
+                                           'fail', 'status'])
+    parser.add_argument('--db', default='SICE_manifest.sqlite')
+    parser.add_argument('--region', default=None)
+    parser.add_argument('--date', default=None)
+    parser.add_argument('--scene', default='')
+    parser.add_argument('--stage', default=None)
+    parser.add_argument('--inputs', nargs='*', default=[])
+    parser.add_argument('--outputs', nargs='*', default=[])
+    parser.add_argument('--code', nargs='*', default=[])
+    parser.add_argument('--after', nargs='*', default=[],
+                        help='upstream stages of the same region, date and '
+                        'scene')
+
+    # the command of the stage follows --
+    argv = sys.argv[1:]
+    command = []
+    if '--' in argv:
+        command = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+
+    con = connect(args.db)
+
+    if args.action == 'status':
+        print_status(con, args.region, args.date)
+        sys.exit(0)
+
+    if args.stage is None:
+        print('ERROR: --stage is missing')
+        sys.exit(2)
+
+    key = (args.region or '', args.date or '', args.scene, args.stage)
+
+    if args.action == 'run':
+        sys.exit(run(con, key, args.inputs, args.outputs, args.code,
+                     command, args.after))
+
+    if args.action in ['check', 'start']:
+        fp = fingerprint(con, args.inputs, args.code, command,
+                         upstream(con, key, args.after))
+        if args.action == 'check':
+            # exit code 0 if the stage can be skipped
+            sys.exit(0 if is_done(con, key, fp) else 1)
+        start(con, key, fp)
+
+    elif args.action == 'done':
+        done(con, key, args.outputs)
+
+    elif args.action == 'fail':
+        fail(con, key)
@@ -0,0 +1,499 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+End-to-end processing of a region-day in a single process. Runs the stages
+chained by S3_wrapper.sh and S3_NRT.sh as a graph over in-memory arrays:
+
+    read (S3_reader.py) -> scda (SCDA.py, cloud_mask.py) -> composite
+    (dm_stream.py) -> [slopey (get_ITOAR.py)] -> sice (sice.py) -> write
+
+Each OLCI/SLSTR pair of the day is read and cloud masked independently, in
+a thread pool, at most --threads scenes being read ahead of the compositing.
+The scenes are composited in the daily mosaic held in memory, in acquisition
+order (most usable first with --prescreen). Regions are processed in
+parallel processes. Only the final products are written: the daily mosaic
+(same files as dm.sh) and the SICE outputs (same files as sice.py). The
+scene bands are only written with --debug.
+
+The time spent in each stage is written to {outfolder}/{date}/timings.csv.
+
+INPUTS:
+    date: Date to process (YYYY-MM-DD). [string]
+    inpath: Path to the folder containing the SEN3 products of the date.
+            May contain {region}. [string]
+    outfolder: Path to the mosaic root folder. May contain {region}. [string]
+    --mask: Path to the region mask. May contain {region}. [string]
+    --regions: Regions to process, replacing {region} in the paths. [list]
+    --slopey: Path to the ArcticDEM slope and aspect folder, to run the
+              slope correction. [string]
+    --catalog: Path to the S3_catalog.py database, to pair the scenes from
+               the catalog. [string]
+    --prescreen: Minimum usable fraction of the region, scenes below being
+                 skipped (see S3_prescreen.py). [float]
+    --cog: Write cloud-optimized GeoTIFFs with overviews (see cog.py). [flag]
+    --zones: Label rasters of the zonal statistics, in addition to the region
+             mask (see sice_zonal.py). [strings]
+
+OUTPUTS:
+    {outfolder}/{date}/{band}.tif: daily mosaic (see dm_stream.py). [.tif]
+    {outfolder}/{date}/{variable}.tif: SICE outputs (see sice.py). [.tif]
+    {outfolder}/{date}/timings.csv: time spent in each stage. [.csv]
+    {outfolder}/{date}/prescreen.csv: pre-screening results. [.csv]
+    {outfolder}/{date}/zonal_stats.csv: zonal statistics (see
+                                        sice_zonal.py). [.csv]
+    {outfolder}/{date}/debug/{scene}/{band}.tif: scene bands, with
+                                                 --debug. [.tif]
+
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import islice
+
+import numpy as np
+import rasterio
+
+import cloud_mask
+import get_ITOAR
+import S3_catalog
+import S3_prescreen
+import S3_reader
+import SCDA
+import sice
+import sice_zonal
+from dm_stream import (bands_float32, band_profile, composite, derived_bands,
+                       grid_window, init_state, read_on_grid, region_grid)
+from S3_align import region_mask
+from cog import write_cog
+
+olci_pattern = r'S3._OL_1_EFR____(\d{8}T\d{6})_'
+slstr_pattern = r'S3._SL_1_RBT____(\d{8}T\d{6})_'
+
+
+@contextmanager
+def timed(timings, scene, stage):
+    '''
+    Records the time spent in a stage.
+
+    INPUTS:
+        timings: (scene, stage, seconds) records, appended to. [list]
+        scene: Scene name, empty for the stages of the whole day. [string]
+        stage: Stage name. [string]
+    '''
+
+    start = time.time()
+    yield
+    timings.append((scene, stage, time.time() - start))
+
+
+def pair_scenes(inpath, date, catalog=None):
+    '''
+    Pairs the OLCI and SLSTR products of a date, as S3_proc.sh does: the
+    SLSTR acquisition starts the same minute as the OLCI one, or the minute
+    before or after. With a catalog (S3_catalog.py), the products of inpath
+    are indexed and paired by closest sensing start within the catalog
+    tolerance.
+
+    INPUTS:
+        inpath: Path to the folder containing the SEN3 products. [string]
+        date: Date of the products (YYYY-MM-DD). [string]
+        catalog: Path to the catalog database. [string]
+
+    OUTPUTS:
+        pairs: (scene, olci folder, slstr folder or None) sorted by
+               acquisition time. [list of tuples]
+    '''
+
+    if catalog is not None:
+        con = S3_catalog.connect(catalog)
+        S3_catalog.index(con, S3_catalog.product_folders(inpath))
+        return [(scene, inpath + os.sep + os.path.basename(olci),
+                 inpath + os.sep + os.path.basename(slstr)
+                 if slstr is not None else None)
+                for scene, olci, slstr in S3_catalog.pairs(con, date,
+                                                           within=inpath)]
+
+    products = sorted(os.listdir(inpath))
+    yyyymmdd = date.replace('-', '')
+
+    slstr = {}
+    for product in products:
+        match = re.match(slstr_pattern, product)
+        if match:
+            minute = match.group(1)[:13]
+            slstr.setdefault(minute, inpath + os.sep + product)
+
+    pairs = []
+    for product in products:
+        match = re.match(olci_pattern, product)
+        if not match or not match.group(1).startswith(yyyymmdd):
+            continue
+
+        dts = datetime.strptime(match.group(1)[:13], '%Y%m%dT%H%M')
+        slstr_folder = None
+        for delta in [0, 1, -1]:
+            minute = (dts + timedelta(minutes=delta)).strftime('%Y%m%dT%H%M')
+            if minute in slstr:
+                slstr_folder = slstr[minute]
+                break
+
+        if slstr_folder is None:
+            print('ERROR: No nearby SLSTR scene found for %s' % product)
+
+        pairs.append((match.group(1), inpath + os.sep + product,
+                      slstr_folder))
+
+    return pairs
+
+
+def cloud_detection(scene, res):
+    '''
+    SCDA v2.0 and final cloud mask of a scene, in memory (as SCDA.py).
+
+    INPUTS:
+        scene: Bands of the scene, updated in place with r_TOA_S5_rc, NDSI,
+               SCDA_v20, SCDA_final and SZA_CM. [dict of arrays]
+        res: Pixel size in meters. [float]
+    '''
+
+    scene['r_TOA_S5_rc'] = scene['r_TOA_S5'] * SCDA.S5_factor
+
+    cd, NDSI = SCDA.cloud_detection_v20(R550=scene['r_TOA_S1'],
+                                        R16=scene['r_TOA_S5_rc'],
+                                        BT37=scene['BT_S7'],
+                                        BT11=scene['BT_S8'],
+                                        BT12=scene['BT_S9'])
+
+    mask = scene['mask'].copy()
+    mask[mask == 0] = np.nan
+
+    scene['NDSI'] = NDSI.astype('float32')
+    # cloud=255 is nodata in SCDA_v20.tif
+    scene['SCDA_v20'] = np.where(cd == 1, 1, np.nan).astype('float32')
+    scene['SCDA_final'] = cloud_mask.SCDA_final(cd, mask, res)
+    scene['SZA_CM'] = cloud_mask.SZA_CM(scene['SZA'], scene['SCDA_final'])
+
+
+def process_scene(scene_name, olci_folder, slstr_folder, mask_file, res,
+                  cache_dir=None, debug_folder=None):
+    '''
+    Reads and cloud masks an OLCI/SLSTR pair on the region grid.
+
+    OUTPUTS:
+        scene: Bands of the scene, empty if outside the region.
+               [dict of arrays]
+        grid: Grid of the scene within the region grid. [dict]
+        timings: (scene, stage, seconds) records. [list]
+    '''
+
+    timings = []
+
+    with timed(timings, scene_name, 'read'):
+        scene, grid = S3_reader.read_scene(olci_folder, slstr_folder,
+                                           mask_file, res, cache_dir)
+
+    if grid is None:
+        return {}, None, timings
+
+    if all(b in scene for b in ['r_TOA_S1', 'r_TOA_S5', 'BT_S7', 'BT_S8',
+                                'BT_S9']):
+        with timed(timings, scene_name, 'scda'):
+            cloud_detection(scene, res)
+
+    if debug_folder is not None:
+        with timed(timings, scene_name, 'debug'):
+            S3_reader.write_scene(scene, grid,
+                                  debug_folder + os.sep + scene_name)
+
+    return scene, grid, timings
+
+
+def slope_correction(state, grid, inpath_adem):
+    '''
+    Slope correction of the mosaic, in memory (as get_ITOAR.py): r_TOA_17
+    and r_TOA_21 are replaced by the intrinsic TOA reflectances, SZA and
+    OZA by the effective angles.
+
+    INPUTS:
+        state: Mosaic bands, modified in place. [dict of arrays]
+        grid: Region grid. [dict]
+        inpath_adem: Path to the ArcticDEM slope and aspect folder. [string]
+    '''
+
+    slope = read_on_grid(inpath_adem + os.sep + 'Greenland_S.tif', grid)
+    aspect = read_on_grid(inpath_adem + os.sep + 'Greenland_A.tif', grid)
+
+    for band in ['r_TOA_17', 'r_TOA_21']:
+        state[band] = get_ITOAR.compute_ITOAR(state[band], state['SZA'],
+                                              state['SAA'], slope, aspect)
+
+    for band in ['SZA', 'OZA']:
+        state[band] = get_ITOAR.effective_angle(state[band], state['SAA'],
+                                                slope, aspect)
+
+    state['slope_flag_' + str(get_ITOAR.slope_thres) + '_degrees'] = \
+        np.where(slope <= get_ITOAR.slope_thres, 1, np.nan)
+
+
+def sice_inputs(state):
+    '''
+    Inputs of the retrieval (see sice.read_inputs) from the mosaic bands.
+    '''
+
+    toa = np.stack([state.get('r_TOA_' + str(i + 1).zfill(2),
+                              np.full_like(state['SZA'], np.nan))
+                    for i in range(21)]).astype('float32')
+
+    # the retrieval modifies its inputs
+    return dict(toa=toa,
+                ozone=state['O3'].copy(), water=state['WV'].copy(),
+                sza=state['SZA'].copy(), saa=state['SAA'].copy(),
+                vza=state['OZA'].copy(), vaa=state['OAA'].copy(),
+                height=state['height'].copy())
+
+
+def write_products(products, grid, folder, n_threads=4, cog=False):
+    '''
+    Writes products on the region grid, one GeoTIFF per band, or one
+    cloud-optimized GeoTIFF if cog is True.
+    '''
+
+    def write(band):
+        profile = band_profile(grid, band)
+        if cog:
+            write_cog(folder + os.sep + band + '.tif', products[band], profile)
+            return
+        with rasterio.open(folder + os.sep + band + '.tif', 'w',
+                           **profile) as dst:
+            dst.write(products[band].astype(profile['dtype']), 1)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(write, products))
+
+
+def write_timings(timings, filename):
+
+    with open(filename, 'w') as f:
+        f.write('scene,stage,seconds\n')
+        for scene, stage, seconds in timings:
+            f.write('%s,%s,%.3f\n' % (scene, stage, seconds))
+
+
+def process_region(date, inpath, outfolder, mask_file, res=1000,
+                   inpath_adem=None, n_threads=4, cache_dir=None,
+                   debug=False, overwrite=False, catalog=None,
+                   prescreen=None, cog=False, zones=()):
+    '''
+    Processes a region-day, from the SEN3 products to the SICE outputs.
+
+    INPUTS:
+        date: Date to process (YYYY-MM-DD). [string]
+        inpath: Path to the folder containing the SEN3 products. [string]
+        outfolder: Path to the mosaic root folder. [string]
+        mask_file: Path to the region mask. [string]
+        res: Mosaic resolution in meters. [float]
+        inpath_adem: ArcticDEM folder, None for no slope correction. [string]
+        n_threads: Number of scenes processed in parallel. [int]
+        cache_dir: Folder of the S3_reader.py index cache. [string]
+        debug: If True, the scene bands are written. [boolean]
+        overwrite: If True, an existing mosaic is processed again. [boolean]
+        catalog: Path to the S3_catalog.py database used for pairing. [string]
+        prescreen: Minimum usable fraction of the region of a scene (see
+                   S3_prescreen.py), None for no pre-screening. [float]
+        cog: If True, the products are written as cloud-optimized
+             GeoTIFFs. [boolean]
+        zones: Label rasters of the zonal statistics (see sice_zonal.py), in
+               addition to the region mask. [list]
+
+    OUTPUTS:
+        ok: False if the products or the region mask are missing. [boolean]
+        timings: (scene, stage, seconds) records. [list]
+    '''
+
+    mosaic_folder = outfolder + os.sep + date
+    timings = []
+
+    if not overwrite and os.path.isfile(mosaic_folder + os.sep + 'conc.tif'):
+        print('%s already exists, date skipped' % mosaic_folder)
+        return True, timings
+
+    if not os.path.isdir(inpath):
+        print('ERROR: %s is missing' % inpath)
+        return False, timings
+
+    if not os.path.isfile(mask_file):
+        print('ERROR: region mask %s not found' % mask_file)
+        return False, timings
+
+    os.makedirs(mosaic_folder, exist_ok=True)
+    debug_folder = mosaic_folder + os.sep + 'debug' if debug else None
+
+    grid = region_grid(mask_file, res)
+    mask = region_mask(mask_file, res)
+    state = init_state((grid['height'], grid['width']), bands_float32)
+    lut = []
+
+    pairs = pair_scenes(inpath, date, catalog)
+
+    # scenes with the most usable pixels are processed first
+    usable = {}
+    if prescreen is not None:
+        kept = []
+        for scene_name, olci, slstr in pairs:
+            with timed(timings, scene_name, 'prescreen'):
+                result = S3_prescreen.prescreen(olci, slstr, mask_file,
+                                                prescreen)
+            S3_prescreen.log_result(mosaic_folder + os.sep + 'prescreen.csv',
+                                    olci, slstr, mask_file, result)
+            if result['keep']:
+                kept.append((scene_name, olci, slstr))
+                usable[scene_name] = result['usable']
+            else:
+                print('%s: %s, scene skipped' % (scene_name,
+                                                 result['reason']))
+        pairs = kept
+
+    pairs = sorted(pairs, key=lambda p: -usable.get(p[0], 0))
+    queue = iter(pairs)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        futures = {}
+
+        def submit(n):
+            for scene_name, olci, slstr in islice(queue, n):
+                futures[scene_name] = executor.submit(
+                    process_scene, scene_name, olci, slstr, mask_file, res,
+                    cache_dir, debug_folder)
+
+        # scenes are composited in the order of submission, at most
+        # n_threads scenes being read ahead, so that the memory holds about
+        # n_threads scenes and not the whole day
+        submit(n_threads)
+        for scene_name, _, _ in pairs:
+            scene, scene_grid, scene_timings = futures.pop(scene_name).result()
+            submit(1)
+            timings += scene_timings
+            if scene_grid is None:
+                continue
+
+            with timed(timings, scene_name, 'composite'):
+                slices = grid_window(grid, scene_grid).toslices()
+                window_state = {b: v[slices] for b, v in state.items()}
+                composite(window_state, scene, len(lut), mask[slices])
+                lut.append(scene_name)
+            del scene, window_state
+
+    if not lut:
+        print('%s: no scene within region' % date)
+        return True, timings
+
+    with timed(timings, '', 'composite'):
+        state.update(derived_bands(state))
+
+    if inpath_adem is not None:
+        with timed(timings, '', 'slopey'):
+            slope_correction(state, grid, inpath_adem)
+
+    with timed(timings, '', 'sice'):
+        outputs = sice.retrieval(**sice_inputs(state))
+
+    with timed(timings, '', 'write'):
+        with open(mosaic_folder + os.sep + 'scenes_lut.csv', 'w') as f:
+            f.write('lut_index,scene\n')
+            for index, scene_name in enumerate(lut):
+                f.write('%d,%s\n' % (index, scene_name))
+
+        write_products(state, grid, mosaic_folder, n_threads, cog)
+        write_products(outputs, grid, mosaic_folder, n_threads, cog)
+
+    with timed(timings, '', 'zonal'):
+        sice_zonal.folder_stats(outputs, grid, [mask_file] + list(zones),
+                                mosaic_folder)
+
+    write_timings(timings, mosaic_folder + os.sep + 'timings.csv')
+
+    return True, timings
+
+
+def print_timings(region, timings):
+
+    stages = {}
+    for _, stage, seconds in timings:
+        stages[stage] = stages.get(stage, 0) + seconds
+
+    print('%s: %s' % (region, ', '.join('%s %.1f s' % (stage, seconds)
+                                        for stage, seconds in stages.items())))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('date')
+    parser.add_argument('inpath')
+    parser.add_argument('outfolder')
+    parser.add_argument('--mask', default='mask.tif')
+    parser.add_argument('--regions', nargs='+', default=[''],
+                        help='regions replacing {region} in the paths')
+    parser.add_argument('--res', type=float, default=1000)
+    parser.add_argument('--slopey', default=None,
+                        help='ArcticDEM folder, to run the slope correction')
+    parser.add_argument('--cache', default=None,
+                        help='folder where reprojection indices are cached, '
+                        'for scenes read again (not pruned)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of regions processed in parallel')
+    parser.add_argument('-t', '--threads', type=int, default=4,
+                        help='number of scenes processed in parallel')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='process the dates already in the mosaic')
+    parser.add_argument('--catalog', default=None,
+                        help='S3_catalog.py database, to pair the scenes')
+    parser.add_argument('--prescreen', type=float, nargs='?', default=None,
+                        const=S3_prescreen.min_usable,
+                        help='minimum usable fraction of the region of a '
+                        'scene (S3_prescreen.py)')
+    parser.add_argument('--cog', action='store_true',
+                        help='write cloud-optimized GeoTIFFs (see cog.py)')
+    parser.add_argument('--zones', nargs='*', default=[],
+                        help='label rasters of the zonal statistics, in '
+                        'addition to the region mask')
+    parser.add_argument('--debug', action='store_true',
+                        help='write the scene bands')
+    args = parser.parse_args()
+
+    start_time = time.time()
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {region: executor.submit(
+            process_region, args.date,
+            args.inpath.format(region=region),
+            args.outfolder.format(region=region),
+            args.mask.format(region=region), res=args.res,
+            inpath_adem=args.slopey, n_threads=args.threads,
+            cache_dir=args.cache, debug=args.debug,
+            overwrite=args.overwrite, catalog=args.catalog,
+            prescreen=args.prescreen, cog=args.cog,
+            zones=[zone.format(region=region) for zone in args.zones])
+            for region in args.regions}
+
+        failed = []
+        for region, future in futures.items():
+            ok, timings = future.result()
+            print_timings(region or args.date, timings)
+            if not ok:
+                failed.append(region or args.date)
+
+    print('End S3_pipeline.py %s --- %s seconds ---'
+          % (args.date, time.time() - start_time))
+
+    if failed:
+        print('ERROR: %s failed' % ', '.join(failed))
+        sys.exit(1)
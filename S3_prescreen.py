@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Pre-screening of the OLCI/SLSTR pairs, before the full processing (gpt or
+S3_reader.py, SCDA, mosaic).
+
+The usable area of a scene within the region is estimated on a coarse grid
+(10 km) from:
+    - the OLCI tie-point geolocation and SZA, interpolated every 5 km or
+      so: region pixels covered by the scene, and among them the pixels
+      with SZA < 75 (sice.py discards the others),
+    - a decimated read of the SLSTR S1, S5 and S7-S9 bands (5 km sampling)
+      and the SCDA v2.0 tests on the coarse grid: clear pixels.
+Scenes whose usable (covered, sunlit and clear) fraction of the region is
+below a threshold are dropped, with the reason: "outside" (the scene barely
+touches the region), "sza" (SZA > 75 on the covered part) or "cloud".
+Late-season scenes and the polar night edges of the record are therefore
+skipped in a few seconds instead of being fully processed.
+
+INPUTS:
+    olci: Path to the S3?_OL_1_EFR_*.SEN3 folder. [string]
+    slstr: Path to the S3?_SL_1_RBT_*.SEN3 folder. [string]
+    mask: Path to the region mask. [string]
+    --min-usable: Minimum usable fraction of the region. [float]
+    --max-sza: Maximum SZA in degrees. [float]
+    --log: CSV file where the result is appended. [string]
+
+OUTPUTS:
+    exit code 0 if the scene is kept, 10 if it is dropped.
+    {log}: scene, fractions of the region covered, sunlit and usable,
+           decision and reason. [.csv]
+
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import rasterio
+
+import SCDA
+from dm_stream import region_grid
+from S3_align import region_mask
+from S3_reader import (read_nc, tie_point_factors, interpolate_tie_points,
+                       project)
+
+# coarse grid resolution in meters
+prescreen_res = 10000
+
+# decimation of the SLSTR an (500 m) and in (1 km) grids, the OLCI one
+# being derived from the tie-point spacing: half a coarse cell
+slstr_steps = {'an': 10, 'in': 5}
+
+max_sza = 75
+min_usable = 0.005
+
+skip_exit_code = 10
+
+
+def grid_cells(x, y, grid):
+    '''
+    Rows and columns of the grid cells of projected coordinates.
+
+    OUTPUTS:
+        rows, cols: Cell indices of the coordinates inside the grid. [arrays]
+        inside: True for the coordinates inside the grid. [boolean array]
+    '''
+
+    t = grid['transform']
+    cols = np.floor((x - t.c) / t.a)
+    rows = np.floor((y - t.f) / t.e)
+    inside = (cols >= 0) & (cols < grid['width']) & (rows >= 0) \
+        & (rows < grid['height'])
+
+    return rows[inside].astype('int64'), cols[inside].astype('int64'), inside
+
+
+def cell_mean(values, rows, cols, shape):
+    '''
+    Mean of the values falling in each grid cell, NaN without value.
+    '''
+
+    valid = ~np.isnan(values)
+    index = rows[valid] * shape[1] + cols[valid]
+    total = np.bincount(index, values[valid], minlength=shape[0] * shape[1])
+    count = np.bincount(index, minlength=shape[0] * shape[1])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (total / count).reshape(shape).astype('float32')
+
+
+def olci_sza(folder, grid):
+    '''
+    SZA of an OLCI product on the coarse grid, from the tie-points.
+    '''
+
+    tie_lat, tags = read_nc(folder, 'tie_geo_coordinates.nc', 'latitude')
+    tie_lon, _ = read_nc(folder, 'tie_geo_coordinates.nc', 'longitude')
+    tie_sza, _ = read_nc(folder, 'tie_geometries.nc', 'SZA')
+    ac, al = tie_point_factors(tags)
+
+    # full resolution shape, without reading the variable
+    with rasterio.open('netcdf:' + folder + os.sep
+                       + 'instrument_data.nc:detector_index') as src:
+        shape = src.shape
+
+    tie_x, tie_y = project(tie_lon, tie_lat, grid['crs'])
+    pixel_size = np.nanmedian(np.hypot(np.diff(tie_x, axis=1),
+                                       np.diff(tie_y, axis=1))) / ac
+    step = max(1, int(prescreen_res / 2 / pixel_size))
+
+    rows, cols = np.mgrid[0:shape[0]:step, 0:shape[1]:step]
+    x = interpolate_tie_points(tie_x, ac, al, rows, cols).ravel()
+    y = interpolate_tie_points(tie_y, ac, al, rows, cols).ravel()
+    sza = interpolate_tie_points(tie_sza, ac, al, rows, cols).ravel()
+
+    cell_rows, cell_cols, inside = grid_cells(x, y, grid)
+
+    return cell_mean(sza[inside], cell_rows, cell_cols,
+                     (grid['height'], grid['width']))
+
+
+def slstr_bands(folder, grid, sza):
+    '''
+    Decimated SLSTR reflectances (S1, S5) and brightness temperatures
+    (S7-S9) on the coarse grid.
+    '''
+
+    shape = (grid['height'], grid['width'])
+    mu0 = np.cos(np.deg2rad(sza))
+    bands = {}
+
+    for view, names in [('an', ['S1', 'S5']), ('in', ['S7', 'S8', 'S9'])]:
+        step = slstr_steps[view]
+        lat, _ = read_nc(folder, 'geodetic_' + view + '.nc', 'latitude_' + view,
+                         step)
+        lon, _ = read_nc(folder, 'geodetic_' + view + '.nc',
+                         'longitude_' + view, step)
+        x, y = project(lon, lat, grid['crs'])
+        rows, cols, inside = grid_cells(x.ravel(), y.ravel(), grid)
+
+        for band in names:
+            if view == 'an':
+                radiance, _ = read_nc(folder, band + '_radiance_an.nc',
+                                      band + '_radiance_an', step)
+                irradiance, _ = read_nc(folder, band + '_quality_an.nc',
+                                        band + '_solar_irradiance_an')
+                bands[band] = np.pi * cell_mean(
+                    radiance.ravel()[inside], rows, cols, shape) \
+                    / (np.nanmean(irradiance) * mu0)
+            else:
+                bt, _ = read_nc(folder, band + '_BT_in.nc', band + '_BT_in',
+                                step)
+                bands[band] = cell_mean(bt.ravel()[inside], rows, cols, shape)
+
+    return bands
+
+
+def prescreen(olci_folder, slstr_folder, mask_file, min_usable=min_usable,
+              max_sza=max_sza):
+    '''
+    Estimates the usable fraction of the region in an OLCI/SLSTR pair.
+
+    INPUTS:
+        olci_folder, slstr_folder: Paths to the SEN3 folders, slstr_folder
+                                   may be None (no cloud test). [strings]
+        mask_file: Path to the region mask. [string]
+        min_usable: Minimum usable fraction of the region. [float]
+        max_sza: Maximum SZA in degrees. [float]
+
+    OUTPUTS:
+        result: fractions of the region covered, sunlit and usable, keep
+                (True if usable >= min_usable) and reason. [dict]
+    '''
+
+    grid = region_grid(mask_file, prescreen_res)
+    mask = region_mask(mask_file, prescreen_res)
+    n_mask = max(mask.sum(), 1)
+
+    sza = olci_sza(olci_folder, grid)
+    covered = mask & ~np.isnan(sza)
+    with np.errstate(invalid='ignore'):
+        sunlit = covered & (sza < max_sza)
+
+    usable = sunlit
+    if slstr_folder is not None and sunlit.any():
+        bands = slstr_bands(slstr_folder, grid, sza)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cd, _ = SCDA.cloud_detection_v20(
+                R550=bands['S1'], R16=bands['S5'] * SCDA.S5_factor,
+                BT37=bands['S7'], BT11=bands['S8'], BT12=bands['S9'])
+        usable = sunlit & (cd == 1)
+
+    result = dict(covered=covered.sum() / n_mask, sunlit=sunlit.sum() / n_mask,
+                  usable=usable.sum() / n_mask)
+
+    if result['covered'] < min_usable:
+        reason = 'outside'
+    elif result['sunlit'] < min_usable:
+        reason = 'sza'
+    elif result['usable'] < min_usable:
+        reason = 'cloud'
+    else:
+        reason = 'ok'
+
+    result.update(keep=reason == 'ok', reason=reason)
+
+    return result
+
+
+def log_result(log_file, olci_folder, slstr_folder, mask_file, result):
+
+    new_file = not os.path.isfile(log_file)
+    with open(log_file, 'a') as f:
+        if new_file:
+            f.write('time,olci,slstr,mask,covered,sunlit,usable,keep,'
+                    'reason\n')
+        f.write('%s,%s,%s,%s,%.4f,%.4f,%.4f,%s,%s\n' % (
+            time.strftime('%Y-%m-%dT%H:%M:%S'),
+            os.path.basename(olci_folder),
+            os.path.basename(slstr_folder or ''), mask_file,
+            result['covered'], result['sunlit'], result['usable'],
+            result['keep'], result['reason']))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('olci')
+    parser.add_argument('slstr')
+    parser.add_argument('mask')
+    parser.add_argument('--min-usable', type=float, default=min_usable,
+                        help='minimum usable fraction of the region')
+    parser.add_argument('--max-sza', type=float, default=max_sza)
+    parser.add_argument('--log', default=None,
+                        help='CSV file where the result is appended')
+    args = parser.parse_args()
+
+    start_time = time.time()
+
+    result = prescreen(args.olci, args.slstr, args.mask, args.min_usable,
+                       args.max_sza)
+    if args.log is not None:
+        log_result(args.log, args.olci, args.slstr, args.mask, result)
+
+    print('End S3_prescreen.py %s: %s (usable %.1f%%) --- %s seconds ---'
+          % (os.path.basename(args.olci), result['reason'],
+             100 * result['usable'], time.time() - start_time))
+
+    sys.exit(0 if result['keep'] else skip_exit_code)
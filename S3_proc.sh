@@ -7,12 +7,15 @@ set -x
 
 function print_usage() {
 	echo ""
-	echo "./S3_proc.sh -i inpath -o outpath -X file.xml [-h -v -t]"
+	echo "./S3_proc.sh -i inpath -o outpath -X file.xml [-h -v -t -G -P -S]"
 	echo "  -i: Path to folder containing S3?_*_EFR_*_002.SEN3 (unzipped S3 EFR) files"
 	echo "  -o: Path where to store ouput"
 	echo "  -X: Specify XML file"
 	echo "  -v: Print verbose messages during processing"
 	echo "  -t: Print timing messages during processing"
+	echo "  -G: Align bands with GRASS (G_align.sh) instead of S3_align.py"
+	echo "  -P: Read and resample products with S3_reader.py instead of gpt (-X ignored)"
+	echo "  -S: Pre-screen scenes (S3_prescreen.py), skipping those with too few usable pixels"
 	echo "  -h: print this help"
 	echo ""
 }
@@ -83,6 +86,18 @@ while [[ $# -gt 0 ]]; do
 		timing=1
 		shift
 		;;
+	-G)
+		grass_align=1
+		shift
+		;;
+	-P)
+		python_reader=1
+		shift
+		;;
+	-S)
+		prescreen=1
+		shift
+		;;
 	*)                  # unknown option
 		positional+=("$1") # save it in an array for later. Pass on to dsget.sh
 		shift
@@ -100,19 +115,25 @@ if [[ -z ${outpath:-} ]]; then
 	print_usage
 	exit 1
 fi
-if [[ -z ${xml:-} ]]; then
+if [[ -z ${xml:-} ]] && [[ -z ${python_reader:-} ]]; then
 	log_err "-X not set"
 	print_usage
 	exit 1
 fi
 
+# catalog of the products (S3_catalog.py): indexed pairing, tolerating
+# offsets of more than one minute
+if [[ ${SICE_CATALOG:-} ]]; then
+	python ./S3_catalog.py index "${inpath}" --db "${SICE_CATALOG}"
+fi
+
 for folder in $(ls ${inpath} | grep S3._OL_1_EFR); do
 	olci_folder=$(basename "${folder}")
 	olci_dts=$(echo "${olci_folder}" | rev | cut -d_ -f11 | rev)
 	dest=${outpath}/${olci_dts}
 
-	# skipping if scene already processed
-	if [[ -d "${dest}" ]]; then
+	# skipping if scene already processed (see below with a manifest)
+	if [[ -z ${SICE_MANIFEST:-} ]] && [[ -d "${dest}" ]]; then
 		if [[ -f "${dest}/r_TOA_01.tif" ]]; then
 			log_warn "${dest} already exists, scene skipped"
 			continue
@@ -125,8 +146,14 @@ for folder in $(ls ${inpath} | grep S3._OL_1_EFR); do
 	olci_time1=$(date -d "${olci_date} ${olci_time} + 1 minute" "+%H%M")
 	olci_time2=$(date -d "${olci_date} ${olci_time} - 1 minute" "+%H%M")
 	fileroot="S3._SL_1_RBT____........T" # grep for acquisition not ingest time
-	# pick first nearby slstr
-	slstr_folder=$(ls ${inpath} | grep -E "${fileroot}${olci_time}|${fileroot}${olci_time1}|${fileroot}${olci_time2}" | head -n1 || true)
+	if [[ ${SICE_CATALOG:-} ]]; then
+		# closest SLSTR scene of the same platform
+		slstr_folder=$(python ./S3_catalog.py pair --db "${SICE_CATALOG}" \
+			--olci "${olci_folder}" --within "${inpath}" --names || true)
+	else
+		# pick first nearby slstr
+		slstr_folder=$(ls ${inpath} | grep -E "${fileroot}${olci_time}|${fileroot}${olci_time1}|${fileroot}${olci_time2}" | head -n1 || true)
+	fi
 	if [[ -z ${slstr_folder} ]]; then
 		log_err "No nearby SLSTR scene found"
 		continue
@@ -134,9 +161,54 @@ for folder in $(ls ${inpath} | grep S3._OL_1_EFR); do
 	log_info "${olci_folder}"
 	log_info "${slstr_folder}"
 
+	# cheap estimate of the usable pixels: scenes outside the region, with
+	# SZA > 75 or fully clouded are skipped (reason in prescreen.csv)
+	if [[ ${prescreen:-} ]]; then
+		mkdir -p "${outpath}"
+		prescreen_status=0
+		python ./S3_prescreen.py "${inpath}/${olci_folder}" "${inpath}/${slstr_folder}" \
+			./mask.tif --log "${outpath}/prescreen.csv" || prescreen_status=$?
+		if [[ ${prescreen_status} == 10 ]]; then
+			log_warn "${olci_folder}: too few usable pixels, scene skipped"
+			continue
+		fi
+	fi
+
+	# job-state manifest (S3_manifest.py): skipping if the scene was processed
+	# from the same products with the same code, and its outputs are intact
+	if [[ ${SICE_MANIFEST:-} ]]; then
+		manifest_args=(--db "${SICE_MANIFEST}" --region "${SICE_REGION:-}"
+			--date "${olci_date}" --scene "${olci_dts}" --stage proc_scene
+			--inputs "${inpath}/${olci_folder}" "${inpath}/${slstr_folder}"
+			--code ./S3_proc.sh "${xml:-}" ./S3_align.py ./S3_reader.py
+			-- "python_reader=${python_reader:-0}" "grass_align=${grass_align:-0}")
+		if python ./S3_manifest.py check "${manifest_args[@]}"; then
+			log_warn "${dest} already processed, scene skipped"
+			continue
+		fi
+		python ./S3_manifest.py start "${manifest_args[@]}"
+	fi
+
 	log_info "Generating ${dest}"
 	mkdir -p "${dest}"
 
+	resize=1000
+
+	if [[ ${python_reader:-} ]]; then
+		log_info "S3_reader: Start"
+		timing
+		python ./S3_reader.py "${inpath}/${olci_folder}" "${inpath}/${slstr_folder}" \
+			"${dest}" ./mask.tif ${resize} || (
+			log_err "S3_reader error"
+			exit 1
+		)
+		log_info "S3_reader: Finished"
+		if [[ ${SICE_MANIFEST:-} ]]; then
+			python ./S3_manifest.py done --outputs "${dest}" "${manifest_args[@]}"
+		fi
+		continue
+	fi
+
 	log_info "gpt: Start"
 	timing
 	[[ $(which gpt) ]] || (
@@ -161,13 +233,33 @@ for folder in $(ls ${inpath} | grep S3._OL_1_EFR); do
 	# (cd ${dest}/../; du -sm * | awk '$1 > 10000 {print $2}' | xargs rm -fr)
 	if [[ ! -d "${dest}" ]]; then continue; fi # if we removed the directory, break out of the loop
 
-	resize=1000
 	log_info "Resampling to ${resize} m resolution..."
 	log_info "Aligning SLSTR to OLCI..."
-	grass -c ./mask.tif ${dest}/G_align --exec ./G_align.sh ${dest} ./mask.tif ${resize}
+	align_status=0
+	if [[ ${grass_align:-} ]]; then
+		grass -c ./mask.tif ${dest}/G_align --exec ./G_align.sh ${dest} ./mask.tif ${resize}
+		(cd ${dest} && rm -fR G_align)
+	else
+		python ./S3_align.py ${dest} ./mask.tif ${resize} || align_status=$?
+	fi
+	if [[ ${align_status} != 0 ]]; then
+		# inputs kept, the scene is processed again at the next run
+		log_err "S3_align error: ${dest}"
+		if [[ ${SICE_MANIFEST:-} ]]; then
+			python ./S3_manifest.py fail "${manifest_args[@]}"
+		fi
+		align_failed=true
+		continue
+	fi
 	(cd ${dest} && rm *_x.tif)
-	(cd ${dest} && rm -fR G_align)
+	if [[ ${SICE_MANIFEST:-} ]]; then
+		python ./S3_manifest.py done --outputs "${dest}" "${manifest_args[@]}"
+	fi
 done
 
 log_info "Finished: ${outpath}"
 timing
+
+if [[ ${align_failed:-} ]]; then
+	exit 1
+fi
@@ -0,0 +1,655 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Python reader of Sentinel-3 OLCI EFR and SLSTR RBT L1 products (SEN3
+folders), replacing SNAP gpt (S3_fast.xml) and the alignment step.
+
+The netCDF files of the products are read through GDAL. Radiances are
+converted to reflectances with vectorized NumPy, r = pi * L / (F0 * cos(SZA)),
+and mapped on the region grid with nearest neighbour indices:
+    - OLCI pixel coordinates are interpolated from the tie-point
+      geolocation projected on the region grid,
+    - each destination pixel takes the closest source pixel falling in it,
+      and pixels left empty are filled from their nearest neighbour
+      within one pixel.
+The indices depend only on the geolocation (footprint) and the region grid.
+They are cached in memory and reused for all bands of a scene, so that the
+21 OLCI bands, the geometry, the meteo and the SLSTR S1, S5, S7-S9 bands are
+produced in one pass, without intermediate *_x.tif files. The footprint of
+each acquisition being different, the optional disk cache (--cache, tens of
+MB per scene and grid, never pruned) only serves when the same scene is
+read again on the same grid, e.g. when a day is reprocessed.
+
+INPUTS:
+    olci: Path to the S3?_OL_1_EFR_*.SEN3 folder. [string]
+    slstr: Path to the S3?_SL_1_RBT_*.SEN3 folder. [string]
+    dest: Path to the output scene folder. [string]
+    mask: Path to the region mask. [string]
+    resize: Output resolution in meters. [float]
+
+OUTPUTS:
+    {dest}/{band}.tif: same files as S3_proc.sh (r_TOA_01..21, SZA, OZA,
+                       SAA, OAA, O3, WV, height, r_TOA_S1, r_TOA_S5,
+                       BT_S7..9, mask). [.tif]
+
+"""
+
+import argparse
+import hashlib
+import os
+import threading
+import time
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.warp import transform as transform_coords
+from rasterio.windows import Window
+from scipy import ndimage
+
+from dm_stream import region_grid, window_grid, read_on_grid
+from S3_align import region_mask, write_band
+
+olci_bands = ['Oa' + str(i + 1).zfill(2) for i in range(21)]
+
+# SLSTR bands: reflectances on the 500 m (an) grid, brightness temperatures
+# on the 1 km (in) grid
+slstr_reflectance = ['S1', 'S5']
+slstr_bt = ['S7', 'S8', 'S9']
+
+# OLCI quality_flags bit for invalid pixels
+olci_invalid_flag = 1 << 25
+
+# SEN3 netCDF files carry no geotransform
+warnings.simplefilter('ignore', NotGeoreferencedWarning)
+
+# maximum number of indices kept in memory
+cache_size = 8
+_index_cache = OrderedDict()
+_index_lock = threading.Lock()
+
+
+def read_nc(folder, filename, variable, decimation=1):
+    '''
+    Reads a variable of a SEN3 netCDF file, scaled and with fill values
+    set to NaN.
+
+    INPUTS:
+        folder: Path to the SEN3 folder. [string]
+        filename: netCDF file name. [string]
+        variable: Variable name. [string]
+        decimation: Only one pixel out of decimation is read in each
+                    direction. [int]
+
+    OUTPUTS:
+        data: variable values. [array]
+        tags: global and variable attributes. [dict]
+    '''
+
+    path = 'netcdf:' + folder + os.sep + filename + ':' + variable
+
+    with rasterio.open(path) as src:
+        out_shape = None
+        if decimation > 1:
+            out_shape = (-(-src.height // decimation),
+                         -(-src.width // decimation))
+        data = src.read(1, masked=True, out_shape=out_shape)
+        scale, offset = src.scales[0], src.offsets[0]
+        tags = src.tags()
+
+    data = data.astype('float32').filled(np.nan)
+    if scale != 1 or offset != 0:
+        data = data * np.float32(scale) + np.float32(offset)
+
+    return data, tags
+
+
+def read_flags(folder, filename, variable):
+    '''
+    Reads an integer flag variable without scaling.
+    '''
+
+    path = 'netcdf:' + folder + os.sep + filename + ':' + variable
+
+    with rasterio.open(path) as src:
+        return src.read(1)
+
+
+def tie_point_factors(tags):
+    '''
+    Across-track and along-track subsampling factors of OLCI tie-points.
+    '''
+
+    ac = int(tags.get('NC_GLOBAL#ac_subsampling_factor', 64))
+    al = int(tags.get('NC_GLOBAL#al_subsampling_factor', 1))
+
+    return ac, al
+
+
+def interpolate_tie_points(tie, ac, al, rows, cols):
+    '''
+    Bilinear interpolation of a tie-point grid at full resolution pixels.
+
+    INPUTS:
+        tie: Tie-point values. [2D array]
+        ac, al: Across-track and along-track subsampling factors. [int]
+        rows, cols: Full resolution pixel coordinates. [arrays]
+
+    OUTPUTS:
+        values at (rows, cols). [array]
+    '''
+
+    r = rows / al
+    c = cols / ac
+    r0 = np.clip(np.floor(r).astype('int32'), 0, max(tie.shape[0] - 2, 0))
+    c0 = np.clip(np.floor(c).astype('int32'), 0, max(tie.shape[1] - 2, 0))
+    r1 = np.minimum(r0 + 1, tie.shape[0] - 1)
+    c1 = np.minimum(c0 + 1, tie.shape[1] - 1)
+    fr = (r - r0).astype('float32')
+    fc = (c - c0).astype('float32')
+
+    return (tie[r0, c0] * (1 - fr) * (1 - fc) + tie[r0, c1] * (1 - fr) * fc
+            + tie[r1, c0] * fr * (1 - fc) + tie[r1, c1] * fr * fc)
+
+
+def interpolate_angle(tie, ac, al, rows, cols):
+    '''
+    Bilinear interpolation of azimuth angles (degrees) through their sine
+    and cosine, to avoid the 0/360 discontinuity.
+    '''
+
+    rad = np.deg2rad(tie)
+    s = interpolate_tie_points(np.sin(rad), ac, al, rows, cols)
+    c = interpolate_tie_points(np.cos(rad), ac, al, rows, cols)
+
+    return np.rad2deg(np.arctan2(s, c)).astype('float32')
+
+
+def footprint_key(lat, lon, grid):
+    '''
+    Hash of a geolocation and a region grid, used as cache key.
+    '''
+
+    sha = hashlib.sha1()
+    sha.update(np.ascontiguousarray(lat, dtype='float32').tobytes())
+    sha.update(np.ascontiguousarray(lon, dtype='float32').tobytes())
+    sha.update(repr((tuple(grid['transform']), grid['width'],
+                     grid['height'], str(grid['crs']))).encode())
+
+    return sha.hexdigest()
+
+
+def build_index(x, y, grid, fill_distance=1.5):
+    '''
+    Nearest neighbour index from source pixels with projected coordinates
+    (x, y) to the region grid.
+
+    INPUTS:
+        x, y: Projected coordinates of the source pixels. [2D arrays]
+        grid: Region grid (see dm_stream.region_grid). [dict]
+        fill_distance: Maximum distance in destination pixels to fill empty
+                       pixels from their neighbours. [float]
+
+    OUTPUTS:
+        index: window of the region grid, destination rows/cols and
+               flat source index. [dict]
+    '''
+
+    tr = grid['transform']
+    col = (x.ravel() - tr.c) / tr.a
+    row = (y.ravel() - tr.f) / tr.e
+    valid = np.isfinite(col) & np.isfinite(row) \
+        & (col >= 0) & (col < grid['width']) \
+        & (row >= 0) & (row < grid['height'])
+
+    src = np.where(valid)[0]
+    if src.size == 0:
+        return None
+    col, row = col[valid], row[valid]
+    dcol, drow = np.floor(col).astype('int64'), np.floor(row).astype('int64')
+
+    # squared distance to the destination pixel centre
+    dist = (col - dcol - 0.5) ** 2 + (row - drow - 0.5) ** 2
+
+    # window covering the source pixels
+    col_off, row_off = dcol.min(), drow.min()
+    width = int(dcol.max() - col_off + 1)
+    height = int(drow.max() - row_off + 1)
+    dest = (drow - row_off) * width + (dcol - col_off)
+
+    # closest source pixel for each destination pixel
+    order = np.lexsort((dist, dest))
+    dest, first = np.unique(dest[order], return_index=True)
+    src = src[order][first]
+
+    lut = np.full(height * width, -1, dtype='int64')
+    lut[dest] = src
+    lut = lut.reshape(height, width)
+
+    # empty destination pixels within the swath (destination finer than
+    # source, or gaps between scan lines)
+    empty = lut < 0
+    if empty.any() and fill_distance > 0:
+        distance, (ri, ci) = ndimage.distance_transform_edt(
+            empty, return_indices=True)
+        fill = empty & (distance <= fill_distance)
+        lut[fill] = lut[ri[fill], ci[fill]]
+
+    rows, cols = np.where(lut >= 0)
+
+    return dict(window=Window(int(col_off), int(row_off), width, height),
+                rows=rows.astype('int32'), cols=cols.astype('int32'),
+                src=lut[rows, cols])
+
+
+def get_index(lat, lon, grid, coords, cache_dir=None):
+    '''
+    Cached nearest neighbour index of a footprint on a region grid.
+
+    INPUTS:
+        lat, lon: Geolocation used as cache key. [arrays]
+        grid: Region grid. [dict]
+        coords: Function returning the projected (x, y) of the source
+                pixels, only called when the index is not cached. [function]
+        cache_dir: Folder to store the indices on disk, for scenes read
+                   again, None for memory only. [string]
+
+    OUTPUTS:
+        index: see build_index. [dict]
+    '''
+
+    key = footprint_key(lat, lon, grid)
+
+    # the cache is shared by the scene threads of S3_pipeline.py
+    with _index_lock:
+        if key in _index_cache:
+            _index_cache.move_to_end(key)
+            return _index_cache[key]
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = cache_dir + os.sep + key + '.npz'
+
+    if cache_file is not None and os.path.isfile(cache_file):
+        with np.load(cache_file) as f:
+            index = dict(window=Window(*f['window']), rows=f['rows'],
+                         cols=f['cols'], src=f['src'])
+    else:
+        x, y = coords()
+        index = build_index(x, y, grid)
+        if index is not None and cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            w = index['window']
+            # written through a temporary file, not to leave a partial index
+            tmp_file = '%s.%d_%d.tmp.npz' % (cache_file[:-4], os.getpid(),
+                                             threading.get_ident())
+            np.savez(tmp_file, rows=index['rows'], cols=index['cols'],
+                     src=index['src'],
+                     window=[w.col_off, w.row_off, w.width, w.height])
+            os.replace(tmp_file, cache_file)
+
+    with _index_lock:
+        _index_cache[key] = index
+        if len(_index_cache) > cache_size:
+            _index_cache.popitem(last=False)
+
+    return index
+
+
+def apply_index(index, data, shape=None):
+    '''
+    Maps a full resolution array on the grid of an index.
+
+    INPUTS:
+        index: see build_index. [dict]
+        data: Full resolution source array. [array]
+        shape: Shape of the grid the index was built on, None to return
+               the window of the index only. [tuple]
+
+    OUTPUTS:
+        data on the grid (or window). [array]
+    '''
+
+    w = index['window']
+    rows, cols = index['rows'], index['cols']
+
+    if shape is None:
+        shape = (int(w.height), int(w.width))
+    else:
+        rows = rows + int(w.row_off)
+        cols = cols + int(w.col_off)
+
+    out = np.full(shape, np.nan, dtype='float32')
+    out[rows, cols] = data.ravel()[index['src']]
+
+    return out
+
+
+def project(lon, lat, crs):
+    '''
+    Projects geographic coordinates on the region grid coordinate system.
+    '''
+
+    x, y = transform_coords('EPSG:4326', crs, lon.ravel().astype('float64'),
+                            lat.ravel().astype('float64'))
+
+    return (np.asarray(x, dtype='float32').reshape(lon.shape),
+            np.asarray(y, dtype='float32').reshape(lon.shape))
+
+
+def read_olci_grids(folder, grids, cache_dir=None, n_threads=4):
+    '''
+    Reads an OLCI EFR product on one or several region grids. Each variable
+    is read and calibrated once, then mapped on every grid.
+
+    INPUTS:
+        folder: Path to the S3?_OL_1_EFR_*.SEN3 folder. [string]
+        grids: Region grids. [list of dicts]
+        cache_dir: Folder of the cached indices. [string]
+        n_threads: Number of bands read in parallel. [int]
+
+    OUTPUTS:
+        list of (index, scene) for each grid, (None, {}) if the product is
+        outside the grid:
+            index: Index of the OLCI pixels on the region grid. [dict]
+            scene: OLCI bands on the window of the index. [dict of arrays]
+    '''
+
+    tie_lat, tags = read_nc(folder, 'tie_geo_coordinates.nc', 'latitude')
+    tie_lon, _ = read_nc(folder, 'tie_geo_coordinates.nc', 'longitude')
+    ac, al = tie_point_factors(tags)
+
+    detector_index = read_flags(folder, 'instrument_data.nc', 'detector_index')
+    shape = detector_index.shape
+
+    def coords(grid):
+        # tie-points are projected first, then interpolated: no issue
+        # with the longitude discontinuity
+        tie_x, tie_y = project(tie_lon, tie_lat, grid['crs'])
+        rows, cols = np.mgrid[0:shape[0], 0:shape[1]]
+        return (interpolate_tie_points(tie_x, ac, al, rows, cols),
+                interpolate_tie_points(tie_y, ac, al, rows, cols))
+
+    indices = [get_index(tie_lat, tie_lon, grid, lambda: coords(grid),
+                         cache_dir) for grid in grids]
+    scenes = [{} for _ in grids]
+    valid = [k for k, index in enumerate(indices) if index is not None]
+    if not valid:
+        return [(None, {}) for _ in grids]
+
+    # full resolution coordinates of the selected source pixels
+    src = {k: np.unravel_index(indices[k]['src'], shape) for k in valid}
+
+    def on_grid(k, values):
+        index = indices[k]
+        w = index['window']
+        out = np.full((int(w.height), int(w.width)), np.nan, dtype='float32')
+        out[index['rows'], index['cols']] = values
+        return out
+
+    # geometry and meteo from the tie-points
+    for var in ['SZA', 'OZA']:
+        tie, _ = read_nc(folder, 'tie_geometries.nc', var)
+        for k in valid:
+            scenes[k][var] = on_grid(k, interpolate_tie_points(
+                tie, ac, al, *src[k]))
+    for var in ['SAA', 'OAA']:
+        tie, _ = read_nc(folder, 'tie_geometries.nc', var)
+        for k in valid:
+            scenes[k][var] = on_grid(k, interpolate_angle(
+                tie, ac, al, *src[k]) % 360)
+    for var, name in [('total_ozone', 'O3'),
+                      ('total_columnar_water_vapour', 'WV')]:
+        tie, _ = read_nc(folder, 'tie_meteo.nc', var)
+        for k in valid:
+            scenes[k][name] = on_grid(k, interpolate_tie_points(
+                tie, ac, al, *src[k]))
+
+    altitude, _ = read_nc(folder, 'geo_coordinates.nc', 'altitude')
+    for k in valid:
+        scenes[k]['height'] = apply_index(indices[k], altitude)
+
+    # SZA has some valid data where it shouldn't (as in S3_fast.xml)
+    flags = read_flags(folder, 'qualityFlags.nc', 'quality_flags')
+    for k in valid:
+        index = indices[k]
+        invalid = (flags.ravel()[index['src']] & olci_invalid_flag) != 0
+        scenes[k]['SZA'][index['rows'][invalid],
+                         index['cols'][invalid]] = np.nan
+
+    # radiance to reflectance
+    solar_flux, _ = read_nc(folder, 'instrument_data.nc', 'solar_flux')
+    detectors, bad_detector, mu0 = {}, {}, {}
+    for k in valid:
+        index = indices[k]
+        detectors[k] = detector_index.ravel()[index['src']]
+        bad_detector[k] = detectors[k] < 0
+        detectors[k] = np.where(bad_detector[k], 0, detectors[k])
+        mu0[k] = np.cos(np.deg2rad(scenes[k]['SZA'][index['rows'],
+                                                    index['cols']]))
+
+    def olci_reflectance(i):
+        radiance, _ = read_nc(folder, olci_bands[i] + '_radiance.nc',
+                              olci_bands[i] + '_radiance')
+        band = 'r_TOA_' + str(i + 1).zfill(2)
+        for k in valid:
+            f0 = solar_flux[i, detectors[k]]
+            refl = np.pi * radiance.ravel()[indices[k]['src']] / (f0 * mu0[k])
+            refl[bad_detector[k]] = np.nan
+            scenes[k][band] = on_grid(k, refl)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(olci_reflectance, range(21)))
+
+    return list(zip(indices, scenes))
+
+
+def read_olci(folder, grid, cache_dir=None, n_threads=4):
+    '''
+    Reads an OLCI EFR product on the region grid (see read_olci_grids).
+    '''
+
+    return read_olci_grids(folder, [grid], cache_dir, n_threads)[0]
+
+
+def read_slstr_grids(folder, grids, szas, cache_dir=None):
+    '''
+    Reads the SLSTR RBT bands needed by SCDA on windows of one or several
+    region grids. Each variable is read once. The reflectances use the SZA
+    of the grid (from OLCI, same overpass), which avoids interpolating the
+    SLSTR tie-point geometry.
+
+    INPUTS:
+        folder: Path to the S3?_SL_1_RBT_*.SEN3 folder. [string]
+        grids: Grids of the OLCI windows. [list of dicts]
+        szas: Solar zenith angle on each grid. [list of arrays]
+        cache_dir: Folder of the cached indices. [string]
+
+    OUTPUTS:
+        scenes: r_TOA_S1, r_TOA_S5 and BT_S7..9 on each grid.
+                [list of dicts of arrays]
+    '''
+
+    scenes = [{} for _ in grids]
+    mu0 = [np.cos(np.deg2rad(sza)) for sza in szas]
+
+    for view, bands in [('an', slstr_reflectance), ('in', slstr_bt)]:
+        lat, _ = read_nc(folder, 'geodetic_' + view + '.nc', 'latitude_' + view)
+        lon, _ = read_nc(folder, 'geodetic_' + view + '.nc',
+                         'longitude_' + view)
+
+        indices = [get_index(lat, lon, grid,
+                             lambda: project(lon, lat, grid['crs']),
+                             cache_dir) for grid in grids]
+        valid = [k for k, index in enumerate(indices) if index is not None]
+        if not valid:
+            continue
+
+        for band in bands:
+            if view == 'an':
+                radiance, _ = read_nc(folder, band + '_radiance_an.nc',
+                                      band + '_radiance_an')
+                irradiance, _ = read_nc(folder, band + '_quality_an.nc',
+                                        band + '_solar_irradiance_an')
+                for k in valid:
+                    scenes[k]['r_TOA_' + band] = np.pi \
+                        * apply_index(indices[k], radiance, szas[k].shape) \
+                        / (np.nanmean(irradiance) * mu0[k])
+            else:
+                bt, _ = read_nc(folder, band + '_BT_in.nc', band + '_BT_in')
+                for k in valid:
+                    scenes[k]['BT_' + band] = apply_index(indices[k], bt,
+                                                          szas[k].shape)
+
+    return scenes
+
+
+def read_slstr(folder, grid, sza, cache_dir=None):
+    '''
+    Reads the SLSTR RBT bands needed by SCDA on a window of the region grid
+    (see read_slstr_grids).
+    '''
+
+    return read_slstr_grids(folder, [grid], [sza], cache_dir)[0]
+
+
+def read_scenes(olci_folder, slstr_folder, regions, cache_dir=None):
+    '''
+    Reads an OLCI/SLSTR pair once on the grids of several regions, each
+    scene being cropped to the valid SZA extent within the region mask
+    (as S3_align.py does).
+
+    INPUTS:
+        olci_folder, slstr_folder: Paths to the SEN3 folders, slstr_folder
+                                   may be None. [strings]
+        regions: (mask file, resolution) of each region. [list of tuples]
+        cache_dir: Folder of the cached indices. [string]
+
+    OUTPUTS:
+        list of (scene, grid) for each region, ({}, None) if the scene is
+        outside the region:
+            scene: bands of the scene. [dict of arrays]
+            grid: grid of the scene within the region grid. [dict]
+    '''
+
+    # a missing region mask only fails its own region
+    missing = [k for k, (mask_file, _) in enumerate(regions)
+               if not os.path.isfile(mask_file)]
+    if missing:
+        results = [({}, None) for _ in regions]
+        for k in missing:
+            print('ERROR: region mask %s not found' % regions[k][0])
+        available = [k for k in range(len(regions)) if k not in missing]
+        if available:
+            for k, result in zip(available, read_scenes(
+                    olci_folder, slstr_folder,
+                    [regions[k] for k in available], cache_dir)):
+                results[k] = result
+        return results
+
+    grids = [region_grid(mask_file, resize) for mask_file, resize in regions]
+    masks = [region_mask(mask_file, resize) for mask_file, resize in regions]
+
+    results = [({}, None) for _ in regions]
+    zooms = []
+
+    for k, (index, scene) in enumerate(read_olci_grids(olci_folder, grids,
+                                                       cache_dir)):
+        if index is None:
+            print('%s outside of region %s' % (olci_folder, regions[k][0]))
+            continue
+
+        window = index['window']
+        mask_window = masks[k][window.toslices()]
+        valid = ~np.isnan(scene['SZA']) & mask_window
+        if not valid.any():
+            print('%s: no valid SZA within region %s'
+                  % (olci_folder, regions[k][0]))
+            continue
+
+        rows = np.where(valid.any(axis=1))[0]
+        cols = np.where(valid.any(axis=0))[0]
+        crop = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+        zoom = Window(window.col_off + cols[0], window.row_off + rows[0],
+                      cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+        zoom_grid = window_grid(grids[k], zoom)
+
+        scene = {b: v[crop] for b, v in scene.items()}
+        results[k] = (scene, zoom_grid)
+        zooms.append((k, mask_window[crop]))
+
+    if slstr_folder is not None and zooms:
+        slstr = read_slstr_grids(slstr_folder,
+                                 [results[k][1] for k, _ in zooms],
+                                 [results[k][0]['SZA'] for k, _ in zooms],
+                                 cache_dir)
+        for (k, _), slstr_scene in zip(zooms, slstr):
+            results[k][0].update(slstr_scene)
+
+    for k, zoom_mask in zooms:
+        scene, zoom_grid = results[k]
+        for band in scene:
+            scene[band][~zoom_mask] = np.nan
+
+        # region mask classes, as written by S3_align.py
+        scene['mask'] = np.where(zoom_mask,
+                                 read_on_grid(regions[k][0], zoom_grid),
+                                 np.nan).astype('float32')
+
+    return results
+
+
+def read_scene(olci_folder, slstr_folder, mask_file, resize, cache_dir=None):
+    '''
+    Reads an OLCI/SLSTR pair on the region grid (see read_scenes).
+
+    OUTPUTS:
+        scene: bands of the scene. [dict of arrays]
+        grid: grid of the scene within the region grid. [dict]
+    '''
+
+    return read_scenes(olci_folder, slstr_folder, [(mask_file, resize)],
+                       cache_dir)[0]
+
+
+def write_scene(scene, grid, dest, n_threads=4):
+    '''
+    Writes the bands of a scene, one GeoTIFF per band.
+    '''
+
+    os.makedirs(dest, exist_ok=True)
+
+    def write(band):
+        write_band(scene[band], dest + os.sep + band + '.tif', grid)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(write, scene))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('olci')
+    parser.add_argument('slstr')
+    parser.add_argument('dest')
+    parser.add_argument('mask')
+    parser.add_argument('resize', type=float)
+    parser.add_argument('--cache', default=None,
+                        help='folder where reprojection indices are cached, '
+                        'for scenes read again (not pruned)')
+    args = parser.parse_args()
+
+    start_time = time.time()
+
+    scene, grid = read_scene(args.olci, args.slstr, args.mask, args.resize,
+                             cache_dir=args.cache)
+    if grid is not None:
+        write_scene(scene, grid, args.dest)
+
+    print('End S3_reader.py %s --- %s seconds ---'
+          % (args.dest, time.time() - start_time))
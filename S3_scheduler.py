@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Scheduler of (region, date) jobs, replacing the sequential loops of
+S3_wrapper.sh (days) and S3_NRT.sh (regions) for season reprocessing and
+NRT runs.
+
+Each job fetches the products of a region-day (dsget_wrapper.sh) and
+processes them with S3_pipeline.py. Jobs are started by priority (NRT
+first, then backfill, oldest date first) as long as:
+    - the threads of the running jobs fit in the CPU limit,
+    - the estimated memory of the running jobs fits in the RAM limit and
+      the available memory (/proc/meminfo) covers the new job,
+    - the free disk space is above the disk limit.
+A failed stage is retried (with a delay) without restarting the whole job,
+and a job failing is reported without stopping the others. Every stage
+attempt is appended to the job log.
+
+INPUTS:
+    --regions: Regions to process. [list]
+    --nrt: Add the NRT jobs of the regions (date of two days ago). [flag]
+    --start, --end: Backfill period (YYYY-MM-DD), inclusive. [strings]
+    --root: Root folder of the regions. [string]
+
+OUTPUTS:
+    {root}/{region}/mosaic/{date}: S3_pipeline.py outputs. [.tif]
+    {log}: job log, one line per stage attempt. [.csv]
+    {log_folder}/{region}_{date}_{stage}.log: stage outputs. [.log]
+
+"""
+
+import argparse
+import heapq
+import os
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import date as dt_date, timedelta
+
+from dm_stream import region_grid
+
+# job priorities, lowest first
+priority_nrt = 0
+priority_backfill = 1
+
+# bytes per pixel of the region grid used by S3_pipeline.py: about 150
+# float32 arrays (mosaic, SICE inputs, outputs and temporaries)
+bytes_per_pixel = 150 * 4
+
+_log_lock = threading.Lock()
+
+
+def memory_available():
+    '''
+    Available memory in bytes (MemAvailable of /proc/meminfo).
+    '''
+
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+
+    return 0
+
+
+def disk_free(path):
+    '''
+    Free disk space in bytes on the file system of path.
+    '''
+
+    while not os.path.exists(path):
+        path = os.path.dirname(os.path.abspath(path))
+
+    return shutil.disk_usage(path).free
+
+
+def job_memory(mask_file, res):
+    '''
+    Estimated peak memory of a region-day in bytes, from the size of the
+    region grid, 0 without region mask (the job fails at once).
+    '''
+
+    if not os.path.isfile(mask_file):
+        return 0
+
+    grid = region_grid(mask_file, res)
+
+    return grid['width'] * grid['height'] * bytes_per_pixel
+
+
+def make_job(region, date, priority, args, auth):
+    '''
+    Defines the stages of a (region, date) job.
+
+    INPUTS:
+        region: Region name. [string]
+        date: Date to process (YYYY-MM-DD). [string]
+        priority: priority_nrt or priority_backfill. [int]
+        args: Command line arguments. [argparse.Namespace]
+        auth: Data hub username and password. [tuple]
+
+    OUTPUTS:
+        job: region, date, priority, memory, threads, stages, a stage
+             being a (name, command) tuple, and error, the reason the job
+             cannot run (None if it can). [dict]
+    '''
+
+    year = date[:4]
+    region_root = args.root + os.sep + region
+    sen3_source = region_root + os.sep + 'S3' + os.sep + year + os.sep + date
+    mosaic_root = region_root + os.sep + 'mosaic'
+    mask_file = args.mask.format(region=region)
+
+    stages = []
+
+    if not args.no_fetch:
+        stages.append(('fetch', ['./dsget_wrapper.sh', '-d', date,
+                                 '-l', args.sen3_local, '-o', sen3_source,
+                                 '-f', region, '-u', auth[0], '-p', auth[1]]))
+
+    process = ['python', './S3_pipeline.py', date, sen3_source, mosaic_root,
+               '--mask', mask_file, '--res', str(args.res),
+               '-t', str(args.threads)]
+    if args.cache is not None:
+        process += ['--cache', args.cache]
+    if args.slopey is not None:
+        process += ['--slopey', args.slopey]
+    stages.append(('process', process))
+
+    error = None
+    if not os.path.isfile(mask_file):
+        error = 'region mask %s not found' % mask_file
+
+    return dict(region=region, date=date, priority=priority,
+                memory=job_memory(mask_file, args.res), threads=args.threads,
+                stages=stages, error=error)
+
+
+def log_attempt(log_file, job, stage, attempt, status, seconds, returncode):
+
+    with _log_lock:
+        new_file = not os.path.isfile(log_file)
+        with open(log_file, 'a') as f:
+            if new_file:
+                f.write('time,region,date,stage,attempt,status,seconds,'
+                        'returncode\n')
+            f.write('%s,%s,%s,%s,%d,%s,%.1f,%s\n' % (
+                time.strftime('%Y-%m-%dT%H:%M:%S'), job['region'],
+                job['date'], stage, attempt, status, seconds, returncode))
+
+
+def run_job(job, log_file, log_folder, retries=2, retry_delay=60,
+            fetch_lock=None):
+    '''
+    Runs the stages of a job in order, each stage being retried up to
+    retries times.
+
+    INPUTS:
+        job: see make_job. [dict]
+        log_file: Path to the job log. [string]
+        log_folder: Folder of the stage outputs. [string]
+        retries: Number of retries of a failed stage. [int]
+        retry_delay: Delay before the first retry in seconds, doubled at
+                     each retry. [float]
+        fetch_lock: Limits the number of concurrent fetch stages (dsget
+                    shares its working folder). [threading.Semaphore]
+
+    OUTPUTS:
+        True if all the stages succeeded. [boolean]
+    '''
+
+    if job.get('error') is not None:
+        print('ERROR: %s %s: %s' % (job['region'], job['date'], job['error']))
+        log_attempt(log_file, job, job['stages'][0][0], 0, 'failed', 0, None)
+        return False
+
+    for stage, command in job['stages']:
+
+        stage_log = log_folder + os.sep + '%s_%s_%s.log' % (
+            job['region'], job['date'], stage)
+
+        for attempt in range(retries + 1):
+
+            if attempt > 0:
+                time.sleep(retry_delay * 2 ** (attempt - 1))
+
+            start = time.time()
+            lock = fetch_lock if stage == 'fetch' else None
+            if lock is not None:
+                lock.acquire()
+            try:
+                with open(stage_log, 'a') as out:
+                    returncode = subprocess.call(command, stdout=out,
+                                                 stderr=subprocess.STDOUT)
+            except OSError as e:
+                print('ERROR: %s' % e)
+                returncode = None
+            finally:
+                if lock is not None:
+                    lock.release()
+
+            status = 'done' if returncode == 0 else 'failed'
+            log_attempt(log_file, job, stage, attempt, status,
+                        time.time() - start, returncode)
+
+            if returncode == 0:
+                break
+        else:
+            print('ERROR: %s %s failed at stage %s, see %s'
+                  % (job['region'], job['date'], stage, stage_log))
+            return False
+
+    return True
+
+
+def schedule(jobs, max_threads, max_memory, min_disk, disk_path, log_file,
+             log_folder, retries=2, retry_delay=60, fetch_jobs=1,
+             poll=10):
+    '''
+    Runs jobs concurrently by priority within CPU, RAM and disk limits.
+
+    INPUTS:
+        jobs: see make_job. [list of dicts]
+        max_threads: Maximum number of threads of the running jobs. [int]
+        max_memory: Maximum estimated memory of the running jobs in
+                    bytes. [int]
+        min_disk: Minimum free disk space in bytes to start a job. [int]
+        disk_path: Path on the output file system. [string]
+        log_file, log_folder, retries, retry_delay: see run_job.
+        fetch_jobs: Maximum number of concurrent fetch stages. [int]
+        poll: Delay between two checks of the resources in seconds. [float]
+
+    OUTPUTS:
+        failed: (region, date) of the failed jobs. [list]
+    '''
+
+    os.makedirs(log_folder, exist_ok=True)
+
+    queue = [(job['priority'], job['date'] if job['priority'] else '',
+              i, job) for i, job in enumerate(jobs)]
+    heapq.heapify(queue)
+
+    fetch_lock = threading.Semaphore(fetch_jobs)
+    running = {}
+    failed = []
+
+    def can_start(job):
+        if not running:
+            return True
+        threads = sum(j['threads'] for j in running.values())
+        memory = sum(j['memory'] for j in running.values())
+        return (threads + job['threads'] <= max_threads
+                and memory + job['memory'] <= max_memory
+                and memory_available() >= job['memory']
+                and disk_free(disk_path) >= min_disk)
+
+    with ThreadPoolExecutor(max_workers=max(len(jobs), 1)) as executor:
+
+        while queue or running:
+
+            while queue and can_start(queue[0][-1]):
+                job = heapq.heappop(queue)[-1]
+                print('Starting %s %s' % (job['region'], job['date']))
+                future = executor.submit(run_job, job, log_file, log_folder,
+                                         retries, retry_delay, fetch_lock)
+                running[future] = job
+
+            done, _ = wait(list(running), timeout=poll,
+                           return_when=FIRST_COMPLETED)
+
+            for future in done:
+                job = running.pop(future)
+                try:
+                    success = future.result()
+                except Exception as e:
+                    print('ERROR: %s %s: %s' % (job['region'], job['date'], e))
+                    success = False
+                if not success:
+                    failed.append((job['region'], job['date']))
+
+    return failed
+
+
+def date_range(start, end):
+
+    day = dt_date.fromisoformat(start)
+    last = dt_date.fromisoformat(end)
+
+    while day <= last:
+        yield day.isoformat()
+        day += timedelta(days=1)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--regions', nargs='+', required=True)
+    parser.add_argument('--nrt', action='store_true',
+                        help='add the jobs of two days ago, first priority')
+    parser.add_argument('--start', default=None,
+                        help='first date of the backfill (YYYY-MM-DD)')
+    parser.add_argument('--end', default=None,
+                        help='last date of the backfill (YYYY-MM-DD)')
+    parser.add_argument('--root', default='/sice-data/SICE')
+    parser.add_argument('--sen3-local', default='/eodata/Sentinel-3')
+    parser.add_argument('--mask', default='./masks/{region}_300m.tif')
+    parser.add_argument('--res', type=float, default=1000)
+    parser.add_argument('--slopey', default=None,
+                        help='ArcticDEM folder, to run the slope correction')
+    parser.add_argument('--cache', default=None,
+                        help='folder where reprojection indices are cached, '
+                        'for scenes read again (not pruned)')
+    parser.add_argument('--no-fetch', action='store_true',
+                        help='process the products already on disk')
+    parser.add_argument('-t', '--threads', type=int, default=4,
+                        help='threads per job')
+    parser.add_argument('--cpus', type=int, default=os.cpu_count(),
+                        help='maximum number of threads of the running jobs')
+    parser.add_argument('--memory', type=float, default=None,
+                        help='maximum memory of the running jobs in GB, '
+                        'default 80%% of the available memory')
+    parser.add_argument('--disk', type=float, default=50,
+                        help='minimum free disk space in GB to start a job')
+    parser.add_argument('--retries', type=int, default=2)
+    parser.add_argument('--retry-delay', type=float, default=60)
+    parser.add_argument('--fetch-jobs', type=int, default=1)
+    parser.add_argument('--log', default='S3_scheduler_log.csv')
+    parser.add_argument('--log-folder', default='./logs')
+    args = parser.parse_args()
+
+    start_time = time.time()
+
+    # Scihub credentials (from local auth.txt in SICE folder)
+    auth = ('', '')
+    if not args.no_fetch:
+        with open('auth.txt') as f:
+            auth = tuple(f.read().splitlines()[:2])
+
+    jobs = []
+    if args.nrt:
+        nrt_date = (dt_date.today() - timedelta(days=2)).isoformat()
+        jobs += [make_job(region, nrt_date, priority_nrt, args, auth)
+                 for region in args.regions]
+    if args.start is not None:
+        jobs += [make_job(region, date, priority_backfill, args, auth)
+                 for date in date_range(args.start, args.end or args.start)
+                 for region in args.regions]
+
+    if args.memory is None:
+        max_memory = int(0.8 * memory_available())
+    else:
+        max_memory = int(args.memory * 1e9)
+
+    failed = schedule(jobs, args.cpus, max_memory, int(args.disk * 1e9),
+                      args.root, args.log, args.log_folder,
+                      retries=args.retries, retry_delay=args.retry_delay,
+                      fetch_jobs=args.fetch_jobs)
+
+    for region, date in failed:
+        print('Processing of %s %s failed, please check logs.'
+              % (region, date))
+
+    print('End S3_scheduler.py %d jobs, %d failed --- %s seconds ---'
+          % (len(jobs), len(failed), time.time() - start_time))
@@ -34,6 +34,38 @@ slopey=false
 # Fast processing
 fast=true
 
+# In-memory processing of each day (S3_pipeline.py) instead of the
+# S3_proc.sh, SCDA.py, dm.sh, get_ITOAR.py and sice.py chain
+pipeline=false
+
+# Job-state manifest (S3_manifest.py): stages are skipped when their inputs
+# and code are unchanged and their outputs intact. Empty to disable.
+manifest=./SICE_manifest.sqlite
+
+# Pre-screening of the scenes (S3_prescreen.py): scenes outside the area,
+# with SZA > 75 or fully clouded are skipped before processing
+prescreen=false
+
+# Cloud-optimized GeoTIFF outputs (cog.py): tiled, with internal overviews
+cog=false
+
+# Local archive catalog (S3_catalog.py): scenes selected and paired with
+# indexed queries instead of data hub queries. Empty to disable.
+catalog=
+
+# Label rasters of the zonal statistics of the SICE products
+# (sice_zonal.py), e.g. the region mask and drainage basins. Empty to
+# disable (the pipeline always uses the region mask).
+zones="./mask.tif"
+
+# Time-series cube of the daily products (sice_cube.py), e.g.
+# ${mosaic_root}/SICE.zarr. Empty to disable.
+cube=
+
+# Gapless daily broadband albedo of the season (sice_gapfill.py), written
+# in ${mosaic_root}/SICE_BBA/${year}
+gapfill=false
+
 # Error reporting
 error=false
 
@@ -46,6 +78,48 @@ fi
 
 LD_LIBRARY_PATH=. # SNAP requirement
 
+# runs a stage of the date through the manifest, if any
+# usage: stage <name> [S3_manifest.py options] -- <command>
+stage() {
+	local name=$1
+	shift
+	if [[ -z ${manifest} ]]; then
+		while [[ $1 != "--" ]]; do shift; done
+		shift
+		"$@"
+	else
+		python ./S3_manifest.py run --db ${manifest} --region ${area} --date "${date}" \
+			--stage "${name}" "$@"
+	fi
+}
+
+if [[ ${manifest} ]]; then
+	# per-scene records in S3_proc.sh
+	export SICE_MANIFEST=${manifest}
+	export SICE_REGION=${area}
+fi
+
+if [ "${prescreen}" = true ]; then
+	proc_opt="-S"
+	prescreen_opt="--prescreen"
+else
+	proc_opt=""
+	prescreen_opt=""
+fi
+
+if [ "${cog}" = true ]; then
+	# GRASS mosaics converted by dm.grass.sh
+	export SICE_COG=1
+	cog_opt="--cog"
+else
+	cog_opt=""
+fi
+
+if [[ ${catalog} ]]; then
+	# pairing in S3_proc.sh
+	export SICE_CATALOG=${catalog}
+fi
+
 for year in 2020; do
 	for doy in $(seq -w 91 276); do
 
@@ -55,38 +129,113 @@ for year in 2020; do
 
 		date=$(date -d "${year}-01-01 +$((10#${doy} - 1)) days" "+%Y-%m-%d")
 
-		if [[ -d "${mosaic_root}/${date}" ]] && [[ -e "${mosaic_root}/${date}/conc.tif" ]]; then
+		if [[ -z ${manifest} ]] && [[ -d "${mosaic_root}/${date}" ]] && [[ -e "${mosaic_root}/${date}/conc.tif" ]]; then
 			log_warn "${mosaic_root}/${date} already exists, date skipped"
 			continue
 		fi
 
 		### Fetch one day of OLCI & SLSTR scenes over Greenland
 		## Use local files (PTEP, DIAS, etc.)
-		./dsget_wrapper.sh -d "${date}" -l ${SEN3_local} -o ${SEN3_source}/${year}/"${date}" \
-			-f ${area} -u "${username}" -p "${password}" || error=true
+		if [[ ${catalog} ]]; then
+			python ./S3_catalog.py index ${SEN3_local} --date "${date}" --db ${catalog} || error=true
+			python ./S3_catalog.py link --db ${catalog} --date "${date}" \
+				--mask ./masks/${area}_300m.tif --direction descending \
+				--out ${SEN3_source}/${year}/"${date}" || error=true
+		else
+			./dsget_wrapper.sh -d "${date}" -l ${SEN3_local} -o ${SEN3_source}/${year}/"${date}" \
+				-f ${area} -u "${username}" -p "${password}" || error=true
+		fi
 		## Download files
 		# ./dsget_wrapper.sh -d ${date} -o ${SEN3_source}/${year}/${date} \
 		# 			 -f Svalbard -u "${username}" -p "${password}"
 
+		if [ "${pipeline}" = true ]; then
+			if [ "${slopey}" = true ]; then
+				slopey_opt="--slopey $(pwd)/ArcticDEM/"
+			else
+				slopey_opt=""
+			fi
+			# shellcheck disable=SC2086
+			stage pipeline --inputs ${SEN3_source}/${year}/"${date}" --outputs ${mosaic_root}/"${date}" \
+				--code S3_pipeline.py S3_reader.py SCDA.py cloud_mask.py dm_stream.py \
+				sice.py sice_lib.py constants.py get_ITOAR.py cog.py sice_zonal.py sice_lut.py sice_codecs.py -- \
+				python ./S3_pipeline.py "${date}" ${SEN3_source}/${year}/"${date}" ${mosaic_root} \
+				--overwrite ${slopey_opt} \
+				${catalog:+--catalog ${catalog}} ${prescreen_opt} ${cog_opt} \
+				${zones:+--zones ${zones}} || error=true
+
+			if [[ ${cube} ]]; then
+				stage cube --after pipeline --code sice_cube.py -- \
+					python ./sice_cube.py append ${mosaic_root}/"${date}" ${cube} || error=true
+			fi
+
+			if [ "${error}" = true ]; then
+				echo "Processing of ${date} failed, please check logs."
+			fi
+			continue
+		fi
+
 		# SNAP: Reproject, calculate reflectance, extract bands, etc.
-		./S3_proc.sh -i ${SEN3_source}/${year}/"${date}" -o ${proc_root}/"${date}" -X ${xml_file} -t || error=true
+		# shellcheck disable=SC2086
+		stage proc --inputs ${SEN3_source}/${year}/"${date}" --outputs ${proc_root}/"${date}" \
+			--code S3_proc.sh ${xml_file} S3_align.py S3_prescreen.py -- \
+			./S3_proc.sh -i ${SEN3_source}/${year}/"${date}" -o ${proc_root}/"${date}" -X ${xml_file} -t \
+			${proc_opt} || error=true
 
 		# Run the Simple Cloud Detection Algorithm (SCDA)
-		python ./SCDA.py ${proc_root}/"${date}" || error=true
+		stage scda --after proc --outputs "${proc_root}/${date}/*/SCDA_*.tif" "${proc_root}/${date}/*/SZA_CM.tif" \
+			"${proc_root}/${date}/*/NDSI.tif" "${proc_root}/${date}/*/r_TOA_S5_rc.tif" \
+			--code SCDA.py cloud_mask.py dm_stream.py -- \
+			python ./SCDA.py ${proc_root}/"${date}" || error=true
+
+		# Outputs of the mosaic, slopey and sice stages, disjoint since they
+		# share the mosaic folder: the slopey correction rewrites the angles
+		# and two r_TOA mosaics, which are then outputs of slopey only
+		out=${mosaic_root}/${date}
+		mosaic_outputs=("${out}/r_TOA_0?.tif" "${out}/r_TOA_1[0-689].tif" "${out}/r_TOA_20.tif"
+			"${out}/r_TOA_S*.tif" "${out}/SZA_CM.tif" "${out}/SAA.tif" "${out}/OAA.tif" "${out}/WV.tif"
+			"${out}/O3.tif" "${out}/NDSI.tif" "${out}/BT_S*.tif" "${out}/height.tif" "${out}/SCDA_*.tif"
+			"${out}/sza_lut.tif" "${out}/num_scenes*.tif" "${out}/NDBI.tif" "${out}/BBA_emp.tif")
+		slopey_outputs=("${out}/SZA.tif" "${out}/OZA.tif" "${out}/r_TOA_17.tif" "${out}/r_TOA_21.tif")
+		sice_outputs=("${out}/O3_SICE.tif" "${out}/grain_diameter.tif" "${out}/snow_specific_surface_area.tif"
+			"${out}/al.tif" "${out}/r0.tif" "${out}/diagnostic_retrieval.tif" "${out}/conc.tif"
+			"${out}/albedo_*.tif" "${out}/rBRR_*.tif" "${out}/zonal_stats.csv")
+		if [ "${slopey}" = false ]; then
+			mosaic_outputs+=("${slopey_outputs[@]}")
+		fi
 
 		# Mosaic
-		./dm.sh "${date}" ${proc_root}/"${date}" ${mosaic_root} || error=true
+		stage mosaic --after proc scda --outputs "${mosaic_outputs[@]}" --code dm.sh dm.grass.sh cog.py -- \
+			./dm.sh "${date}" ${proc_root}/"${date}" ${mosaic_root} || error=true
 
+		sice_after="mosaic"
 		if [ "${slopey}" = true ]; then
 			# Run the slopey correction
-			python ./get_ITOAR.py ${mosaic_root}/"${date}"/ "$(pwd)"/ArcticDEM/ || error=true
+			stage slopey --after mosaic --inputs ArcticDEM \
+				--outputs "${slopey_outputs[@]}" "${out}/slope_flag_*_degrees.tif" --code get_ITOAR.py -- \
+				python ./get_ITOAR.py ${mosaic_root}/"${date}"/ "$(pwd)"/ArcticDEM/ || error=true
+			sice_after="mosaic slopey"
 		fi
 
 		# SICE
-		python ./sice.py ${mosaic_root}/"${date}" || error=true
+		# shellcheck disable=SC2086
+		stage sice --after ${sice_after} --outputs "${sice_outputs[@]}" \
+			--code sice.py sice_lib.py constants.py cog.py sice_zonal.py sice_lut.py sice_codecs.py \
+			tg_vod.dat tg_water_vod.dat -- \
+			python ./sice.py ${mosaic_root}/"${date}" ${cog_opt} ${zones:+--zones ${zones}} || error=true
+
+		if [[ ${cube} ]]; then
+			stage cube --after sice --code sice_cube.py -- \
+				python ./sice_cube.py append ${mosaic_root}/"${date}" ${cube} || error=true
+		fi
 
 		if [ "${error}" = true ]; then
 			echo "Processing of ${date} failed, please check logs."
 		fi
 	done
+
+	if [ "${gapfill}" = true ]; then
+		python ./sice_gapfill.py ${mosaic_root} "${year}-04-01" "${year}-10-02" \
+			${mosaic_root}/SICE_BBA/${year} || echo "Gap-filling of ${year} failed, please check logs."
+	fi
 done
@@ -25,6 +25,10 @@ OUTPUTS:
                                results in a .tif file, stored in {inpath}. [.tif]
         {inpath}/SCDA_v14.tif: Simple Cloud Detection Algorithm (SCDA) v1.4
                                results in a .tif file, stored in {inpath}. [.tif]
+        {inpath}/SCDA_final.tif: SCDA v2.0 results with buffered clouds and
+                                 small clear clumps removed over ice, see
+                                 cloud_mask.py. [.tif]
+        {inpath}/SZA_CM.tif: cloud masked SZA, see cloud_mask.py. [.tif]
 
 """
 
@@ -34,13 +38,13 @@ import rasterio
 import argparse
 import os
 import time
+import cloud_mask
 
-parser = argparse.ArgumentParser()
-parser.add_argument('inpath')
-args = parser.parse_args()
+# S5 nadir view adjustment factor, see radiometric_calibration
+S5_factor=1.12
 
 
-def radiometric_calibration(R16,scene,inpath=args.inpath):
+def radiometric_calibration(R16,scene,inpath):
     '''
     Sentinel-3 Product Notice – SLSTR:
     "Based on the analysis performed to-date, a recommendation has been put forward to users to
@@ -52,6 +56,8 @@ def radiometric_calibration(R16,scene,inpath=args.inpath):
         R16: Dataset reader for Top of Atmosphere (TOA) reflectance channel S5.
              Central wavelengths at 1.6um. [rasterio.io.DatasetReader]
         scene: Scene on which to compute SCDA. [string]
+        inpath: Path to the folder of a given date containing extracted scenes
+                in .tif format. [string]
         
     OUTPUTS:
         {inpath}/r_TOA_S5_rc.tif: Adjusted Top of Atmosphere (TOA)
@@ -59,9 +65,8 @@ def radiometric_calibration(R16,scene,inpath=args.inpath):
     '''
     
     profile_R16=R16.profile
-    factor=1.12
     R16_data=R16.read(1)
-    R16_rc=R16_data*factor
+    R16_rc=R16_data*S5_factor
     
     with rasterio.open(inpath+os.sep+scene+os.sep+'r_TOA_S5_rc.tif','w',**profile_R16) as dst:
         dst.write(R16_rc, 1)
@@ -71,37 +76,29 @@ def radiometric_calibration(R16,scene,inpath=args.inpath):
 
 
     
-def SCDA_v20(R550, R16, BT37, BT11, BT12, profile, scene, 
-             inpath=args.inpath, SICE_toolchain=True):
+def cloud_detection_v20(R550, R16, BT37, BT11, BT12, SICE_toolchain=True):
     
     '''
     
+    SCDA v2.0 on arrays, nothing is written.
+    
     INPUTS:
-        inpath: Path to the folder of a given date containing extracted scenes
-                in .tif format. [string]
-        SICE_toolchain: if True: cloud=255, clear=1
-                        if False: cloud=1, clear=0
-        profile: Profile to save outputs. [rasterio.profiles.Profile]
-        scene: Scene on which to compute the SCDA. [string]
         R550, R16: Top of Atmosphere (TOA) reflectances for channels S1 and S5.
                    Central wavelengths at 550nm and 1.6um. [arrays]
         BT37, BT11, BT12: Gridded pixel Brightness Temperatures (BT) for channels 
                           S7, S8 and S9 (1km TIR grid, nadir view). Central 
                           wavelengths at 3.7, 11 and 12 um. [arrays]
+        SICE_toolchain: if True: cloud=255, clear=1
+                        if False: cloud=1, clear=0
               
     OUTPUTS:
-        {inpath}/NDSI.tif: Normalized Difference Snow Index (NDSI) in a 
-                           .tif file, stored in {inpath}. [.tif]
-        {inpath}/SCDA.tif: Simple Cloud Detection Algorithm (SCDA) results 
-                           in a .tif file, stored in {inpath}. 
-                           clouds=1, clear=0 [.tif]
+        cloud_detection: Simple Cloud Detection Algorithm (SCDA) results. [array]
+        NDSI: Normalized Difference Snow Index (NDSI). [array]
          
     '''
     
     #determining the NDSI, needed for the cloud detection
     NDSI=(R550-R16)/(R550+R16)
-    with rasterio.open(inpath+os.sep+scene+os.sep+'NDSI.tif','w',**profile) as dst:
-        dst.write(NDSI, 1)
     
     #initializing thresholds
     base=np.empty((R550.shape[0],R550.shape[1]))
@@ -145,6 +142,42 @@ def SCDA_v20(R550, R16, BT37, BT11, BT12, profile, scene,
     if SICE_toolchain:
         cloud_detection = np.where(cloud_detection==True, 255.0, 1.0)
     
+    return cloud_detection, NDSI
+
+
+def SCDA_v20(R550, R16, BT37, BT11, BT12, profile, scene, 
+             inpath, SICE_toolchain=True):
+    
+    '''
+    
+    INPUTS:
+        inpath: Path to the folder of a given date containing extracted scenes
+                in .tif format. [string]
+        SICE_toolchain: if True: cloud=255, clear=1
+                        if False: cloud=1, clear=0
+        profile: Profile to save outputs. [rasterio.profiles.Profile]
+        scene: Scene on which to compute the SCDA. [string]
+        R550, R16: Top of Atmosphere (TOA) reflectances for channels S1 and S5.
+                   Central wavelengths at 550nm and 1.6um. [arrays]
+        BT37, BT11, BT12: Gridded pixel Brightness Temperatures (BT) for channels 
+                          S7, S8 and S9 (1km TIR grid, nadir view). Central 
+                          wavelengths at 3.7, 11 and 12 um. [arrays]
+              
+    OUTPUTS:
+        {inpath}/NDSI.tif: Normalized Difference Snow Index (NDSI) in a 
+                           .tif file, stored in {inpath}. [.tif]
+        {inpath}/SCDA.tif: Simple Cloud Detection Algorithm (SCDA) results 
+                           in a .tif file, stored in {inpath}. 
+                           clouds=1, clear=0 [.tif]
+         
+    '''
+    
+    cloud_detection, NDSI = cloud_detection_v20(R550, R16, BT37, BT11, BT12,
+                                                SICE_toolchain=SICE_toolchain)
+    
+    with rasterio.open(inpath+os.sep+scene+os.sep+'NDSI.tif','w',**profile) as dst:
+        dst.write(NDSI, 1)
+    
     #writing results
     profile_cloud_detection=profile.copy()
     if SICE_toolchain:
@@ -158,26 +191,39 @@ def SCDA_v20(R550, R16, BT37, BT11, BT12, profile, scene,
     return cloud_detection, NDSI
 
 
-#listing scenes for a given date
-scenes=os.listdir(args.inpath)
+def main(argv=None):
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inpath')
+    args = parser.parse_args(argv)
 
-for i,scene in enumerate(scenes):
+    #listing scenes for a given date
+    scenes=os.listdir(args.inpath)
 
-    #saving profile metadata only for the first iteration
-    profile=rasterio.open(args.inpath+os.sep+scene+os.sep+'r_TOA_S1.tif').profile
 
-    #calibrating R16
-    R16=rasterio.open(args.inpath+os.sep+scene+os.sep+'r_TOA_S5.tif')
-    radiometric_calibration(R16=R16,scene=scene)
+    for i,scene in enumerate(scenes):
 
-    #loading inputs
-    R550=rasterio.open(args.inpath+os.sep+scene+os.sep+'r_TOA_S1.tif').read(1)
-    R16=rasterio.open(args.inpath+os.sep+scene+os.sep+'r_TOA_S5_rc.tif').read(1)
-    BT37=rasterio.open(args.inpath+os.sep+scene+os.sep+'BT_S7.tif').read(1)
-    BT11=rasterio.open(args.inpath+os.sep+scene+os.sep+'BT_S8.tif').read(1)
-    BT12=rasterio.open(args.inpath+os.sep+scene+os.sep+'BT_S9.tif').read(1)
+        #saving profile metadata only for the first iteration
+        profile=rasterio.open(args.inpath+os.sep+scene+os.sep+'r_TOA_S1.tif').profile
 
-    #running SCDA v2.0 and v1.4
-    cd,NDSI=SCDA_v20(R550=R550,R16=R16,BT37=BT37,BT11=BT11,BT12=BT12,scene=scene,profile=profile)
-    
+        #calibrating R16
+        R16=rasterio.open(args.inpath+os.sep+scene+os.sep+'r_TOA_S5.tif')
+        radiometric_calibration(R16=R16,scene=scene,inpath=args.inpath)
+
+        #loading inputs
+        R550=rasterio.open(args.inpath+os.sep+scene+os.sep+'r_TOA_S1.tif').read(1)
+        R16=rasterio.open(args.inpath+os.sep+scene+os.sep+'r_TOA_S5_rc.tif').read(1)
+        BT37=rasterio.open(args.inpath+os.sep+scene+os.sep+'BT_S7.tif').read(1)
+        BT11=rasterio.open(args.inpath+os.sep+scene+os.sep+'BT_S8.tif').read(1)
+        BT12=rasterio.open(args.inpath+os.sep+scene+os.sep+'BT_S9.tif').read(1)
+
+        #running SCDA v2.0 and v1.4
+        cd,NDSI=SCDA_v20(R550=R550,R16=R16,BT37=BT37,BT11=BT11,BT12=BT12,scene=scene,profile=profile,
+                         inpath=args.inpath)
+
+        #buffering clouds and removing small clear clumps before mosaicking
+        SCDA_final,SZA_CM=cloud_mask.process_scene(args.inpath+os.sep+scene,cd,profile)
+
+
+if __name__ == '__main__':
+    main()
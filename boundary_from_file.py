@@ -1,61 +1,383 @@
 # -*- coding: utf-8 -*-
 """
 @author: Adrien Wehrlé, GEUS (Geological Survey of Denmark and Greenland)
+
+Area of interest (AOI) from a geojson or csv file: boundary of the data hub
+queries (dhusget_wrapper.sh) and region mask on a polar stereographic grid.
+
+All the polygons of all the features are read (Polygon and MultiPolygon
+geometries, with their holes), or the single ring of the first two columns
+(lon, lat) of a csv file. The rings are simplified with the Douglas-Peucker
+algorithm, vectorized over all the segments of a level: each vertex gets the
+distance at which it would be removed, so that one pass serves any
+tolerance, and the vertex count is capped (--max-vertices) by raising the
+tolerance, dropping the smallest polygons if their rings alone exceed the
+cap. Distances are in degrees of latitude, longitudes being scaled by the
+cosine of the latitude of each ring.
+
+The simplified polygons are cached per input file hash and parameters in
+cache_folder, detailed coastlines being read and simplified only once.
+
+INPUTS:
+    file: Path to the AOI file, .geojson or .csv. [string]
+    --wkt: Prints the POLYGON or MULTIPOLYGON WKT of all the polygons
+           instead of the boundary of the first polygon. [flag]
+    --tolerance: Simplification tolerance in degrees. [float]
+    --max-vertices: Max number of vertices, 0 for no cap. [int]
+    --rasterize: Path to the output mask, e.g. masks/{region}_300m.tif.
+                 [string]
+    --res: Resolution of the mask in meters. [float]
+    --grid: Region mask whose grid is used instead of the AOI bounds.
+            [string]
+
+OUTPUTS:
+    boundary: "lon lat,lon lat,..." ring of the first polygon, or the WKT
+              (--wkt), printed. [string]
+    {rasterize}: 1 inside the AOI, 255 (nodata) outside. [.tif]
 """
 
+import argparse
+import hashlib
+import json
+import os
+import sys
+
 import numpy as np
 import pandas as pd
-import json
-import argparse
 
-parser = argparse.ArgumentParser(description='Boundary from file')
-parser.add_argument('file', help='File used to create boundary: csv and geojson extensions implemented')
+cache_folder = './boundary_cache'
+# version of the simplification in the cache file names, not to read the
+# polygons cached by a previous version
+cache_version = 2
+
+# vertices of the data hub query footprints
+max_vertices = 200
 
-args = parser.parse_args()
+# polar stereographic grid of the masks (see dm_stream.region_grid)
+mask_crs = 'EPSG:3413'
+mask_res = 300
+
+
+def read_polygons(file):
+    '''
+    Polygons of an AOI file.
+
+    OUTPUTS:
+        polygons: Rings (exterior first, then holes) of each polygon, closed
+                  (first vertex repeated). [list of lists of (n, 2) arrays]
+    '''
 
-def boundary_from_file(file):
-    
     #extension extraction out of file name
-    extension=file.split('.')[-1]
-    
-    #data loading
-    if extension=='geojson':
-        with open(file,encoding='utf8') as f:
+    extension = file.split('.')[-1]
+
+    if extension == 'geojson':
+        with open(file, encoding='utf8') as f:
             data = json.load(f)
-            coordinates=data['features'][0]['geometry']['coordinates']
-            #check for different coordinates organisation
-            if len(np.shape(coordinates))!=2:
-                coordinates=data['features'][0]['geometry']['coordinates'][0]
-                if len(np.shape(coordinates))!=2:
-                    coordinates=data['features'][0]['geometry']['coordinates'][0][0]
-                
-    elif extension=='csv':
-        coordinates=pd.read_csv(file)
+        if data.get('type') == 'FeatureCollection':
+            geometries = [feature['geometry'] for feature in data['features']]
+        elif data.get('type') == 'Feature':
+            geometries = [data['geometry']]
+        else:
+            geometries = [data]
+        polygons = []
+        while geometries:
+            geometry = geometries.pop(0)
+            if geometry is None:
+                continue
+            if geometry['type'] == 'Polygon':
+                polygons.append(geometry['coordinates'])
+            elif geometry['type'] == 'MultiPolygon':
+                polygons += geometry['coordinates']
+            elif geometry['type'] == 'GeometryCollection':
+                geometries += geometry['geometries']
+    elif extension == 'csv':
+        polygons = [[pd.read_csv(file).iloc[:, :2].values]]
     else:
-        print('ERROR: %s extension not implemented' %extension)
+        print('ERROR: %s extension not implemented' % extension)
+        return []
+
+    closed = []
+    for polygon in polygons:
+        rings = []
+        for ring in polygon:
+            # lon, lat (without elevation)
+            ring = np.asarray(ring, dtype='float64')[:, :2]
+            if not np.array_equal(ring[0], ring[-1]):
+                ring = np.vstack([ring, ring[:1]])
+            rings.append(ring)
+        closed.append(rings)
+
+    return closed
+
+
+def segment_distance(p, a, b):
+    '''
+    Distance of points p to the segments [a, b]. [array]
+    '''
+
+    ab = b - a
+    length2 = np.sum(ab ** 2, axis=1)
+    t = np.sum((p - a) * ab, axis=1) / np.where(length2 > 0, length2, 1)
+    t = np.clip(np.where(length2 > 0, t, 0), 0, 1)
+
+    return np.sqrt(np.sum((p - a - t[:, None] * ab) ** 2, axis=1))
+
+
+def importance(rings):
+    '''
+    Douglas-Peucker tolerance below which each vertex of closed rings is
+    kept, inf for the first vertex of a ring and the one farthest from it.
+    The segments of all the rings are processed level by level, at once.
+
+    OUTPUTS:
+        values: Tolerance of each vertex of each ring. [list of arrays]
+    '''
+
+    if not rings:
+        return []
+
+    # longitudes scaled to the distance of a degree of latitude
+    xy = np.concatenate([ring * [np.cos(np.deg2rad(np.mean(ring[:, 1]))), 1]
+                         for ring in rings])
+    sizes = np.array([len(ring) for ring in rings])
+    firsts = np.cumsum(sizes) - sizes
+    lasts = firsts + sizes - 1
+    values = np.full(len(xy), np.inf)
+
+    # each ring is split in two polylines at the vertex farthest from its
+    # first vertex (rings of less than 5 vertices are kept whole)
+    fars = np.array([first + int(np.argmax(np.sum(
+        (xy[first:last + 1] - xy[first]) ** 2, axis=1)))
+        for first, last in zip(firsts, lasts)])
+    starts = np.concatenate([firsts, fars])
+    ends = np.concatenate([fars, lasts])
+    parents = np.full(len(starts), np.inf)
+    whole = np.tile(sizes >= 5, 2)
+    starts, ends, parents = starts[whole], ends[whole], parents[whole]
+
+    while True:
+        keep = ends - starts > 1
+        starts, ends, parents = starts[keep], ends[keep], parents[keep]
+        if len(starts) == 0:
+            break
+
+        counts = ends - starts - 1
+        offsets = np.cumsum(counts) - counts
+        segment = np.repeat(np.arange(len(starts)), counts)
+        index = np.arange(counts.sum()) - offsets[segment] + starts[segment] + 1
+
+        distance = segment_distance(xy[index], xy[starts[segment]],
+                                    xy[ends[segment]])
+        dmax = np.maximum.reduceat(distance, offsets)
+
+        # first vertex at the max distance of each segment
+        at_max = np.flatnonzero(distance == dmax[segment])
+        first = at_max[np.concatenate(
+            [[True], segment[at_max][1:] != segment[at_max][:-1]])]
+        splits = index[first]
+
+        # a vertex is not kept at a larger tolerance than its parent
+        value = np.minimum(dmax, parents)
+        values[splits] = value
+
+        starts = np.concatenate([starts, splits])
+        ends = np.concatenate([splits, ends])
+        parents = np.concatenate([value, value])
+
+    return np.split(values, np.cumsum(sizes)[:-1])
+
+
+def polygon_area(ring):
+
+    x, y = ring[:, 0], ring[:, 1]
+
+    return abs(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1])) / 2
+
+
+def simplify(polygons, tolerance=0., max_vertices=max_vertices):
+    '''
+    Simplifies the rings of polygons within a tolerance, raised if needed to
+    keep at most max_vertices vertices. Each ring keeps at least 4 distinct
+    vertices plus the closing one (all of them if it has less).
+
+    INPUTS:
+        polygons: Polygons (see read_polygons). [list]
+        tolerance: Simplification tolerance in degrees. [float]
+        max_vertices: Max number of vertices, None or 0 for no cap. [int]
+
+    OUTPUTS:
+        polygons: Simplified polygons. [list]
+    '''
+
+    # largest polygons first, the smallest being dropped to fit the cap
+    polygons = sorted(polygons, key=lambda p: -polygon_area(p[0]))
+    if max_vertices:
+        n_polygons = len(polygons)
+        while len(polygons) > 1 and \
+                sum(min(len(r), 5) for p in polygons for r in p) > max_vertices:
+            polygons = polygons[:-1]
+        if len(polygons) < n_polygons:
+            # on stderr, the boundary being read from stdout
+            print('WARNING: %d smallest polygons dropped to keep %d vertices'
+                  % (n_polygons - len(polygons), max_vertices),
+                  file=sys.stderr)
+
+    if not tolerance and not max_vertices:
+        return polygons
+
+    rings = [ring for polygon in polygons for ring in polygon]
+    values = importance(rings)
+
+    # besides the first, farthest and closing vertices, the two most
+    # important vertices of each ring are kept, not to collapse it
+    for value in values:
+        finite = np.flatnonzero(np.isfinite(value))
+        value[finite[np.argsort(value[finite])[-2:]]] = np.inf
+
+    if max_vertices:
+        all_values = np.concatenate(values)
+        finite = np.sort(all_values[np.isfinite(all_values)])[::-1]
+        budget = max_vertices - int(np.sum(np.isinf(all_values)))
+        if 0 <= budget < len(finite):
+            tolerance = max(tolerance, finite[budget])
+
+    simplified = iter([ring[value > tolerance]
+                       for ring, value in zip(rings, values)])
+
+    return [[next(simplified) for _ in polygon] for polygon in polygons]
+
+
+def file_hash(file):
+
+    with open(file, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def aoi_polygons(file, tolerance=0., max_vertices=max_vertices, cache=True):
+    '''
+    Simplified polygons of an AOI file, cached per file hash and parameters.
+    '''
+
+    cache_file = '%s/%s_%g_%d_v%d.json' % (cache_folder, file_hash(file),
+                                           tolerance, max_vertices or 0,
+                                           cache_version)
+
+    if cache and os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            return [[np.array(ring) for ring in polygon]
+                    for polygon in json.load(f)]
+
+    polygons = simplify(read_polygons(file), tolerance, max_vertices)
+
+    if cache and polygons:
+        os.makedirs(cache_folder, exist_ok=True)
+        with open(cache_file + '.tmp', 'w') as f:
+            json.dump([[ring.tolist() for ring in polygon]
+                       for polygon in polygons], f)
+        os.replace(cache_file + '.tmp', cache_file)
+
+    return polygons
+
+
+def ring_text(ring):
+    '''
+    "lon lat,lon lat,..." of a ring.
+    '''
+
+    text = np.char.mod('%.6f', ring)
+
+    return ','.join(np.char.add(np.char.add(text[:, 0], ' '), text[:, 1]))
+
+
+def to_wkt(polygons):
+    '''
+    POLYGON, or MULTIPOLYGON WKT of several polygons.
+    '''
+
+    texts = ['(%s)' % ','.join('(%s)' % ring_text(ring) for ring in polygon)
+             for polygon in polygons]
+
+    if len(texts) == 1:
+        return 'POLYGON%s' % texts[0]
+
+    return 'MULTIPOLYGON(%s)' % ','.join(texts)
+
+
+def boundary_from_file(file, tolerance=0., max_vertices=max_vertices):
+    '''
+    Boundary of the data hub queries: exterior ring of the first (largest)
+    polygon of an AOI file. [string]
+    '''
+
+    polygons = aoi_polygons(file, tolerance, max_vertices)
+    if not polygons:
         return
-    
-    #boundary initialisation
-    boundary=''
-     
-    #boundary creation out of coordinates
-    if extension=='geojson':
-        for i in range(0,np.shape(coordinates)[0]): 
-            if i==np.shape(coordinates)[0]-1:    
-                boundary=boundary+str(coordinates[i][0])+' '+str(coordinates[i][1])+','
-                boundary=boundary+str(coordinates[0][0])+' '+str(coordinates[0][1])
-            else:
-                boundary=boundary+str(coordinates[i][0])+' '+str(coordinates[i][1])+','
-                
-    if extension=='csv':
-        for i in range(0,coordinates.shape[0]): 
-            if i==coordinates.shape[0]-1:
-                boundary=boundary+str(coordinates.iloc[i][0])+' '+str(coordinates.iloc[i][1])+','
-                boundary=boundary+str(coordinates.iloc[0][0])+' '+str(coordinates.iloc[0][1])
-            else:
-                boundary=boundary+str(coordinates.iloc[i][0])+' '+str(coordinates.iloc[i][1])+','
-            
-    return boundary
-    
-
-boundary=boundary_from_file(args.file)
+
+    return ring_text(polygons[0][0])
+
+
+def rasterize(polygons, out_file, res=mask_res, grid_file=None):
+    '''
+    Writes the AOI mask on a polar stereographic grid: the grid of a region
+    mask (grid_file), or the AOI bounds aligned on the resolution.
+    '''
+
+    import rasterio
+    from rasterio.features import rasterize as rio_rasterize
+    from rasterio.transform import from_origin
+    from rasterio.warp import transform_geom
+
+    geometries = [transform_geom('EPSG:4326', mask_crs, dict(
+        type='Polygon', coordinates=[ring.tolist() for ring in polygon]))
+        for polygon in polygons]
+
+    if grid_file is not None:
+        from dm_stream import region_grid
+        grid = region_grid(grid_file, res)
+    else:
+        xy = np.concatenate([np.array(ring) for g in geometries
+                             for ring in g['coordinates']])
+        left, bottom = np.floor(xy.min(axis=0) / res) * res
+        right, top = np.ceil(xy.max(axis=0) / res) * res
+        grid = dict(crs=mask_crs, transform=from_origin(left, top, res, res),
+                    width=int(round((right - left) / res)),
+                    height=int(round((top - bottom) / res)))
+
+    mask = rio_rasterize(geometries, out_shape=(grid['height'], grid['width']),
+                         transform=grid['transform'], fill=255,
+                         default_value=1, dtype='uint8')
+
+    with rasterio.open(out_file, 'w', driver='GTiff', dtype='uint8',
+                       nodata=255, count=1, compress='DEFLATE', **grid) as dst:
+        dst.write(mask, 1)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Boundary from file')
+    parser.add_argument('file', help='File used to create boundary: csv and geojson extensions implemented')
+    parser.add_argument('--wkt', action='store_true',
+                        help='print the WKT of all the polygons')
+    parser.add_argument('--tolerance', type=float, default=0.,
+                        help='simplification tolerance in degrees')
+    parser.add_argument('--max-vertices', type=int, default=max_vertices,
+                        help='max number of vertices, 0 for no cap')
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--rasterize', default=None,
+                        help='output mask, e.g. masks/{region}_300m.tif')
+    parser.add_argument('--res', type=float, default=mask_res)
+    parser.add_argument('--grid', default=None,
+                        help='region mask whose grid is used')
+    args = parser.parse_args()
+
+    if args.rasterize is not None:
+        # the mask keeps the detail of the AOI, without vertex cap
+        rasterize(aoi_polygons(args.file, args.tolerance, 0,
+                               cache=not args.no_cache),
+                  args.rasterize, args.res, args.grid)
+    else:
+        polygons = aoi_polygons(args.file, args.tolerance, args.max_vertices,
+                                cache=not args.no_cache)
+        if polygons:
+            print(to_wkt(polygons) if args.wkt
+                  else ring_text(polygons[0][0]))
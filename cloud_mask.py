@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Post-processing of the Simple Cloud Detection Algorithm (SCDA) results,
+run on each scene within SCDA.py. NumPy/scipy.ndimage implementation of the
+GRASS morphology previously done in dm.grass.sh:
+
+    r.grow input=SCDA_v20 output=SCDA_grow radius=-5
+    r.clump -d input=SCDA_grow output=SCDA_clump
+    r.reclass.area input=SCDA_clump output=SCDA_area value=10000 mode=greater
+    SCDA_final = if((isnull(SCDA_area) && (MASK == 220))
+                    || (isnull(SCDA_v20) && (MASK != 220)), null(), 1)
+    SZA_CM = if(not(isnull(SZA)) & SCDA_final, 1, null())
+
+OUTPUTS:
+    {scene}/SCDA_final.tif: clear=1, cloud=NaN. [.tif]
+    {scene}/SZA_CM.tif: 1 where SZA is valid and clear, NaN otherwise. [.tif]
+
+"""
+
+import os
+
+import numpy as np
+import rasterio
+from rasterio.errors import RasterioIOError
+from scipy import ndimage
+
+from dm_stream import read_on_grid
+
+# permanent snow and ice class of the ESA CCI land cover masks
+ice_class = 220
+
+# clouds are grown by grow_radius pixels
+grow_radius = 5
+
+# clear clumps smaller than min_area (hectares) are removed over ice
+min_area = 10000
+
+
+def grow_clouds(clear, radius=grow_radius):
+    '''
+    Grows clouds (non-clear pixels) by radius pixels, Euclidean distance
+    (r.grow radius=-radius).
+
+    INPUTS:
+        clear: True for clear pixels. [boolean array]
+        radius: Growing radius in pixels. [float]
+
+    OUTPUTS:
+        clear pixels farther than radius from a cloud. [boolean array]
+    '''
+
+    if clear.all():
+        return clear.copy()
+
+    # distance of each clear pixel to the nearest cloud pixel
+    distance = ndimage.distance_transform_edt(clear)
+
+    return clear & (distance > radius)
+
+
+def remove_small_clumps(clear, min_pixels):
+    '''
+    Labels connected clear regions, diagonals included (r.clump -d), and
+    keeps the clumps with more than min_pixels pixels
+    (r.reclass.area mode=greater).
+
+    INPUTS:
+        clear: True for clear pixels. [boolean array]
+        min_pixels: Area threshold in pixels. [float]
+
+    OUTPUTS:
+        clear pixels of the large enough clumps. [boolean array]
+    '''
+
+    clumps, n_clumps = ndimage.label(clear, structure=np.ones((3, 3)))
+
+    if n_clumps == 0:
+        return clear.copy()
+
+    area = np.bincount(clumps.ravel())
+    keep = area > min_pixels
+    keep[0] = False
+
+    return keep[clumps]
+
+
+def SCDA_final(scda_v20, mask, res, radius=grow_radius, area_ha=min_area):
+    '''
+    Final cloud mask: clouds buffered and small clear clumps removed over
+    ice (MASK == 220), raw SCDA v2.0 results elsewhere.
+
+    INPUTS:
+        scda_v20: SCDA v2.0 results, clear=1, cloud=255 or NaN. [array]
+        mask: Region mask on the same grid, NaN outside the region. [array]
+        res: Pixel size in meters. [float]
+        radius: Cloud growing radius in pixels. [float]
+        area_ha: Minimum area of clear clumps over ice in hectares. [float]
+
+    OUTPUTS:
+        scda_final: clear=1, cloud or outside region=NaN. [array]
+    '''
+
+    clear = scda_v20 == 1
+
+    # hectares to pixels
+    min_pixels = area_ha / (res * res / 1e4)
+    clear_area = remove_small_clumps(grow_clouds(clear, radius), min_pixels)
+
+    ice = mask == ice_class
+    valid = np.where(ice, clear_area, clear) & ~np.isnan(mask)
+
+    return np.where(valid, 1, np.nan).astype('float32')
+
+
+def SZA_CM(sza, scda_final):
+    '''
+    SZA cloud mask: 1 where SZA is valid and the pixel is clear.
+    '''
+
+    return np.where(~np.isnan(sza) & (scda_final == 1),
+                    1, np.nan).astype('float32')
+
+
+def process_scene(scene_folder, scda_v20, profile):
+    '''
+    Computes and writes SCDA_final and SZA_CM for a scene, on the grid of
+    the SCDA v2.0 results.
+
+    INPUTS:
+        scene_folder: Path to the scene folder containing mask.tif and
+                      SZA.tif. [string]
+        scda_v20: SCDA v2.0 results, clear=1, cloud=255. [array]
+        profile: Profile of the SCDA v2.0 results. [rasterio.profiles.Profile]
+
+    OUTPUTS:
+        scda_final, sza_cm: see SCDA_final and SZA_CM. [arrays]
+        {scene_folder}/SCDA_final.tif, {scene_folder}/SZA_CM.tif [.tif]
+    '''
+
+    grid = dict(crs=profile['crs'], transform=profile['transform'],
+                width=profile['width'], height=profile['height'])
+
+    try:
+        mask = read_on_grid(scene_folder + os.sep + 'mask.tif', grid)
+        sza = read_on_grid(scene_folder + os.sep + 'SZA.tif', grid)
+    except RasterioIOError as e:
+        print('ERROR: %s' % e)
+        return None, None
+
+    # mask.tif is 0 or nodata outside the region
+    mask[mask == 0] = np.nan
+
+    scda_final = SCDA_final(scda_v20, mask, res=abs(profile['transform'].a))
+    sza_cm = SZA_CM(sza, scda_final)
+
+    profile_out = profile.copy()
+    profile_out.update(dtype=rasterio.float32, nodata=np.nan, count=1)
+
+    for var, var_name in zip([scda_final, sza_cm], ['SCDA_final', 'SZA_CM']):
+        with rasterio.open(scene_folder + os.sep + var_name + '.tif', 'w',
+                           **profile_out) as dst:
+            dst.write(var, 1)
+
+    return scda_final, sza_cm
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Benchmark of the GeoTIFF codecs of the SICE outputs (see sice_codecs.py).
+
+Each product of an output folder is written with each codec, with the layout
+(strips or tiles) of the original file, then read back. The write and read
+times (best of --repeat runs), the file size and the max absolute error
+(LERC codecs, within the error budget of the product) are reported per
+product and per codec, the sizes relative to the uncompressed files.
+A fast codec with a fair ratio suits the NRT processing, the smallest
+files within the error budgets the archive.
+
+INPUTS:
+    folder: Path to a folder of SICE outputs (sice.py). [string]
+    --codecs: Codecs to compare, [codec][:level][@max_error] (see
+              sice_codecs.py). [strings]
+    --products: Patterns of the products. [strings]
+    --repeat: Runs of each write and read. [int]
+    --out: Path to the csv of the results per product. [string]
+
+OUTPUTS:
+    {out}: codec, product, size, ratio, write_s, read_s, max_error, budget.
+           [.csv]
+    Summary per codec, printed.
+
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+from fnmatch import fnmatch
+
+import numpy as np
+import rasterio as rio
+
+from sice_codecs import output_profile, parse
+
+candidates = ['none', 'deflate', 'deflate_fp', 'deflate_fp:9', 'zstd:1',
+              'zstd:9', 'zstd:15', 'lerc', 'lerc_deflate', 'lerc_zstd:9']
+
+products = ['albedo_*', 'rBRR_*', 'grain_diameter',
+            'snow_specific_surface_area', 'al', 'r0', 'conc', 'O3_SICE',
+            'diagnostic_retrieval']
+
+
+def timed(f, repeat):
+    '''
+    Best time of repeated calls, and the result of the last call.
+    '''
+
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f()
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+def benchmark(filename, codec, tmp_folder, repeat=3):
+    '''
+    Writes and reads a product with a codec.
+
+    OUTPUTS:
+        result: size (bytes), write_s, read_s, max_error, the error budget
+                of the codec and whether the error is within the budget, up
+                to the float32 rounding of the values. [dict]
+    '''
+
+    name = os.path.basename(filename)[:-4]
+
+    with rio.open(filename) as src:
+        data = src.read(1)
+        profile = output_profile(src.profile, name, parse([codec]))
+
+    tmp_file = tmp_folder + os.sep + name + '.tif'
+
+    def write():
+        with rio.open(tmp_file, 'w', **profile) as dst:
+            dst.write(data, 1)
+
+    def read():
+        with rio.open(tmp_file) as src:
+            return src.read(1)
+
+    write_s, _ = timed(write, repeat)
+    read_s, values = timed(read, repeat)
+
+    if np.array_equal(np.isnan(values), np.isnan(data)):
+        error = float(np.nanmax(np.abs(values - data), initial=0))
+    else:
+        # NaN not preserved
+        error = np.inf
+
+    budget = profile.get('max_z_error', 0)
+    rounding = float(np.spacing(np.nanmax(np.abs(data), initial=0)))
+
+    result = dict(size=os.path.getsize(tmp_file), write_s=write_s,
+                  read_s=read_s, max_error=error, budget=budget,
+                  within=error <= budget + rounding)
+    os.remove(tmp_file)
+
+    return result
+
+
+def run(folder, codecs=candidates, patterns=products, repeat=3):
+    '''
+    Benchmark of the codecs on the products of a folder.
+
+    OUTPUTS:
+        results: (codec, product, result) of each codec and product. [list]
+    '''
+
+    filenames = [f for f in sorted(glob.glob(folder + os.sep + '*.tif'))
+                 if any(fnmatch(os.path.basename(f)[:-4], pattern)
+                        for pattern in patterns)]
+    if not filenames:
+        print('ERROR: no product of %s in %s' % (', '.join(patterns), folder))
+        return []
+
+    results = []
+    tmp_folder = tempfile.mkdtemp(dir=folder)
+    try:
+        for codec in codecs:
+            for filename in filenames:
+                results.append((codec, os.path.basename(filename)[:-4],
+                                benchmark(filename, codec, tmp_folder,
+                                          repeat)))
+    finally:
+        shutil.rmtree(tmp_folder)
+
+    return results
+
+
+def summary(results):
+    '''
+    Prints the totals of each codec, the sizes relative to the first codec
+    (uncompressed by default).
+    '''
+
+    codecs = list(dict.fromkeys(codec for codec, _, _ in results))
+    totals = {codec: {key: sum(r[key] for c, _, r in results if c == codec)
+                      for key in ['size', 'write_s', 'read_s']}
+              for codec in codecs}
+    reference = totals[codecs[0]]['size']
+
+    print('%-14s %10s %7s %9s %9s %10s %7s' % (
+        'codec', 'MB', 'ratio', 'write s', 'read s', 'max error', 'budget'))
+    for codec in codecs:
+        total = totals[codec]
+        error = max(r['max_error'] for c, _, r in results if c == codec)
+        within = all(r['within'] for c, _, r in results if c == codec)
+        print('%-14s %10.2f %7.2f %9.3f %9.3f %10.2e %7s' % (
+            codec, total['size'] / 1e6, reference / total['size'],
+            total['write_s'], total['read_s'], error,
+            'ok' if within else 'EXCEEDED'))
+
+
+def write_csv(results, filename):
+
+    reference = {product: r['size'] for c, product, r in results
+                 if c == results[0][0]}
+
+    with open(filename, 'w') as f:
+        f.write('codec,product,size,ratio,write_s,read_s,max_error,'
+                'budget\n')
+        for codec, product, r in results:
+            f.write('%s,%s,%d,%.3f,%.4f,%.4f,%.3e,%.3e\n' % (
+                codec, product, r['size'], reference[product] / r['size'],
+                r['write_s'], r['read_s'], r['max_error'], r['budget']))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('folder')
+    parser.add_argument('--codecs', nargs='+', default=candidates)
+    parser.add_argument('--products', nargs='+', default=products)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--out', default=None,
+                        help='csv of the results per product')
+    args = parser.parse_args()
+
+    start_time = time.time()
+
+    results = run(args.folder, args.codecs, args.products, args.repeat)
+    if results:
+        summary(results)
+        if args.out is not None:
+            write_csv(results, args.out)
+
+    print('End codec_benchmark.py %s --- %s seconds ---'
+          % (args.folder, time.time() - start_time))
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Cloud-optimized GeoTIFF (COG) writer of the SICE products and mosaics.
+
+The files are tiled (512 x 512), DEFLATE compressed with the floating point
+predictor for float32 bands (horizontal differencing for integer bands), or
+with the ZSTD or LERC codec of the profile (see sice_codecs.py), and carry
+internal overviews down to one block, stored before the full resolution
+data. A zoomed-out view or a thumbnail of a region therefore only reads a
+few tiles.
+
+The overviews are computed in memory by successive 2 x 2 decimation of the
+array being written, each level from the previous one (NaN-aware mean for
+float bands, nearest for integer bands), then written in the overview
+levels of a temporary in-memory file copied to the COG layout. There is no
+separate gdaladdo pass on the written file.
+
+INPUTS:
+    files: GeoTIFF files to convert to COG, in place. [strings]
+
+OUTPUTS:
+    {file}: COG. [.tif]
+
+"""
+
+import argparse
+import os
+import time
+import warnings
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.io import MemoryFile
+from rasterio.shutil import copy as rio_copy
+
+blocksize = 512
+
+
+def cog_profile(profile):
+    '''
+    Creation options of a COG from a rasterio profile.
+    '''
+
+    floating = np.dtype(profile['dtype']).kind == 'f'
+
+    # other codecs (ZSTD, LERC) keep their options
+    codec = {}
+    if str(profile.get('compress', 'DEFLATE')).upper() == 'DEFLATE':
+        codec = dict(compress='DEFLATE', predictor=3 if floating else 2)
+
+    return dict(profile, driver='GTiff', tiled=True, blockxsize=blocksize,
+                blockysize=blocksize, interleave='band', BIGTIFF='IF_SAFER',
+                **codec)
+
+
+def overview_factors(width, height):
+    '''
+    Decimation factors of the overviews, until the overview fits in one
+    block.
+    '''
+
+    factors = []
+    factor = 2
+    while max(width, height) / (factor // 2) > blocksize:
+        factors.append(factor)
+        factor *= 2
+
+    return factors
+
+
+def decimate(data):
+    '''
+    2 x 2 decimation of an array: NaN-aware mean for float arrays, nearest
+    for integer arrays.
+    '''
+
+    if data.dtype.kind != 'f':
+        return data[::2, ::2]
+
+    # odd sizes are padded with NaN
+    height, width = -(-data.shape[0] // 2) * 2, -(-data.shape[1] // 2) * 2
+    padded = np.full((height, width), np.nan, dtype=data.dtype)
+    padded[:data.shape[0], :data.shape[1]] = data
+    blocks = padded.reshape(height // 2, 2, width // 2, 2)
+
+    with warnings.catch_warnings():
+        # mean of empty blocks
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.nanmean(blocks, axis=(1, 3)).astype(data.dtype)
+
+
+def write_cog(filename, data, profile):
+    '''
+    Writes a 2D array as a COG.
+
+    INPUTS:
+        filename: Path to the output file. [string]
+        data: Band values. [2D array]
+        profile: rasterio profile (crs, transform, dtype, nodata...). [dict]
+    '''
+
+    data = np.asarray(data, dtype=profile['dtype'])
+    factors = overview_factors(data.shape[1], data.shape[0])
+
+    mem_profile = dict(profile, driver='GTiff', count=1, height=data.shape[0],
+                       width=data.shape[1], tiled=True,
+                       blockxsize=blocksize, blockysize=blocksize)
+    for key in ['compress', 'predictor', 'zlevel', 'zstd_level',
+                'max_z_error', 'num_threads', 'interleave', 'BIGTIFF']:
+        mem_profile.pop(key, None)
+
+    with MemoryFile() as memfile:
+        with memfile.open(**mem_profile) as mem:
+            mem.write(data, 1)
+            if factors:
+                # allocates the overview levels, overwritten below
+                mem.build_overviews(factors, Resampling.nearest)
+
+        overview = data
+        for level in range(len(factors)):
+            overview = decimate(overview)
+            # overview levels are the next TIFF directories
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', NotGeoreferencedWarning)
+                with rasterio.open('GTIFF_DIR:%d:%s' % (level + 2,
+                                                        memfile.name),
+                                   'r+') as dst:
+                    dst.write(overview[:dst.height, :dst.width], 1)
+
+        options = cog_profile(profile)
+        for key in ['driver', 'crs', 'transform', 'width', 'height', 'count',
+                    'dtype', 'nodata']:
+            options.pop(key, None)
+
+        tmp_file = filename + '.tmp.tif'
+        rio_copy(memfile.name, tmp_file, driver='GTiff',
+                 copy_src_overviews=True, **options)
+        os.replace(tmp_file, filename)
+
+
+def convert(filename):
+    '''
+    Converts a GeoTIFF to COG, in place.
+    '''
+
+    with rasterio.open(filename) as src:
+        data = src.read(1)
+        profile = src.profile
+
+    write_cog(filename, data, profile)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='+')
+    args = parser.parse_args()
+
+    start_time = time.time()
+
+    for filename in args.files:
+        convert(filename)
+
+    print('End cog.py %d files --- %s seconds ---'
+          % (len(args.files), time.time() - start_time))
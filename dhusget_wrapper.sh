@@ -172,8 +172,9 @@ if [[ -z ${path_product_list:-} ]]; then
 	elif [[ ${footprint} == "AlaskaYukon" ]]; then
 		footprint_poly="footprint:\"Intersects(POLYGON((-153.443453 59.371565,-155.758468 59.983386,-155.849887 62.149612,-149.612619 64.317909,-144.046921 64.090493,-132.520688 60.004403,-127.994321 55.260251,-130.140189 54.742974,-134.865137 57.917908,-137.747917 58.366708,-140.962528 59.595609,-145.794814 60.095665, -150.979670 58.572775, -153.443453 59.371565)))\""
 	else
-		boundary=$(boundary_from_file.py ${footprint})
-		footprint_poly="footprint:\"Intersects(POLYGON((${boundary})))\""
+		# all the polygons of the AOI file, simplified to a short query
+		aoi_wkt=$(python ./boundary_from_file.py --wkt ${footprint})
+		footprint_poly="footprint:\"Intersects(${aoi_wkt})\""
 	fi
 	debug "Footprint ${footprint} is: ${footprint_poly}"
 
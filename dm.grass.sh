@@ -53,6 +53,7 @@ scene=$(echo ${scenes} | tr ' ' '\n' | head -n3 | tail -n1) # DEBUG
 for scene in ${scenes}; do
 	g.mapset -c ${scene} --q
 	g.region -d --q
+	# SCDA_final and SZA_CM (buffered cloud mask) computed in SCDA.py (cloud_mask.py)
 	files=$(ls ${infolder}/${scene}/*.tif || true)
 	if [[ -z ${files} ]]; then
 		log_err "No files: ${scene}"
@@ -60,18 +61,6 @@ for scene in ${scenes}; do
 	fi
 	log_info "Importing rasters: ${scene}"
 	parallel -j 1 "r.external source={} output={/.} --q" ::: ${files}
-
-	log_info "Masking clouds in SZA raster"
-	r.grow input=SCDA_v20 output=SCDA_grow radius=-5 new=-1 --q # increase clouds by 5 pixels
-	# remove small clusters of isolated pixels
-	r.clump -d input=SCDA_grow output=SCDA_clump --q
-	# frink "(1000 m)^2 -> hectares" 100 hectares per pixel, so value=10000 -> 10 pixels
-	# this sometimes fails. Force success (||true) and check for failure on next line.
-	r.reclass.area -c input=SCDA_clump output=SCDA_area value=10000 mode=greater --q || true
-	[[ "" == $(g.list type=raster pattern=SCDA_area) ]] && r.mapcalc "SCDA_area = null()" --q
-	# SZA_CM is SZA but Cloud Masked: Invalid where buffered clouds over ice w/ valid SZA
-	r.mapcalc "SCDA_final = if((isnull(SCDA_area) && (MASK@PERMANENT == 220)) || (isnull(SCDA_v20) && (MASK@PERMANENT != 220)), null(), 1)" --q
-	r.mapcalc "SZA_CM = if(not(isnull(SZA)) & SCDA_final, 1, null())" --q
 done
 
 # Bands for which invalid pixels are kept (r_TOA and BT)
@@ -100,10 +89,7 @@ r_TOA_S1
 r_TOA_S5
 r_TOA_S5_rc
 SAA
-SCDA_area
-SCDA_clump
 SCDA_final
-SCDA_grow
 SCDA_v20
 SZA
 SZA_CM
@@ -177,21 +163,30 @@ mapset_list=$(g.mapsets --q -l separator=newline | grep T | tr '\n' ',' | sed 's
 raster_list=$(g.list type=raster pattern=r_TOA_01 mapset=${mapset_list} separator=comma)
 r.series input=${raster_list} method=count output=num_scenes --q
 
-bandsFloat32="$(g.list type=raster pattern="r_TOA_*") SZA SZA_CM SAA OZA OAA WV O3 NDSI BT_S7 BT_S8 BT_S9 r_TOA_S5 r_TOA_S5_rc r_TOA_S1 height SCDA_v20 SCDA_grow SCDA_clump SCDA_area SCDA_final"
+bandsFloat32="$(g.list type=raster pattern="r_TOA_*") SZA SZA_CM SAA OZA OAA WV O3 NDSI BT_S7 BT_S8 BT_S9 r_TOA_S5 r_TOA_S5_rc r_TOA_S1 height SCDA_v20 SCDA_final"
 bandsInt16="sza_lut num_scenes num_scenes_cloudfree"
 log_info "Writing mosaics to disk..."
 
-tifopts='type=Float32 createopt=COMPRESS=DEFLATE,PREDICTOR=2,TILED=YES --q --o'
+# codec of the Float32 mosaics, e.g. SICE_TIF_CODEC=COMPRESS=ZSTD,PREDICTOR=3
+# (see codec_benchmark.py), compressed with all the CPUs
+tif_codec=${SICE_TIF_CODEC:-COMPRESS=DEFLATE,PREDICTOR=2},NUM_THREADS=ALL_CPUS
+
+tifopts="type=Float32 createopt=${tif_codec},TILED=YES --q --o"
 parallel -j 1 "r.colors map={} color=grey --q" ::: ${bandsFloat32} # grayscale
 parallel -j 1 "r.null map={} setnull=inf --q" ::: ${bandsFloat32}  # set inf to null
 parallel "r.out.gdal -m -c input={} output=${outfolder}/${date}/{}.tif ${tifopts}" ::: ${bandsFloat32}
 
-tifopts='type=Int16 createopt=COMPRESS=DEFLATE,PREDICTOR=2,TILED=YES --q --o'
+tifopts='type=Int16 createopt=COMPRESS=DEFLATE,PREDICTOR=2,NUM_THREADS=ALL_CPUS,TILED=YES --q --o'
 parallel "r.out.gdal -m -c input={} output=${outfolder}/${date}/{}.tif ${tifopts}" ::: ${bandsInt16}
 
 # Generate some extra rasters
-tifopts='type=Float32 createopt=COMPRESS=DEFLATE,PREDICTOR=2,TILED=YES --q --o'
+tifopts="type=Float32 createopt=${tif_codec},TILED=YES --q --o"
 r.mapcalc "ndbi = ( r_TOA_01 - r_TOA_21 ) / ( r_TOA_01 + r_TOA_21 )"
 r.mapcalc "bba_emp = (r_TOA_01 + r_TOA_06 + r_TOA_17 + r_TOA_21) / 4.0 * 1.003 + 0.058"
 r.out.gdal -f -m -c input=ndbi output=${outfolder}/${date}/NDBI.tif ${tifopts}
 r.out.gdal -f -m -c input=bba_emp output=${outfolder}/${date}/BBA_emp.tif ${tifopts}
+
+if [[ ${SICE_COG:-} ]]; then
+	# cloud-optimized GeoTIFFs, with overviews computed by cog.py
+	python ./cog.py ${outfolder}/${date}/*.tif
+fi
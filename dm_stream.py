@@ -0,0 +1,526 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Incremental daily mosaic. Counterpart of dm.sh/dm.grass.sh that updates the
+daily composite of a region scene by scene instead of rebuilding it from
+all the scenes of the day.
+
+For each region-day, the mosaic folder holds the running composite. A newly
+processed scene only replaces the pixels where it offers a lower SZA than the
+current mosaic, cloud-free pixels always winning over cloudy ones. The
+source scene index (sza_lut) and the scene counts (num_scenes,
+num_scenes_cloudfree) are updated in place, within the footprint of the
+scene only. Scenes already in the mosaic are skipped, so the script can be
+called every time a new scene arrives.
+
+INPUTS:
+    date: Date of the mosaic (YYYY-MM-DD). [string]
+    infolder: Path to the folder of a given date containing processed scenes
+              (output of S3_proc.sh and SCDA.py). [string]
+    outfolder: Path to the mosaic root folder. [string]
+
+OUTPUTS:
+    {outfolder}/{date}/{band}.tif: mosaic of each band. [.tif]
+    {outfolder}/{date}/sza_lut.tif: index of the scene used for each
+                                    pixel. [.tif]
+    {outfolder}/{date}/num_scenes.tif: number of valid scenes. [.tif]
+    {outfolder}/{date}/num_scenes_cloudfree.tif: number of cloud-free
+                                                 scenes. [.tif]
+    {outfolder}/{date}/scenes_lut.csv: scene name of each index in
+                                       sza_lut. [.csv]
+
+"""
+
+import argparse
+import fcntl
+import os
+import re
+import time
+from functools import lru_cache
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.warp import reproject, transform_bounds, Resampling
+from rasterio.windows import Window, from_bounds
+from rasterio.windows import transform as window_transform
+
+# bands patched from the selected scene (as in dm.grass.sh)
+bands_float32 = ['SZA', 'SZA_CM', 'SAA', 'OZA', 'OAA', 'WV', 'O3', 'NDSI',
+                 'BT_S7', 'BT_S8', 'BT_S9', 'r_TOA_S1', 'r_TOA_S5',
+                 'r_TOA_S5_rc', 'height', 'SCDA_v20', 'SCDA_final', 'mask'] \
+    + ['r_TOA_' + str(i + 1).zfill(2) for i in range(21)]
+
+bands_int16 = ['sza_lut', 'num_scenes', 'num_scenes_cloudfree']
+
+# SZA offset given to cloudy pixels so that any cloud-free SZA is preferred
+cloud_penalty = 1000.
+
+tifopts = dict(driver='GTiff', compress='DEFLATE', predictor=2, tiled=True,
+               blockxsize=256, blockysize=256)
+
+
+@lru_cache(maxsize=None)
+def region_grid(mask_file, res):
+    '''
+    Defines the grid of a region from its mask, aligned on the resolution
+    (equivalent of "g.region raster=MASK; g.region res={res} -a").
+
+    INPUTS:
+        mask_file: Path to the region mask. [string]
+        res: Grid resolution in meters. [float]
+
+    OUTPUTS:
+        grid: crs, transform, width and height of the region grid. [dict]
+    '''
+
+    with rasterio.open(mask_file) as src:
+        left, bottom, right, top = src.bounds
+        crs = src.crs
+
+    left = np.floor(left / res) * res
+    bottom = np.floor(bottom / res) * res
+    right = np.ceil(right / res) * res
+    top = np.ceil(top / res) * res
+
+    return dict(crs=crs,
+                transform=from_origin(left, top, res, res),
+                width=int(round((right - left) / res)),
+                height=int(round((top - bottom) / res)))
+
+
+def window_grid(grid, window):
+    '''
+    Sub-grid of a region grid covered by a window.
+
+    INPUTS:
+        grid: Region grid (see region_grid). [dict]
+        window: Window of the region grid. [rasterio.windows.Window]
+
+    OUTPUTS:
+        sub-grid with the same keys as grid. [dict]
+    '''
+
+    return dict(crs=grid['crs'],
+                transform=window_transform(window, grid['transform']),
+                width=int(window.width), height=int(window.height))
+
+
+def grid_window(grid, sub_grid):
+    '''
+    Window of a region grid covered by one of its sub-grids (inverse of
+    window_grid).
+
+    INPUTS:
+        grid: Region grid (see region_grid). [dict]
+        sub_grid: Sub-grid aligned on the region grid. [dict]
+
+    OUTPUTS:
+        window: Window of the region grid. [rasterio.windows.Window]
+    '''
+
+    col_off, row_off = ~grid['transform'] * (sub_grid['transform'].c,
+                                             sub_grid['transform'].f)
+
+    return Window(int(round(col_off)), int(round(row_off)),
+                  sub_grid['width'], sub_grid['height'])
+
+
+def read_on_grid(filename, grid, dtype='float32'):
+    '''
+    Reads a raster and resamples it (nearest neighbour) on a given grid.
+    Nodata pixels are set to NaN.
+
+    INPUTS:
+        filename: Path to the raster. [string]
+        grid: Destination grid (see region_grid). [dict]
+
+    OUTPUTS:
+        data: raster on the grid. [array]
+    '''
+
+    data = np.full((grid['height'], grid['width']), np.nan, dtype=dtype)
+
+    with rasterio.open(filename) as src:
+        reproject(source=rasterio.band(src, 1), destination=data,
+                  src_nodata=src.nodata, dst_transform=grid['transform'],
+                  dst_crs=grid['crs'], dst_nodata=np.nan,
+                  resampling=Resampling.nearest)
+
+    return data
+
+
+def bounds_window(bounds, crs, grid):
+    '''
+    Window of the region grid covering given bounds, clipped to the region,
+    None if the bounds are outside the region.
+
+    INPUTS:
+        bounds: left, bottom, right, top. [tuple]
+        crs: Coordinate reference system of the bounds. [rasterio.crs.CRS]
+        grid: Region grid (see region_grid). [dict]
+
+    OUTPUTS:
+        window: Window of the region grid. [rasterio.windows.Window]
+    '''
+
+    bounds = transform_bounds(crs, grid['crs'], *bounds)
+    window = from_bounds(*bounds, transform=grid['transform'])
+
+    col_start = max(int(np.floor(window.col_off)), 0)
+    row_start = max(int(np.floor(window.row_off)), 0)
+    col_stop = min(int(np.ceil(window.col_off + window.width)), grid['width'])
+    row_stop = min(int(np.ceil(window.row_off + window.height)),
+                   grid['height'])
+
+    if col_stop <= col_start or row_stop <= row_start:
+        return None
+
+    return Window(col_start, row_start, col_stop - col_start,
+                  row_stop - row_start)
+
+
+def scene_window(scene_folder, grid):
+    '''
+    Window of the region grid covered by a scene (equivalent of
+    "g.region zoom=SZA"), None if the scene is outside the region.
+
+    INPUTS:
+        scene_folder: Path to the scene folder. [string]
+        grid: Region grid (see region_grid). [dict]
+
+    OUTPUTS:
+        window: Window of the region grid. [rasterio.windows.Window]
+    '''
+
+    with rasterio.open(scene_folder + os.sep + 'SZA.tif') as src:
+        return bounds_window(src.bounds, src.crs, grid)
+
+
+def scene_clear(scene):
+    '''
+    Cloud-free pixels of a scene, from the final cloud mask computed in
+    SCDA.py (see cloud_mask.py) or else from the SCDA v2.0 results
+    (clear=1, cloud=255 i.e. NaN once read).
+
+    INPUTS:
+        scene: Scene bands on the grid. [dict of arrays]
+
+    OUTPUTS:
+        clear: True for cloud-free pixels. [boolean array]
+    '''
+
+    if 'SCDA_final' in scene:
+        return scene['SCDA_final'] == 1
+
+    if 'SCDA_v20' not in scene:
+        return np.zeros_like(scene['SZA'], dtype=bool)
+
+    return scene['SCDA_v20'] == 1
+
+
+def init_state(shape, bands):
+    '''
+    Creates an empty mosaic state.
+
+    INPUTS:
+        shape: Shape of the mosaic. [tuple]
+        bands: Float bands of the mosaic. [list]
+
+    OUTPUTS:
+        state: Empty mosaic bands. [dict of arrays]
+    '''
+
+    state = {b: np.full(shape, np.nan, dtype='float32') for b in bands}
+    state['sza_lut'] = np.full(shape, -1, dtype='int16')
+    state['num_scenes'] = np.zeros(shape, dtype='int16')
+    state['num_scenes_cloudfree'] = np.zeros(shape, dtype='int16')
+
+    return state
+
+
+def composite(state, scene, index, region_mask=None):
+    '''
+    Updates a mosaic with a new scene, in place. A pixel is taken from the
+    scene if it has a lower SZA than the mosaic, cloud-free pixels being
+    always preferred over cloudy ones.
+
+    INPUTS:
+        state: Mosaic bands, modified in place (see init_state). [dict of arrays]
+        scene: Scene bands on the same grid as the mosaic. [dict of arrays]
+        index: Index of the scene in the mosaic look-up table. [int]
+        region_mask: True inside the region, None for no mask. [boolean array]
+
+    OUTPUTS:
+        update: True for the pixels taken from the scene. [boolean array]
+    '''
+
+    sza = scene['SZA']
+    valid = ~np.isnan(sza)
+    if region_mask is not None:
+        valid &= region_mask
+    clear = scene_clear(scene) & valid
+
+    key_new = np.where(valid, sza + cloud_penalty * ~clear, np.inf)
+
+    # cloud-free status of the current mosaic, recovered from SZA_CM
+    mosaic_clear = state['SZA_CM'] == 1
+    key_old = np.where(np.isnan(state['SZA']), np.inf,
+                       state['SZA'] + cloud_penalty * ~mosaic_clear)
+
+    update = key_new < key_old
+
+    scene = dict(scene)
+    scene['SZA_CM'] = np.where(clear, 1, np.nan).astype('float32')
+
+    for band in state:
+        if band in bands_int16:
+            continue
+        if band in scene:
+            state[band][update] = scene[band][update]
+        else:
+            state[band][update] = np.nan
+
+    state['sza_lut'][update] = index
+
+    if 'r_TOA_01' in scene:
+        state['num_scenes'] += (~np.isnan(scene['r_TOA_01']) & valid)
+    else:
+        state['num_scenes'] += valid
+    state['num_scenes_cloudfree'] += clear
+
+    return update
+
+
+def derived_bands(state):
+    '''
+    Normalized Difference Blue ice Index and empirical BroadBand Albedo
+    (as in dm.grass.sh).
+
+    INPUTS:
+        state: Mosaic bands. [dict of arrays]
+
+    OUTPUTS:
+        derived: NDBI and BBA_emp. [dict of arrays]
+    '''
+
+    derived = {}
+
+    if 'r_TOA_01' in state and 'r_TOA_21' in state:
+        derived['NDBI'] = (state['r_TOA_01'] - state['r_TOA_21']) \
+            / (state['r_TOA_01'] + state['r_TOA_21'])
+
+    if all('r_TOA_' + b in state for b in ['01', '06', '17', '21']):
+        derived['BBA_emp'] = (state['r_TOA_01'] + state['r_TOA_06']
+                              + state['r_TOA_17'] + state['r_TOA_21']) \
+            / 4.0 * 1.003 + 0.058
+
+    return derived
+
+
+def read_scene(scene_folder, grid):
+    '''
+    Loads the bands of a scene on a grid.
+
+    INPUTS:
+        scene_folder: Path to the scene folder. [string]
+        grid: Destination grid. [dict]
+
+    OUTPUTS:
+        scene: Scene bands. [dict of arrays]
+    '''
+
+    scene = {}
+
+    for band in bands_float32:
+        filename = scene_folder + os.sep + band + '.tif'
+        if os.path.isfile(filename):
+            scene[band] = read_on_grid(filename, grid)
+
+    return scene
+
+
+def read_lut(mosaic_folder):
+    '''
+    Lists the scenes already in a mosaic, in index order.
+    '''
+
+    filename = mosaic_folder + os.sep + 'scenes_lut.csv'
+
+    if not os.path.isfile(filename):
+        return []
+
+    with open(filename) as f:
+        lines = f.read().splitlines()[1:]
+
+    return [line.split(',')[1] for line in lines if line]
+
+
+def append_lut(mosaic_folder, index, scene_name):
+
+    filename = mosaic_folder + os.sep + 'scenes_lut.csv'
+    new_file = not os.path.isfile(filename)
+
+    with open(filename, 'a') as f:
+        if new_file:
+            f.write('lut_index,scene\n')
+        f.write('%d,%s\n' % (index, scene_name))
+
+
+def band_profile(grid, band):
+
+    profile = dict(tifopts, crs=grid['crs'], transform=grid['transform'],
+                   width=grid['width'], height=grid['height'], count=1)
+
+    if band in bands_int16:
+        profile.update(dtype='int16', nodata=-1 if band == 'sza_lut' else None)
+    else:
+        profile.update(dtype='float32', nodata=np.nan)
+
+    return profile
+
+
+def read_state(mosaic_folder, grid, window, bands):
+    '''
+    Reads the window of a mosaic stored on disk. Missing bands are
+    initialised empty.
+    '''
+
+    state = init_state((int(window.height), int(window.width)), bands)
+
+    for band in state:
+        filename = mosaic_folder + os.sep + band + '.tif'
+        if os.path.isfile(filename):
+            with rasterio.open(filename) as src:
+                state[band] = src.read(1, window=window).astype(
+                    state[band].dtype)
+
+    return state
+
+
+def write_state(mosaic_folder, grid, window, state, bands):
+    '''
+    Writes the window of a mosaic in place. Band files are created on the
+    region grid when missing.
+    '''
+
+    for band in bands:
+        filename = mosaic_folder + os.sep + band + '.tif'
+        profile = band_profile(grid, band)
+
+        if not os.path.isfile(filename):
+            with rasterio.open(filename, 'w', **profile) as dst:
+                if band == 'sza_lut':
+                    fill = -1
+                elif band in bands_int16:
+                    fill = 0
+                else:
+                    fill = np.nan
+                dst.write(np.full((grid['height'], grid['width']), fill,
+                                  dtype=profile['dtype']), 1)
+
+        with rasterio.open(filename, 'r+') as dst:
+            dst.write(state[band].astype(profile['dtype']), 1, window=window)
+
+
+def update_mosaic(scene_folder, mosaic_folder, mask_file='mask.tif', res=1000):
+    '''
+    Adds one scene to the mosaic stored in mosaic_folder. Only the window of
+    the region covered by the scene is read and rewritten.
+
+    INPUTS:
+        scene_folder: Path to the scene folder. [string]
+        mosaic_folder: Path to the mosaic folder of the date. [string]
+        mask_file: Path to the region mask. [string]
+        res: Mosaic resolution in meters. [float]
+
+    OUTPUTS:
+        window: Window of the mosaic where pixels were updated, None if the
+                mosaic did not change. [rasterio.windows.Window]
+    '''
+
+    scene_name = os.path.basename(os.path.normpath(scene_folder))
+    grid = region_grid(mask_file, res)
+
+    os.makedirs(mosaic_folder, exist_ok=True)
+
+    # one scene at a time per mosaic
+    with open(mosaic_folder + os.sep + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        lut = read_lut(mosaic_folder)
+        if scene_name in lut:
+            print('%s already in mosaic, scene skipped' % scene_name)
+            return None
+
+        if not os.path.isfile(scene_folder + os.sep + 'SZA.tif'):
+            print('ERROR: SZA.tif is missing in %s' % scene_folder)
+            return None
+
+        window = scene_window(scene_folder, grid)
+        if window is None:
+            print('%s outside of region, scene skipped' % scene_name)
+            return None
+
+        sub_grid = window_grid(grid, window)
+        scene = read_scene(scene_folder, sub_grid)
+        region_mask = read_on_grid(mask_file, sub_grid)
+        region_mask = ~np.isnan(region_mask) & (region_mask != 0)
+
+        bands = [b for b in bands_float32
+                 if b in scene or b == 'SZA_CM'
+                 or os.path.isfile(mosaic_folder + os.sep + b + '.tif')]
+
+        state = read_state(mosaic_folder, grid, window, bands)
+        index = len(lut)
+        update = composite(state, scene, index, region_mask)
+
+        state.update(derived_bands(state))
+        write_state(mosaic_folder, grid, window, state,
+                    list(state.keys()))
+        append_lut(mosaic_folder, index, scene_name)
+
+    if not np.any(update):
+        return None
+
+    rows = np.where(np.any(update, axis=1))[0]
+    cols = np.where(np.any(update, axis=0))[0]
+
+    return Window(window.col_off + cols[0], window.row_off + rows[0],
+                  cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('date')
+    parser.add_argument('infolder')
+    parser.add_argument('outfolder')
+    parser.add_argument('--mask', default='mask.tif')
+    parser.add_argument('--res', type=float, default=1000)
+    args = parser.parse_args(argv)
+
+    start_time = time.time()
+
+    # scenes of the date not in the mosaic yet
+    yyyymmdd = args.date.replace('-', '')
+    scenes = sorted(s for s in os.listdir(args.infolder)
+                    if re.match(yyyymmdd + r'T\d{6}', s))
+
+    for scene in scenes:
+        window = update_mosaic(args.infolder + os.sep + scene,
+                               args.outfolder + os.sep + args.date,
+                               mask_file=args.mask, res=args.res)
+        if window is not None:
+            print('%s: updated rows %d-%d, cols %d-%d' % (
+                scene, window.row_off, window.row_off + window.height,
+                window.col_off, window.col_off + window.width))
+
+    print('End dm_stream.py %s --- %s seconds ---'
+          % (args.date, time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
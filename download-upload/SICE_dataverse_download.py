@@ -19,8 +19,8 @@ SICE_BBA: Wehrlé, Adrien; Box, Jason; Vandecrux, Baptiste; Mankoff, Ken, 2021,
 """
 
 import os
-import pandas as pd
-from pyDataverse.api import NativeApi, DataAccessApi
+import dataverse_index
+from dataverse_transfer import make_session, download_files
 
 # %% choose SICE dataset
 
@@ -57,21 +57,15 @@ folder_store = "/path/to/SICE/folder"
 # user API key
 api_key = "your_api_key"
 
-# create a NativeApi instance
-api = NativeApi(dataverse_server, api_key)
+# number of concurrent downloads
+n_workers = 8
 
-# access dataverse’s data access API
-data_api = DataAccessApi(dataverse_server, api_key)
-
-# get dataverse metadata
-dataset = api.get_dataset(persistentId)
+# local index of the dataset file listings (see dataverse_index.py)
+index_db = f"{folder_store}/dataverse_index.sqlite"
 
 # example of date range (all dates within the time window will be downloaded)
 date_range = ["2019-08-01", "2019-08-03"]
 
-# create list of dates from first to last date
-date_list = list(pd.date_range(date_range[0], date_range[1]).strftime("%Y-%m-%d"))
-
 # %% the actual download
 
 #  local data set subfolder to store files
@@ -81,56 +75,47 @@ destination_folder = f"{folder_store}/{dataset_name}"
 if not os.path.exists(destination_folder):
     os.makedirs(destination_folder)
 
-# access list of files to download from the dataverse
-dataverse_files = dataset.json()["data"]["latestVersion"]["files"]
-
-for file in dataverse_files:
-
-    # store metadata
-    dataverse_filename = file["dataFile"]["filename"]
-    file_id = file["dataFile"]["id"]
-
-    if dataset_name == "SICE_NRT":
-        # extract SICE_NRT file date from subfolder name
-        file_date = file["directoryLabel"]
-
-        # download file if file name in file list and date in date list
-        file_to_download = (
-            dataverse_filename in files_to_download and file_date in date_list
-        )
-
-    if dataset_name == "SICE_BBA":
-        # extract SICE_BBA file date from file name
-        file_date = dataverse_filename.split(".")[0]
-
-        # download file if date in date list
-        file_to_download = file_date in date_list
+# pooled HTTP session, shared by the listing and the downloads
+session = make_session(n_connections=n_workers, api_key=api_key)
 
-    if file_to_download:
+# the file listing is only fetched again if the dataset version changed
+con = dataverse_index.connect(index_db)
+dataverse_index.refresh(con, session, dataverse_server, persistentId)
 
-        if dataset_name == "SICE_NRT":
-            # create the dataverse directory tree (if it does not exist)
-            if not os.path.exists(f"{destination_folder}/{file_date}"):
-                os.makedirs(f"{destination_folder}/{file_date}")
+# select files by date range (and file name for SICE_NRT) from the index
+if dataset_name == "SICE_NRT":
+    selected_files = dataverse_index.select(
+        con, persistentId, *date_range, filenames=files_to_download
+    )
 
-            # store file in date subfolder
-            local_filename = f"{destination_folder}/{file_date}/{dataverse_filename}"
+if dataset_name == "SICE_BBA":
+    selected_files = dataverse_index.select(con, persistentId, *date_range)
 
-        if dataset_name == "SICE_BBA":
-            # store file directly in destination folder
-            local_filename = f"{destination_folder}/{dataverse_filename}"
+# list of downloads (URL, local file, size and checksum reported by the dataverse)
+jobs = []
 
-        # download if file does not exist yet
-        if bool(os.path.isfile(local_filename)) == False:
+for file in selected_files:
 
-            print(f"downloading {file_date}/{dataverse_filename}...")
+    if dataset_name == "SICE_NRT":
+        # store file in date subfolder
+        local_filename = f"{destination_folder}/{file['date']}/{file['filename']}"
 
-            # download datafile
-            response = data_api.get_datafile(file_id)
+    if dataset_name == "SICE_BBA":
+        # store file directly in destination folder
+        local_filename = f"{destination_folder}/{file['filename']}"
+
+    jobs.append(
+        dict(
+            url=f"{dataverse_server}/api/access/datafile/{file['file_id']}",
+            local_filename=local_filename,
+            size=file["size"],
+            checksum=file["checksum"],
+        )
+    )
 
-            # write file
-            with open(local_filename, "wb") as f:
-                f.write(response.content)
-        else:
+# streamed, resumable and verified downloads (see dataverse_transfer.py), existing
+# files being skipped if their size matches
+results = download_files(session, jobs, n_workers=n_workers)
 
-            print(f"{local_filename} already exists")
+failed = [f for f, status in results.items() if status not in ["exists", "downloaded"]]
+print(f"{len(jobs) - len(failed)} files up to date, {len(failed)} failed")
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Extraction of a region of interest (ROI) from the SICE GeoTIFFs of the SICE
+dataverse at GEUS, without downloading the whole files
+
+The remote files are opened through GDAL's /vsicurl/, which reads the file
+header and then only the tiles (or strips) intersecting the ROI with HTTP Range
+requests. For a glacier catchment, a few hundred kB are transferred per file
+instead of the whole regional GeoTIFF. The ROI is a bounding box in lon/lat or
+the extent of a mask raster, pixels outside the mask being set to NaN.
+
+The files are selected from the local index of the dataset listing (see
+dataverse_index.py), and written as one cropped GeoTIFF per date and file, or
+with --stack as one multi-band GeoTIFF per file (one band per date).
+
+Example:
+    python SICE_dataverse_roi.py SICE_NRT 2019-08-01 2019-08-31 /path/to/out \
+        --files albedo_bb_planar_sw.tif --bbox -50.1 67.0 -49.5 67.2
+"""
+
+import argparse
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rasterio
+import rasterio.errors
+from rasterio.warp import reproject, transform_bounds, Resampling
+from rasterio.windows import Window, from_bounds
+
+import dataverse_index
+from dataverse_transfer import make_session
+
+# dataset DOIs
+persistent_ids = {
+    "SICE_NRT": "doi:10.22008/FK2/SD56CB",
+    "SICE_BBA": "doi:10.22008/FK2/A5RXJ5",
+}
+
+# GDAL options of the remote reads: no directory listing nor HEAD request (the
+# size is read from the first Range response), files are read by blocks of at
+# least 16 kB and the blocks read are cached
+vsicurl_options = dict(
+    GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR",
+    CPL_VSIL_CURL_USE_HEAD="NO",
+    GDAL_HTTP_MULTIRANGE="YES",
+    GDAL_HTTP_MERGE_CONSECUTIVE_RANGES="YES",
+    CPL_VSIL_CURL_CHUNK_SIZE=16384,
+    VSI_CACHE="TRUE",
+)
+
+
+def roi_bounds(bbox: list = None, mask_file: str = None) -> tuple:
+    """
+    Bounds and CRS of the ROI
+
+    :param bbox: west, south, east, north in degrees
+    :param mask_file: path to a mask raster, used if bbox is None
+    :returns bounds, crs: (left, bottom, right, top) and their CRS
+    """
+
+    if bbox is not None:
+        return tuple(bbox), "EPSG:4326"
+
+    with rasterio.open(mask_file) as src:
+        return tuple(src.bounds), src.crs
+
+
+def roi_window(src, bounds: tuple, crs) -> Window:
+    """
+    Window of a raster covering the ROI, None if they do not intersect
+
+    :param src: open raster
+    :param bounds: ROI bounds
+    :param crs: CRS of the bounds
+    :returns window: window of the raster
+    """
+
+    left, bottom, right, top = transform_bounds(crs, src.crs, *bounds, densify_pts=21)
+    window = from_bounds(left, bottom, right, top, src.transform)
+
+    # whole pixels covering the bounds, within the raster
+    col_off = max(math.floor(window.col_off), 0)
+    row_off = max(math.floor(window.row_off), 0)
+    width = min(math.ceil(window.col_off + window.width), src.width) - col_off
+    height = min(math.ceil(window.row_off + window.height), src.height) - row_off
+
+    if width <= 0 or height <= 0:
+        return None
+
+    return Window(col_off, row_off, width, height)
+
+
+def apply_mask(data: np.ndarray, profile: dict, mask_file: str) -> np.ndarray:
+    """
+    Set to NaN the pixels outside a mask raster (0 or nodata)
+    """
+
+    mask = np.zeros(data.shape, dtype="float32")
+
+    with rasterio.open(mask_file) as src:
+        reproject(
+            source=rasterio.band(src, 1),
+            destination=mask,
+            src_nodata=src.nodata,
+            dst_transform=profile["transform"],
+            dst_crs=profile["crs"],
+            dst_nodata=0,
+            resampling=Resampling.nearest,
+        )
+
+    return np.where(mask != 0, data, np.nan)
+
+
+def read_roi(url: str, bounds: tuple, crs, mask_file: str = None) -> tuple:
+    """
+    Read the ROI of a remote (or local) GeoTIFF
+
+    :param url: URL of the file
+    :param bounds: ROI bounds
+    :param crs: CRS of the bounds
+    :param mask_file: path to a mask raster, None for the whole bounds
+    :returns data, profile: float32 values of the ROI and their profile, (None,
+    None) outside the file
+    """
+
+    path = "/vsicurl/" + url if url.startswith("http") else url
+
+    with rasterio.open(path) as src:
+        window = roi_window(src, bounds, crs)
+        if window is None:
+            return None, None
+        data = src.read(1, window=window, masked=True).astype("float32").filled(np.nan)
+        profile = dict(
+            driver="GTiff",
+            dtype="float32",
+            nodata=np.nan,
+            count=1,
+            crs=src.crs,
+            transform=src.window_transform(window),
+            width=int(window.width),
+            height=int(window.height),
+            compress="DEFLATE",
+            predictor=3,
+        )
+
+    if mask_file is not None:
+        data = apply_mask(data, profile, mask_file)
+
+    return data, profile
+
+
+def extract(
+    files: list,
+    dataverse_server: str,
+    out_folder: str,
+    bounds: tuple,
+    crs,
+    mask_file: str = None,
+    stack: bool = False,
+    api_key: str = None,
+    n_workers: int = 4,
+) -> int:
+    """
+    Extract the ROI of dataverse files
+
+    :param files: files selected from the index (see dataverse_index.select)
+    :param dataverse_server: dataverse URL
+    :param out_folder: output folder
+    :param bounds: ROI bounds
+    :param crs: CRS of the bounds
+    :param mask_file: path to a mask raster
+    :param stack: if True, one multi-band GeoTIFF per file name
+    :param api_key: dataverse API key, for restricted files
+    :param n_workers: number of files read concurrently
+    :returns n: number of ROIs written
+    """
+
+    options = dict(vsicurl_options)
+    if api_key is not None:
+        # GDAL configuration option (GDAL >= 3.6), the key is not written to
+        # disk
+        options["GDAL_HTTP_HEADERS"] = f"X-Dataverse-key: {api_key}"
+
+    def read(file):
+        try:
+            with rasterio.Env(**options):
+                return read_roi(
+                    f"{dataverse_server}/api/access/datafile/{file['file_id']}",
+                    bounds,
+                    crs,
+                    mask_file,
+                )
+        except rasterio.errors.RasterioIOError as e:
+            print(f"{file['date']}/{file['filename']}: {e}")
+            return None, None
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        rois = list(executor.map(read, files))
+
+    written = 0
+    stacks = {}
+
+    for file, (data, profile) in zip(files, rois):
+
+        if data is None:
+            print(f"{file['date']}/{file['filename']}: skipped")
+            continue
+
+        if stack:
+            stacks.setdefault(file["filename"], []).append((file["date"], data, profile))
+            continue
+
+        local_filename = f"{out_folder}/{file['date']}/{file['filename']}"
+        os.makedirs(os.path.dirname(local_filename), exist_ok=True)
+        with rasterio.open(local_filename, "w", **profile) as dst:
+            dst.write(data, 1)
+        written += 1
+
+    for filename, layers in stacks.items():
+        profile = dict(layers[0][2], count=len(layers))
+        local_filename = f"{out_folder}/{os.path.splitext(filename)[0]}_stack.tif"
+        with rasterio.open(local_filename, "w", **profile) as dst:
+            for band, (date, data, _) in enumerate(layers, start=1):
+                dst.write(data, band)
+                dst.set_band_description(band, date)
+        written += len(layers)
+
+    return written
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dataset", choices=list(persistent_ids))
+    parser.add_argument("start", help="first date (YYYY-MM-DD)")
+    parser.add_argument("end", help="last date (YYYY-MM-DD)")
+    parser.add_argument("out_folder")
+    parser.add_argument("--files", nargs="*", default=None,
+                        help="file names, e.g. albedo_bb_planar_sw.tif")
+    parser.add_argument("--bbox", nargs=4, type=float, default=None,
+                        metavar=("WEST", "SOUTH", "EAST", "NORTH"))
+    parser.add_argument("--mask", default=None, help="mask raster of the ROI")
+    parser.add_argument("--stack", action="store_true",
+                        help="one multi-band GeoTIFF per file name")
+    parser.add_argument("--server", default="https://dataverse01.geus.dk")
+    parser.add_argument("--api-key", default=None)
+    parser.add_argument("--index", default="dataverse_index.sqlite")
+    parser.add_argument("-j", "--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.bbox is None and args.mask is None:
+        parser.error("a ROI is required (--bbox or --mask)")
+
+    os.makedirs(args.out_folder, exist_ok=True)
+
+    persistent_id = persistent_ids[args.dataset]
+    session = make_session(api_key=args.api_key)
+    con = dataverse_index.connect(args.index)
+    dataverse_index.refresh(con, session, args.server, persistent_id)
+    files = dataverse_index.select(
+        con, persistent_id, args.start, args.end, filenames=args.files
+    )
+
+    bounds, crs = roi_bounds(args.bbox, args.mask)
+    n = extract(
+        files,
+        args.server,
+        args.out_folder,
+        bounds,
+        crs,
+        args.mask,
+        args.stack,
+        args.api_key,
+        args.workers,
+    )
+
+    print(f"{n} ROIs of {len(files)} files written in {args.out_folder}")
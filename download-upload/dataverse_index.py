@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Local SQLite index of the file listing of a SICE dataverse dataset
+
+The listing of SICE_NRT holds every product of every day since 2017. It is
+stored in a local SQLite database, keyed by dataset version: each run only
+asks the dataverse for the latest version number, and the listing is fetched
+again (by pages) only when the version changed. Files are then selected with
+indexed queries by date range, file name and directory label.
+
+The date of a file is its directory label (SICE_NRT) or the date at the start
+of its file name (SICE_BBA).
+"""
+
+import re
+import sqlite3
+import time
+
+import requests
+
+# number of files per page of the listing
+page_size = 1000
+
+date_pattern = re.compile(r"(\d{4}-\d{2}-\d{2})")
+
+
+def connect(db: str) -> sqlite3.Connection:
+    """
+    Open (and create if needed) the index database
+
+    :param db: path to the SQLite database
+    :returns con: connection
+    """
+
+    con = sqlite3.connect(db)
+    con.row_factory = sqlite3.Row
+
+    con.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS datasets (
+            persistent_id TEXT PRIMARY KEY,
+            version TEXT,
+            updated REAL
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            file_id INTEGER,
+            persistent_id TEXT,
+            filename TEXT,
+            directory_label TEXT,
+            date TEXT,
+            size INTEGER,
+            checksum_type TEXT,
+            checksum_value TEXT,
+            PRIMARY KEY (persistent_id, file_id)
+        );
+        CREATE INDEX IF NOT EXISTS files_date ON files (persistent_id, date);
+        CREATE INDEX IF NOT EXISTS files_filename ON files (persistent_id, filename);
+        """
+    )
+
+    return con
+
+
+def latest_version(
+    session: requests.Session, dataverse_server: str, persistent_id: str
+) -> str:
+    """
+    Latest version of a dataset, without its file listing
+
+    :param session: HTTP session
+    :param dataverse_server: dataverse URL
+    :param persistent_id: dataset DOI
+    :returns version: "major.minor", or "DRAFT"
+    """
+
+    response = session.get(
+        f"{dataverse_server}/api/datasets/:persistentId/versions/:latest",
+        params=dict(persistentId=persistent_id, excludeFiles="true"),
+        timeout=60,
+    )
+    response.raise_for_status()
+    data = response.json()["data"]
+
+    if data.get("versionState") == "DRAFT":
+        return "DRAFT"
+
+    return f"{data['versionNumber']}.{data['versionMinorNumber']}"
+
+
+def fetch_files(
+    session: requests.Session, dataverse_server: str, persistent_id: str, version: str
+) -> list:
+    """
+    File listing of a dataset version, fetched by pages
+
+    :param session: HTTP session
+    :param dataverse_server: dataverse URL
+    :param persistent_id: dataset DOI
+    :param version: dataset version ("major.minor" or "DRAFT")
+    :returns files: file metadata as listed by the dataverse
+    """
+
+    version = ":draft" if version == "DRAFT" else version
+    files = []
+    file_ids = set()
+
+    while True:
+        response = session.get(
+            f"{dataverse_server}/api/datasets/:persistentId/versions/{version}/files",
+            params=dict(persistentId=persistent_id, limit=page_size, offset=len(files)),
+            timeout=300,
+        )
+        response.raise_for_status()
+        page = response.json()["data"]
+
+        # servers without pagination ignore limit and offset, and return the
+        # whole listing on each request: a page larger than page_size, or
+        # starting with a file already listed, ends the listing
+        if page and page[0]["dataFile"]["id"] in file_ids:
+            return files
+        if len(page) > page_size:
+            return page
+
+        files += page
+        file_ids.update(file["dataFile"]["id"] for file in page)
+
+        if len(page) < page_size:
+            return files
+
+
+def file_date(filename: str, directory_label: str) -> str:
+    """
+    Date of a file, from its directory label or its file name
+
+    :returns date: YYYY-MM-DD, None if not found
+    """
+
+    for name in [directory_label or "", filename]:
+        match = date_pattern.match(name)
+        if match:
+            return match.group(1)
+
+    return None
+
+
+def refresh(
+    con: sqlite3.Connection,
+    session: requests.Session,
+    dataverse_server: str,
+    persistent_id: str,
+) -> bool:
+    """
+    Update the index of a dataset if its version changed
+
+    :param con: index connection
+    :param session: HTTP session
+    :param dataverse_server: dataverse URL
+    :param persistent_id: dataset DOI
+    :returns changed: True if the listing was fetched again
+    """
+
+    version = latest_version(session, dataverse_server, persistent_id)
+
+    row = con.execute(
+        "SELECT version FROM datasets WHERE persistent_id = ?", (persistent_id,)
+    ).fetchone()
+
+    # drafts change without a new version number
+    if row is not None and row["version"] == version and version != "DRAFT":
+        return False
+
+    files = fetch_files(session, dataverse_server, persistent_id, version)
+
+    with con:
+        con.execute("DELETE FROM files WHERE persistent_id = ?", (persistent_id,))
+        con.executemany(
+            "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    file["dataFile"]["id"],
+                    persistent_id,
+                    file["dataFile"]["filename"],
+                    file.get("directoryLabel"),
+                    file_date(file["dataFile"]["filename"], file.get("directoryLabel")),
+                    file["dataFile"].get("filesize"),
+                    file["dataFile"].get("checksum", {}).get("type"),
+                    file["dataFile"].get("checksum", {}).get("value"),
+                )
+                for file in files
+            ],
+        )
+        con.execute(
+            "INSERT OR REPLACE INTO datasets VALUES (?, ?, ?)",
+            (persistent_id, version, time.time()),
+        )
+
+    print(f"{persistent_id}: version {version}, {len(files)} files indexed")
+
+    return True
+
+
+def select(
+    con: sqlite3.Connection,
+    persistent_id: str,
+    start: str = None,
+    end: str = None,
+    filenames: list = None,
+    directory_label: str = None,
+) -> list:
+    """
+    Select files of a dataset from the index
+
+    :param con: index connection
+    :param persistent_id: dataset DOI
+    :param start: first date (YYYY-MM-DD), included
+    :param end: last date (YYYY-MM-DD), included
+    :param filenames: file names to select, all if None
+    :param directory_label: directory label to select, all if None
+    :returns files: file_id, filename, directory_label, date, size and checksum
+    (dict with type and value, or None) of the selected files
+    """
+
+    query = "SELECT * FROM files WHERE persistent_id = ?"
+    params = [persistent_id]
+
+    if start is not None:
+        query += " AND date >= ?"
+        params.append(start)
+    if end is not None:
+        query += " AND date <= ?"
+        params.append(end)
+    if filenames is not None:
+        query += f" AND filename IN ({','.join('?' * len(filenames))})"
+        params += list(filenames)
+    if directory_label is not None:
+        query += " AND directory_label = ?"
+        params.append(directory_label)
+
+    return [
+        dict(
+            file_id=row["file_id"],
+            filename=row["filename"],
+            directory_label=row["directory_label"],
+            date=row["date"],
+            size=row["size"],
+            checksum=dict(type=row["checksum_type"], value=row["checksum_value"])
+            if row["checksum_type"] is not None
+            else None,
+        )
+        for row in con.execute(query + " ORDER BY date, filename", params)
+    ]
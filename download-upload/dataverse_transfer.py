@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Concurrent, resumable downloads and idempotent uploads of SICE product files
+from/to the SICE dataverse at GEUS (or any HTTP server supporting Range requests)
+
+Files are streamed in chunks to a ".part" file next to the destination. An
+interrupted transfer is resumed from the size of the ".part" file with a Range
+request, and the file is only renamed to its final name once its size and
+checksum match the ones reported by the dataverse. A local file is therefore
+either complete or absent. Downloads run concurrently on a pooled HTTP session.
+
+Uploads first list the files the dataset already holds in the directory label
+of the folder: files with the same checksum are skipped, modified files are
+replaced and new files added. The remaining files are uploaded concurrently,
+each one retried with exponential backoff (e.g. while the dataset is locked by
+a previous upload), and the dataset is published once for the whole batch.
+"""
+
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from dataverse_index import fetch_files
+
+# size of the streamed chunks (bytes)
+chunk_size = 1024 * 1024
+
+# number of attempts of a download, waiting 2**attempt seconds in between
+max_attempts = 5
+
+
+def make_session(n_connections: int = 8, api_key: str = None) -> requests.Session:
+    """
+    Create an HTTP session keeping up to n_connections connections alive
+
+    :param n_connections: size of the connection pool
+    :param api_key: dataverse API key, sent with every request if given
+    :returns session: requests session
+    """
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=n_connections, pool_maxsize=n_connections)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    if api_key is not None:
+        session.headers["X-Dataverse-key"] = api_key
+
+    return session
+
+
+def file_checksum(filename: str, algorithm: str = "MD5") -> str:
+    """
+    Compute the checksum of a local file
+
+    :param filename: path to the file
+    :param algorithm: dataverse checksum type (MD5, SHA-1, SHA-256, SHA-512)
+    :returns checksum: hexadecimal digest
+    """
+
+    digest = hashlib.new(algorithm.lower().replace("-", ""))
+
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def is_complete(
+    filename: str, size: int = None, checksum: dict = None, verify: bool = False
+) -> bool:
+    """
+    Check a local file against the size (and checksum if verify) of the remote
+    file
+
+    :param filename: path to the local file
+    :param size: size of the remote file in bytes, None if unknown
+    :param checksum: dataverse checksum, e.g. {"type": "MD5", "value": "..."}
+    :param verify: if True, the checksum is also compared
+    :returns complete: True if the file matches
+    """
+
+    if not os.path.isfile(filename):
+        return False
+
+    if size is not None and os.path.getsize(filename) != size:
+        return False
+
+    if verify and checksum is not None:
+        return file_checksum(filename, checksum["type"]) == checksum["value"]
+
+    return True
+
+
+def stream_to_part(session: requests.Session, url: str, part_filename: str) -> None:
+    """
+    Stream a remote file to a ".part" file, resuming from its current size
+
+    :param session: HTTP session
+    :param url: URL of the remote file
+    :param part_filename: path to the partial file
+    """
+
+    offset = os.path.getsize(part_filename) if os.path.isfile(part_filename) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+
+    with session.get(url, headers=headers, stream=True, timeout=60) as response:
+
+        if response.status_code == 416:
+            # nothing left to download
+            return
+
+        response.raise_for_status()
+
+        # the server may ignore the Range header and send the whole file
+        mode = "ab" if response.status_code == 206 else "wb"
+
+        with open(part_filename, mode) as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+
+
+def download_file(
+    session: requests.Session,
+    url: str,
+    local_filename: str,
+    size: int = None,
+    checksum: dict = None,
+) -> str:
+    """
+    Download a file, resuming a previous partial download, and rename it to
+    local_filename once its size and checksum are verified
+
+    :param session: HTTP session
+    :param url: URL of the remote file
+    :param local_filename: path to the local file
+    :param size: size of the remote file in bytes, None if unknown
+    :param checksum: dataverse checksum, e.g. {"type": "MD5", "value": "..."}
+    :returns status: "exists" or "downloaded", an exception is raised after
+    max_attempts failed attempts
+    """
+
+    if is_complete(local_filename, size):
+        return "exists"
+
+    os.makedirs(os.path.dirname(os.path.abspath(local_filename)), exist_ok=True)
+    part_filename = local_filename + ".part"
+
+    for attempt in range(max_attempts):
+
+        try:
+            stream_to_part(session, url, part_filename)
+        except requests.RequestException as e:
+            # client errors (missing file, access denied) are not retried
+            status_code = getattr(e.response, "status_code", None)
+            if status_code is not None and status_code < 500 and status_code != 429:
+                raise
+            print(f"{os.path.basename(local_filename)}: {e}, retrying...")
+            time.sleep(2 ** attempt)
+            continue
+
+        if is_complete(part_filename, size, checksum, verify=True):
+            os.replace(part_filename, local_filename)
+            return "downloaded"
+
+        if size is None or os.path.getsize(part_filename) >= size:
+            # corrupted, the next attempt starts from scratch
+            print(f"{os.path.basename(local_filename)}: checksum mismatch, retrying...")
+            os.remove(part_filename)
+
+        time.sleep(2 ** attempt)
+
+    raise RuntimeError(f"download of {url} failed after {max_attempts} attempts")
+
+
+def download_files(
+    session: requests.Session, jobs: list, n_workers: int = 4
+) -> dict:
+    """
+    Download files concurrently
+
+    :param session: HTTP session, with a connection pool of at least n_workers
+    :param jobs: dicts with the download_file arguments (url, local_filename,
+    size, checksum)
+    :param n_workers: number of concurrent downloads
+    :returns results: status of each local file ("exists", "downloaded" or the
+    error message)
+    """
+
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+
+        futures = {
+            executor.submit(download_file, session, **job): job["local_filename"]
+            for job in jobs
+        }
+
+        for future in as_completed(futures):
+
+            local_filename = futures[future]
+
+            try:
+                results[local_filename] = future.result()
+            except Exception as e:
+                results[local_filename] = str(e)
+
+            print(f"{local_filename}: {results[local_filename]}")
+
+    return results
+
+
+def remote_files(
+    session: requests.Session,
+    dataverse_server: str,
+    persistent_id: str,
+    directory_label: str,
+) -> dict:
+    """
+    Files of the latest version (draft or released) of a dataset in a directory
+    label
+
+    :returns files: file id and checksum of each file name
+    """
+
+    return {
+        file["dataFile"]["filename"]: dict(
+            file_id=file["dataFile"]["id"], checksum=file["dataFile"].get("checksum")
+        )
+        for file in fetch_files(session, dataverse_server, persistent_id, ":latest")
+        if file.get("directoryLabel") == directory_label
+    }
+
+
+def upload_file(
+    session: requests.Session,
+    dataverse_server: str,
+    persistent_id: str,
+    filename: str,
+    directory_label: str,
+    description: str,
+    replace_id: int = None,
+) -> str:
+    """
+    Upload a file to a dataset, or replace an existing file, with exponential
+    backoff
+
+    :param session: HTTP session
+    :param dataverse_server: dataverse URL
+    :param persistent_id: dataset DOI
+    :param filename: path to the local file
+    :param directory_label: dataverse directory of the file
+    :param description: file description
+    :param replace_id: id of the dataverse file replaced, None to add the file
+    :returns status: "uploaded" or "replaced", an exception is raised after
+    max_attempts failed attempts
+    """
+
+    if replace_id is None:
+        url = f"{dataverse_server}/api/datasets/:persistentId/add"
+        params = dict(persistentId=persistent_id)
+        status = "uploaded"
+    else:
+        url = f"{dataverse_server}/api/files/{replace_id}/replace"
+        params = {}
+        status = "replaced"
+
+    json_data = json.dumps(
+        dict(
+            description=description,
+            directoryLabel=directory_label,
+            forceReplace=replace_id is not None,
+        )
+    )
+
+    for attempt in range(max_attempts):
+
+        try:
+            with open(filename, "rb") as f:
+                response = session.post(
+                    url,
+                    params=params,
+                    data=dict(jsonData=json_data),
+                    files=dict(file=(os.path.basename(filename), f)),
+                    timeout=600,
+                )
+            # bad requests and permissions are not retried
+            if response.status_code in [400, 401, 403, 404]:
+                raise RuntimeError(f"{response.status_code}: {response.text[:200]}")
+            if response.ok and response.json().get("status") == "OK":
+                return status
+            print(f"{os.path.basename(filename)}: {response.status_code}, retrying...")
+        except requests.RequestException as e:
+            print(f"{os.path.basename(filename)}: {e}, retrying...")
+
+        time.sleep(2 ** attempt)
+
+    raise RuntimeError(f"upload of {filename} failed after {max_attempts} attempts")
+
+
+def upload_folder(
+    session: requests.Session,
+    dataverse_server: str,
+    persistent_id: str,
+    folder: str,
+    file_list: list,
+    description: str,
+    n_workers: int = 4,
+) -> dict:
+    """
+    Upload the files of a folder whose checksum differs from the dataset files
+    in the directory label of the folder (its name)
+
+    :param session: HTTP session, with a connection pool of at least n_workers
+    :param dataverse_server: dataverse URL
+    :param persistent_id: dataset DOI
+    :param folder: path to local folder where files are stored
+    :param file_list: list of files to upload
+    :param description: description to add to uploaded files
+    :param n_workers: number of concurrent uploads
+    :returns results: status of each file ("unchanged", "uploaded", "replaced",
+    "missing" or the error message)
+    """
+
+    directory_label = os.path.basename(os.path.normpath(folder))
+    existing = remote_files(session, dataverse_server, persistent_id, directory_label)
+
+    results = {}
+    jobs = []
+
+    for file in file_list:
+
+        filename = f"{folder}/{file}"
+
+        if not os.path.isfile(filename):
+            results[file] = "missing"
+            continue
+
+        remote = existing.get(file)
+        if remote is not None and remote["checksum"] is not None:
+            checksum = remote["checksum"]
+            if file_checksum(filename, checksum["type"]) == checksum["value"]:
+                results[file] = "unchanged"
+                continue
+
+        jobs.append((file, filename, remote["file_id"] if remote else None))
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+
+        futures = {
+            executor.submit(
+                upload_file,
+                session,
+                dataverse_server,
+                persistent_id,
+                filename,
+                directory_label,
+                description,
+                replace_id,
+            ): file
+            for file, filename, replace_id in jobs
+        }
+
+        for future in as_completed(futures):
+
+            file = futures[future]
+
+            try:
+                results[file] = future.result()
+            except Exception as e:
+                results[file] = str(e)
+
+            print(f"{directory_label}/{file}: {results[file]}")
+
+    return results
+
+
+def publish(
+    session: requests.Session,
+    dataverse_server: str,
+    persistent_id: str,
+    release_type: str = "major",
+) -> str:
+    """
+    Publish the draft version of a dataset
+
+    :param release_type: "major" or "minor"
+    :returns status: dataverse status ("OK" if successful)
+    """
+
+    response = session.post(
+        f"{dataverse_server}/api/datasets/:persistentId/actions/:publish",
+        params=dict(persistentId=persistent_id, type=release_type),
+        timeout=600,
+    )
+
+    return response.json().get("status", "ERROR")
@@ -6,12 +6,8 @@
 
 """
 
-import json
-import requests
-import os
-from pyDataverse.api import NativeApi
-import time
 import argparse
+from dataverse_transfer import make_session, upload_folder, publish
 
 # %% parse arguments from command line
 
@@ -46,77 +42,32 @@ file_list = [
 # Add file description
 file_description = "my medata"
 
-# %% upload function
+# number of concurrent uploads
+n_workers = 4
 
-def upload_files_to_dataverse(
-    folder: str, file_list: list, file_description: str
-) -> str:
-    """
-    Upload a list of files and associated descriptions to the dataverse
-    
-    :param folder: path to local folder where files are stored
-    :param file_list: list of files to upload 
-    :param file_description: description to add to uploaded files 
-    :returns status: upload status, if successful then status is 'OK',
-    otherwise 'ERROR'
-    """
+# %% upload the new and modified files (see dataverse_transfer.py)
 
-    for file in file_list:
+session = make_session(n_connections=n_workers, api_key=api_key)
 
-        # check if file exists in local and is not corrupted
-        try:
-            files = {"file": open(f"{folder}/{file}", "rb")}
-        except Exception as e:
-            print(e)
-            continue
+results = upload_folder(
+    session,
+    dataverse_server,
+    persistentId,
+    args.InputFolder,
+    file_list,
+    file_description,
+    n_workers=n_workers,
+)
 
-        # build parameter dictionary
-        params = dict(
-            description=file_description,
-            directoryLabel=os.path.basename(os.path.normpath(folder)),
-        )
-
-        # serialize dictionary to a JSON formatted string
-        params_as_json_string = json.dumps(params)
-
-        # build payload
-        payload = dict(jsonData=params_as_json_string)
-
-        # assemble target URL
-        url_persistent_id = (
-            f"{dataverse_server}/api/datasets/:persistentId/"
-            + "add?persistentId={persistendId}&key={api_key}"
-        )
-
-        # print status
-        print("uploading ", os.path.basename(os.path.normpath(folder)) + os.sep + file)
-
-        # make POST request to target URL
-        r = requests.post(url_persistent_id, data=payload, files=files)
-
-        # store upload status
-        status = r.json()["status"]
-
-        return status
-
-
-# %% run every 5 seconds until upload is successful (circumventing denied URL requests)
-
-# create a NativeApi instance
-api = NativeApi(dataverse_server, api_key)
-
-# declare a flag to track upload status
-flag = None
-
-while flag != "OK":
-
-    try:
-        flag = upload_files_to_dataverse(args.InputFolder, file_list, file_description)
-    except Exception as e:
-        print(e)
-        print("... starting again")
-        time.sleep(5)
+uploaded = [f for f, status in results.items() if status in ["uploaded", "replaced"]]
+failed = [
+    f
+    for f, status in results.items()
+    if status not in ["uploaded", "replaced", "unchanged", "missing"]
+]
+print(f"{len(uploaded)} files uploaded, {len(failed)} failed")
 
-# make a new release
-print("Publishing dataset...")
-api.publish_dataset(persistentId, "major")
+# make a new release, once for the whole folder and only if files changed
+if uploaded:
+    print("Publishing dataset...")
+    print(publish(session, dataverse_server, persistentId, "major"))
@@ -13,22 +13,94 @@ import numpy as np
 import rasterio
 import os
 import argparse
+from functools import lru_cache
 from osgeo import gdal, gdalconst
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument('inpath')
-parser.add_argument('inpath_adem')
-
-args = parser.parse_args()
-
 # slope threshold in degrees to create slope_flag
 # Default is set to 15° based on the "small slope approximation" 
 # (Picard et al, 2020)
 slope_thres = 15
+
+
+def effective_angle(angle, saa, slope, aspect):
+    '''
+    
+    Effective zenith angle on a slope.
+    
+    INPUTS:
+        angle: zenith angle in degrees [array]
+        saa: solar azimuth angle in degrees [array]
+        slope, aspect: slope and slope aspect in degrees [arrays]
+    
+    OUTPUTS:
+        angle_eff: effective angle in degrees [array]
+        
+    '''
+    
+    # convert slope, aspect, angle and SAA to radians
+    angle_rad = np.deg2rad(angle)
+    saa_rad = np.deg2rad(saa)
+    slope_rad = np.deg2rad(slope)
+    aspect_rad = np.deg2rad(aspect)
+    
+    # compute effective angle
+    mu = np.cos(angle_rad) * np.cos(slope_rad) + np.sin(angle_rad) * np.sin(slope_rad) * \
+               np.cos(saa_rad - aspect_rad)
+               
+    eff = np.arccos(mu)
+    
+    return np.rad2deg(eff)
+
+
+def compute_ITOAR(toar, sza, saa, slope, aspect):
+    '''
+    
+    Intrinsic Top Of Atmosphere Reflectance (ITOAR) of a band.
+    
+    INPUTS:
+        toar: TOA reflectance (flat) [array]
+        sza, saa: solar zenith and azimuth angles (flat) in degrees [arrays]
+        slope, aspect: slope and slope aspect in degrees [arrays]
+    
+    OUTPUTS:
+        itoar: intrinsic TOA reflectance [array]
+        
+    '''
     
+    mu0 = np.cos(np.deg2rad(sza))
+    mu0_ov = mu0 * np.cos(np.deg2rad(slope)) + np.sin(np.deg2rad(sza))\
+        * np.sin(np.deg2rad(slope)) * np.cos(np.deg2rad(saa) - np.deg2rad(aspect))
+
+    itoar = toar * mu0 / mu0_ov
+    
+    return itoar
+    
+    
+@lru_cache(maxsize=4)
+def read_adem(inpath_adem):
+    '''
+    
+    ArcticDEM slope and aspect, read once per folder and kept in memory 
+    (read-only) for the next mosaics.
+    
+    INPUTS:
+        inpath_adem: path to the ArcticDEM slope and aspect folder [string]
+    
+    OUTPUTS:
+        slope, aspect: slope and slope aspect in degrees [arrays]
+        
+    '''
     
-def get_effective_angle(variable):
+    slope = rasterio.open(inpath_adem + 'Greenland_S.tif').read(1)
+    aspect = rasterio.open(inpath_adem + 'Greenland_A.tif').read(1)
+    slope.flags.writeable = False
+    aspect.flags.writeable = False
+    
+    return slope, aspect
+
+
+def get_effective_angle(variable, inpath, inpath_adem):
     '''
     
     Determines effective Solar and Observation Zenith angles to compute the 
@@ -36,6 +108,8 @@ def get_effective_angle(variable):
     
     INPUTS:
         variable: name of the variable to compute (here SZA or OZA) [string]
+        inpath: path to the mosaic folder [string]
+        inpath_adem: path to the ArcticDEM slope and aspect folder [string]
     
     OUTPUTS:
         {variable}_eff: effective angles [array]
@@ -53,45 +127,33 @@ def get_effective_angle(variable):
     # load variables
     try:
         angle_name = variable + '.tif'
-        angle = rasterio.open(args.inpath + variable + '.tif').read(1)
+        angle = rasterio.open(inpath + variable + '.tif').read(1)
     except:
         print('ERROR: %s is missing' % angle_name)
         return
     try:
-        saa = rasterio.open(args.inpath + 'SAA.tif').read(1)
+        saa = rasterio.open(inpath + 'SAA.tif').read(1)
     except:
         print('ERROR: SAA.tif is missing')
         return
     
     # load slope and aspect
-    slope = rasterio.open(args.inpath_adem + 'Greenland_S.tif').read(1)
-    aspect = rasterio.open(args.inpath_adem + 'Greenland_A.tif').read(1)
+    slope, aspect = read_adem(inpath_adem)
     
     # create a flag based on the "small slope approximation" 
     slope_flag = slope.copy()
     slope_flag[np.where(slope <= slope_thres)] = 1
     slope_flag[np.where(slope > slope_thres)] = 255
     
-    # convert slope, aspect, angle and SAA to radians
-    angle_rad = np.deg2rad(angle)
-    saa_rad = np.deg2rad(saa)
-    slope_rad = np.deg2rad(slope)
-    aspect_rad = np.deg2rad(aspect)
-    
-    # compute effective angle
-    mu = np.cos(angle_rad) * np.cos(slope_rad) + np.sin(angle_rad) * np.sin(slope_rad) * \
-               np.cos(saa_rad - aspect_rad)
-               
-    eff = np.arccos(mu)
-    angle_eff = np.rad2deg(eff)
+    angle_eff = effective_angle(angle, saa, slope, aspect)
 
     # load initial metadata to save the output
-    profile = rasterio.open(args.inpath + variable + '.tif', 'r').profile
+    profile = rasterio.open(inpath + variable + '.tif', 'r').profile
     angle_eff = np.nan_to_num(angle_eff)  # nan no data don't pass
     # profile.update(nodata=0)
 
     # write output file
-    output_filename = args.inpath + variable + '_eff' + '.tif'
+    output_filename = inpath + variable + '_eff' + '.tif'
     
     try:
         with rasterio.open(output_filename, 'w', **profile) as dst:
@@ -106,7 +168,7 @@ def get_effective_angle(variable):
     # write slope_flag 
     profile.update(nodata=255)
     
-    slope_flag_filename = args.inpath + 'slope_flag_' + str(slope_thres) \
+    slope_flag_filename = inpath + 'slope_flag_' + str(slope_thres) \
                           + '_degrees.tif'
     
     with rasterio.open(slope_flag_filename, 'w', **profile) as dst:
@@ -120,7 +182,7 @@ def get_effective_angle(variable):
         return angle_eff
 
 
-def get_ITOAR(slope, aspect):
+def get_ITOAR(slope, aspect, inpath):
     '''
 
     Determines the Intrinsic Top Of Atmosphere Reflectance (ITOAR) for given bands 
@@ -129,6 +191,7 @@ def get_ITOAR(slope, aspect):
     INPUTS:
         slope: slope raster [array]
         aspect: slope aspect raster [array]
+        inpath: path to the mosaic folder [string]
     
     OUTPUTS:
         ir_TOA_{band_num}.tif: tiff file containing the intrinsic TOA for each
@@ -136,56 +199,59 @@ def get_ITOAR(slope, aspect):
                               
     '''
     
-    # load solar and viewing zenith angles (flat)
-    sza = rasterio.open(args.inpath + 'SZA.tif').read(1)
-    oza = rasterio.open(args.inpath + 'OZA.tif').read(1)
+    # load solar zenith angle (flat)
+    sza = rasterio.open(inpath + 'SZA.tif').read(1)
     
     # load solar azimuth angle (flat)
-    saa = rasterio.open(args.inpath + 'SAA.tif').read(1)
+    saa = rasterio.open(inpath + 'SAA.tif').read(1)
     
     # load TOAR (flat)
-    toar17 = rasterio.open(args.inpath + 'r_TOA_17.tif').read(1)
-    toar21 = rasterio.open(args.inpath + 'r_TOA_21.tif').read(1)
+    toar17 = rasterio.open(inpath + 'r_TOA_17.tif').read(1)
+    toar21 = rasterio.open(inpath + 'r_TOA_21.tif').read(1)
     # save profile as base for ITOAR file
-    profile = rasterio.open(args.inpath + 'r_TOA_21.tif').profile 
+    profile = rasterio.open(inpath + 'r_TOA_21.tif').profile 
     
     # compute ITOARs
-    def compute_ITOAR(toar):
-        
-        mu0 = np.cos(np.deg2rad(sza))
-        mu = np.cos(np.deg2rad(oza))
-        mu0_ov = mu0 * np.cos(np.deg2rad(slope)) + np.sin(np.deg2rad(sza))\
-            * np.sin(np.deg2rad(slope)) * np.cos(np.deg2rad(saa) - np.deg2rad(aspect))
-
-        itoar = toar * mu0 / mu0_ov
-        
-        return itoar
-    
-    itoar17 = compute_ITOAR(toar17)
-    itoar21 = compute_ITOAR(toar21)
+    itoar17 = compute_ITOAR(toar17, sza, saa, slope, aspect)
+    itoar21 = compute_ITOAR(toar21, sza, saa, slope, aspect)
     
     # save ITOARs
-    with rasterio.open(args.inpath + 'ir_TOA_17.tif', 'w', **profile) as dst:
+    with rasterio.open(inpath + 'ir_TOA_17.tif', 'w', **profile) as dst:
         dst.write(itoar17, 1)
-    with rasterio.open(args.inpath + 'ir_TOA_21.tif', 'w', **profile) as dst:
+    with rasterio.open(inpath + 'ir_TOA_21.tif', 'w', **profile) as dst:
         dst.write(itoar21, 1)
 
     
-# get effective SZA and OZA
-SZA_eff, slope, aspect, slope_flag = get_effective_angle(variable='SZA')
-OZA_eff = get_effective_angle(variable='OZA')
+def main(argv=None):
+    
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inpath')
+    parser.add_argument('inpath_adem')
+    
+    args = parser.parse_args(argv)
+    
+    # get effective SZA and OZA
+    SZA_eff, slope, aspect, slope_flag = get_effective_angle(variable='SZA',
+                                                             inpath=args.inpath,
+                                                             inpath_adem=args.inpath_adem)
+    OZA_eff = get_effective_angle(variable='OZA', inpath=args.inpath,
+                                  inpath_adem=args.inpath_adem)
+
+    # get ITOAR 
+    get_ITOAR(slope, aspect, args.inpath)
+
+    # remove initial angles
+    os.remove(args.inpath + 'SZA.tif')
+    os.remove(args.inpath + 'OZA.tif')
+    os.remove(args.inpath + 'r_TOA_21.tif')
+    os.remove(args.inpath + 'r_TOA_17.tif')
 
-# get ITOAR 
-get_ITOAR(slope, aspect)
+    # rename corrected angles
+    os.rename(args.inpath + 'SZA_eff.tif', args.inpath + 'SZA.tif')
+    os.rename(args.inpath + 'OZA_eff.tif', args.inpath + 'OZA.tif')
+    os.rename(args.inpath + 'ir_TOA_21.tif', args.inpath + 'r_TOA_21.tif')
+    os.rename(args.inpath + 'ir_TOA_17.tif', args.inpath + 'r_TOA_17.tif')
 
-# remove initial angles
-os.remove(args.inpath + 'SZA.tif')
-os.remove(args.inpath + 'OZA.tif')
-os.remove(args.inpath + 'r_TOA_21.tif')
-os.remove(args.inpath + 'r_TOA_17.tif')
 
-# rename corrected angles
-os.rename(args.inpath + 'SZA_eff.tif', args.inpath + 'SZA.tif')
-os.rename(args.inpath + 'OZA_eff.tif', args.inpath + 'OZA.tif')
-os.rename(args.inpath + 'ir_TOA_21.tif', args.inpath + 'r_TOA_21.tif')
-os.rename(args.inpath + 'ir_TOA_17.tif', args.inpath + 'r_TOA_17.tif')
+if __name__ == '__main__':
+    main()
@@ -78,307 +78,763 @@
 import numpy as np
 from numpy import genfromtxt
 import sice_lib as sl
+import sice_lut
 import rasterio as rio
-import time
+from rasterio.windows import Window
+import argparse
+import os
 import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from cog import write_cog
+from sice_codecs import output_profile, parse as parse_codecs
+from sice_zonal import folder_stats, variables as zonal_variables
 from constants import w, bai, sol1_clean, sol2, sol3_clean, sol1_pol, sol3_pol, asol
 np.seterr(invalid='ignore')
 
-start_time = time.process_time()
+# %% ========= input tif ================
 
-InputFolder = sys.argv[1] + '/'
 
-# %% ========= input tif ================
+def read_inputs(InputFolder, window=None):
+    '''
+    Reads the inputs of the retrieval from the tif files of a mosaic.
 
-Oa01 = rio.open(InputFolder + 'r_TOA_01.tif')
-meta = Oa01.meta
+    INPUTS:
+        InputFolder: Path to the mosaic folder, ending with a separator. [string]
+        window: Window to read, None for the whole mosaic. [rasterio Window]
 
-with rio.Env():    
-    meta.update(compress='DEFLATE')
+    OUTPUTS:
+        meta: r_TOA_01.tif metadata used to write the outputs. [dict]
+        inputs: toa, ozone, water, sza, saa, vza and vaa, height. [dict of arrays]
+    '''
 
+    Oa01 = rio.open(InputFolder + 'r_TOA_01.tif')
+    meta = Oa01.meta
 
-def WriteOutput(var, var_name, in_folder):
-    # this functions write tif files based on a model file, here "Oa01"
-    # opens a file for writing
+    with rio.Env():
+        meta.update(compress='DEFLATE')
 
-    with rio.open(in_folder + var_name + '.tif', 'w+', **meta) as dst:
-        dst.write(var.astype('float32'), 1)
-  
-toa = np.tile(Oa01.read(1).astype('float32') * np.nan, (21, 1, 1))
+    toa = np.tile(Oa01.read(1, window=window).astype('float32') * np.nan,
+                  (21, 1, 1))
 
-for i in range(21):
-    
-    try:
-        dat = rio.open((InputFolder + 'r_TOA_' + str(i + 1).zfill(2) + '.tif'))
-        toa[i, :, :] = dat.read(1).astype('float32')
-    except:
-        toa[i, :, :] = np.nan
-    
-ozone = rio.open(InputFolder + 'O3.tif').read(1).astype('float32')
-water = rio.open(InputFolder + 'WV.tif').read(1).astype('float32')
-sza = rio.open(InputFolder + 'SZA.tif').read(1).astype('float32')
-saa = rio.open(InputFolder + 'SAA.tif').read(1).astype('float32')
-vza = rio.open(InputFolder + 'OZA.tif').read(1).astype('float32')
-vaa = rio.open(InputFolder + 'OAA.tif').read(1).astype('float32')
-height = rio.open(InputFolder + 'height.tif').read(1).astype('float32')
+    for i in range(21):
 
-sza[np.isnan(toa[0, :, :])] = np.nan
-saa[np.isnan(toa[0, :, :])] = np.nan
-vza[np.isnan(toa[0, :, :])] = np.nan
-vaa[np.isnan(toa[0, :, :])] = np.nan
+        try:
+            dat = rio.open((InputFolder + 'r_TOA_' + str(i + 1).zfill(2) + '.tif'))
+            toa[i, :, :] = dat.read(1, window=window).astype('float32')
+        except:
+            toa[i, :, :] = np.nan
 
-water_vod = genfromtxt('./tg_water_vod.dat', delimiter='   ')
-voda = water_vod[range(21), 1]
+    def read(name):
+        return rio.open(InputFolder + name).read(1, window=window).astype('float32')
 
-ozone_vod = genfromtxt('./tg_vod.dat', delimiter='   ')
-tozon = ozone_vod[range(21), 1]
-aot = 0.1
+    ozone = read('O3.tif')
+    water = read('WV.tif')
+    sza = read('SZA.tif')
+    saa = read('SAA.tif')
+    vza = read('OZA.tif')
+    vaa = read('OAA.tif')
+    height = read('height.tif')
 
-# %%   declaring variables
+    return meta, dict(toa=toa, ozone=ozone, water=water, sza=sza, saa=saa,
+                      vza=vza, vaa=vaa, height=height)
 
-BXXX, isnow, D, area, al, r0, isnow, conc, ntype, rp1, rp2, rp3, rs1, rs2, rs3 =  \
-    vaa * np.nan, vaa * np.nan, vaa * np.nan, vaa * np.nan, vaa * np.nan, vaa * np.nan, \
-    vaa * np.nan, vaa * np.nan, vaa * np.nan, vaa * np.nan, vaa * np.nan, vaa * np.nan, \
-    vaa * np.nan, vaa * np.nan, vaa * np.nan
 
-alb_sph, rp, refl = toa * np.nan, toa * np.nan, toa * np.nan
+@lru_cache(maxsize=None)
+def read_vod():
+    '''
+    Water vapour and ozone vertical optical depths at the 21 OLCI channels,
+    parsed once per process.
+    '''
 
-# %% =========== ozone scattering  ====================================
+    water_vod = genfromtxt('./tg_water_vod.dat', delimiter='   ')
+    voda = water_vod[range(21), 1]
 
-BXXX, toa_cor_o3 = sl.ozone_scattering(ozone, tozon, sza, vza, toa)
+    ozone_vod = genfromtxt('./tg_vod.dat', delimiter='   ')
+    tozon = ozone_vod[range(21), 1]
 
-# Filtering pixels unsuitable for retrieval
-isnow[sza > 75] = 100
-isnow[toa_cor_o3[20, :, :] < 0.1] = 102
+    return voda, tozon
 
-for i_channel in range(21):
-    toa_cor_o3[i_channel, ~np.isnan(isnow)] = np.nan
 
-vaa[~np.isnan(isnow)] = np.nan
-saa[~np.isnan(isnow)] = np.nan
-sza[~np.isnan(isnow)] = np.nan
-vza[~np.isnan(isnow)] = np.nan
+def retrieval(toa, ozone, water, sza, saa, vza, vaa, height,
+              atmosphere='analytic'):
+    '''
+    Retrieves the snow properties and albedos from OLCI TOA reflectances.
+    The angles and height are modified in place.
 
-height[~np.isnan(isnow)] = np.nan
+    INPUTS:
+        toa: OLCI TOA reflectances at 21 channels. [3D array]
+        ozone, water: ECMWF total ozone and water vapour. [arrays]
+        sza, saa, vza, vaa: solar and viewing zenith and azimuth angles. [arrays]
+        height: height of underlying surface (meters). [array]
+        atmosphere: 'analytic', or 'lut' to interpolate the atmospheric
+                    coefficients in the LUT of sice_lut.py. [string]
 
-# =========== view geometry and atmosphere propeties  ==============
+    OUTPUTS:
+        outputs: retrieved variables, by output file name. [dict of arrays]
+    '''
 
-raa, am1, am2, ak1, ak2, amf, co = sl.view_geometry(vaa, saa, sza, vza, aot, height)
+    sza[np.isnan(toa[0, :, :])] = np.nan
+    saa[np.isnan(toa[0, :, :])] = np.nan
+    vza[np.isnan(toa[0, :, :])] = np.nan
+    vaa[np.isnan(toa[0, :, :])] = np.nan
 
-tau, p, g, gaer, taumol, tauaer = sl.aerosol_properties(aot, height, co)
-     
-# =========== snow properties  ====================================
+    voda, tozon = read_vod()
+    aot = 0.1
 
-D, area, al, r0, bal = sl.snow_properties(toa_cor_o3, ak1, ak2)
-# filtering small D
-D_thresh = 0.1
-isnow[D < D_thresh] = 104
+    # %%   declaring variables
 
-for i in range(21):
-    toa_cor_o3[i, D < D_thresh] = np.nan
-    
-area[D < D_thresh] = np.nan
-al[D < D_thresh] = np.nan
-r0[D < D_thresh] = np.nan
-bal[D < D_thresh] = np.nan
-am1[D < D_thresh] = np.nan
-am2[D < D_thresh] = np.nan
-# D[D<D_thresh] = np.nan
+    BXXX, isnow, D, area, al, r0, isnow, conc, ntype, rp1, rp2, rp3, rs1, rs2, rs3 =  \
+        vaa * np.nan, vaa * np.nan, vaa * np.nan, vaa * np.nan, vaa * np.nan, vaa * np.nan, \
+        vaa * np.nan, vaa * np.nan, vaa * np.nan, vaa * np.nan, vaa * np.nan, vaa * np.nan, \
+        vaa * np.nan, vaa * np.nan, vaa * np.nan
+
+    alb_sph, rp, refl = toa * np.nan, toa * np.nan, toa * np.nan
 
-# =========== clean snow  ====================================
+    # %% =========== ozone scattering  ====================================
 
-# for that we calculate the theoretical reflectance at band 1 of a surface with:
-# r0 = 1, a (albedo) = 1, ak1 = 1, ak2 = 1
-# t1 and t2 are the backscattering fraction
-t1, t2, ratm, r, astra, rms = sl.prepare_coef(tau, g, p, am1, am2, amf, gaer, 
-                                              taumol, tauaer)
-rs_1 = sl.alb2rtoa(1, t1[0, :, :], t2[0, :, :], np.ones_like(r0), np.ones_like(ak1), 
-                   np.ones_like(ak2), ratm[0, :, :], r[0, :, :])
+    BXXX, toa_cor_o3 = sl.ozone_scattering(ozone, tozon, sza, vza, toa)
 
-# we then compare it to the observed toa[0] value
-ind_clean = toa_cor_o3[0, :, :] >= rs_1
-isnow[ind_clean] = 0
-      
-# STEP 4a: clean snow retrieval
-# the spherical albedo derivation: alb_sph
+    # Filtering pixels unsuitable for retrieval
+    isnow[sza > 75] = 100
+    isnow[toa_cor_o3[20, :, :] < 0.1] = 102
 
+    for i_channel in range(21):
+        toa_cor_o3[i_channel, ~np.isnan(isnow)] = np.nan
 
-def mult_channel(c, A):
-    tmp = A.T * c
-    return tmp.T
+    vaa[~np.isnan(isnow)] = np.nan
+    saa[~np.isnan(isnow)] = np.nan
+    sza[~np.isnan(isnow)] = np.nan
+    vza[~np.isnan(isnow)] = np.nan
 
+    height[~np.isnan(isnow)] = np.nan
 
-alb_sph = np.exp(-np.sqrt(1000. * 4. * np.pi
-                          * mult_channel(bai / w, np.tile(al, (21, 1, 1)))))
-alb_sph[alb_sph > 0.999] = 1
+    # =========== view geometry and atmosphere propeties  ==============
 
-# ========== very dirty snow  ====================================
+    raa, am1, am2, ak1, ak2, amf, co = sl.view_geometry(vaa, saa, sza, vza, aot, height)
 
-ind_pol = toa_cor_o3[0, :, :] < rs_1
+    if atmosphere != 'lut':
+        tau, p, g, gaer, taumol, tauaer = sl.aerosol_properties(aot, height, co)
 
-isnow[ind_pol] = 1
+    # =========== snow properties  ====================================
 
-ind_very_dark = np.logical_and(toa_cor_o3[20] < 0.4, ind_pol)
-isnow[ind_very_dark] = 6
+    D, area, al, r0, bal = sl.snow_properties(toa_cor_o3, ak1, ak2)
+    # filtering small D
+    D_thresh = 0.1
+    isnow[D < D_thresh] = 104
 
-am11 = np.sqrt(1. - am1[ind_very_dark] ** 2.)
-am12 = np.sqrt(1. - am2[ind_very_dark] ** 2.)
+    for i in range(21):
+        toa_cor_o3[i, D < D_thresh] = np.nan
 
-tz = np.arccos(-am1[ind_very_dark] * am2[ind_very_dark] + am11 * am12 
-               * np.cos(raa[ind_very_dark] * 3.14159 / 180.)) * 180. / np.pi
-             
-pz = 11.1 * np.exp(-0.087 * tz) + 1.1 * np.exp(-0.014 * tz)
+    area[D < D_thresh] = np.nan
+    al[D < D_thresh] = np.nan
+    r0[D < D_thresh] = np.nan
+    bal[D < D_thresh] = np.nan
+    am1[D < D_thresh] = np.nan
+    am2[D < D_thresh] = np.nan
+    # D[D<D_thresh] = np.nan
 
-rclean = 1.247 + 1.186 * (am1[ind_very_dark] + am2[ind_very_dark]) \
-    + 5.157 * am1[ind_very_dark] * am2[ind_very_dark] + pz
+    # =========== clean snow  ====================================
 
-rclean = rclean / 4. / (am1[ind_very_dark] + am2[ind_very_dark])
-r0[ind_very_dark] = rclean
+    # for that we calculate the theoretical reflectance at band 1 of a surface with:
+    # r0 = 1, a (albedo) = 1, ak1 = 1, ak2 = 1
+    # t1 and t2 are the backscattering fraction
+    if atmosphere == 'lut':
+        tau, t1, t2, ratm, r = sice_lut.coefficients_lut(am1, am2, co, height)
+    else:
+        t1, t2, ratm, r, astra, rms = sl.prepare_coef(tau, g, p, am1, am2, amf, gaer, 
+                                                      taumol, tauaer)
+    rs_1 = sl.alb2rtoa(1, t1[0, :, :], t2[0, :, :], np.ones_like(r0), np.ones_like(ak1), 
+                       np.ones_like(ak2), ratm[0, :, :], r[0, :, :])
 
-# =========== polluted snow  ====================================
+    # we then compare it to the observed toa[0] value
+    ind_clean = toa_cor_o3[0, :, :] >= rs_1
+    isnow[ind_clean] = 0
+
+    # STEP 4a: clean snow retrieval
+    # the spherical albedo derivation: alb_sph
+
+
+    def mult_channel(c, A):
+        tmp = A.T * c
+        return tmp.T
+
+
+    alb_sph = np.exp(-np.sqrt(1000. * 4. * np.pi
+                              * mult_channel(bai / w, np.tile(al, (21, 1, 1)))))
+    alb_sph[alb_sph > 0.999] = 1
+
+    # ========== very dirty snow  ====================================
+
+    ind_pol = toa_cor_o3[0, :, :] < rs_1
+
+    isnow[ind_pol] = 1
+
+    ind_very_dark = np.logical_and(toa_cor_o3[20] < 0.4, ind_pol)
+    isnow[ind_very_dark] = 6
+
+    am11 = np.sqrt(1. - am1[ind_very_dark] ** 2.)
+    am12 = np.sqrt(1. - am2[ind_very_dark] ** 2.)
+
+    tz = np.arccos(-am1[ind_very_dark] * am2[ind_very_dark] + am11 * am12 
+                   * np.cos(raa[ind_very_dark] * 3.14159 / 180.)) * 180. / np.pi
+
+    pz = 11.1 * np.exp(-0.087 * tz) + 1.1 * np.exp(-0.014 * tz)
+
+    rclean = 1.247 + 1.186 * (am1[ind_very_dark] + am2[ind_very_dark]) \
+        + 5.157 * am1[ind_very_dark] * am2[ind_very_dark] + pz
+
+    rclean = rclean / 4. / (am1[ind_very_dark] + am2[ind_very_dark])
+    r0[ind_very_dark] = rclean
+
+    # =========== polluted snow  ====================================
+
+    ind_pol = np.logical_or(ind_very_dark, ind_pol)
+
+    if np.any(ind_pol):
+        subs_pol = np.argwhere(ind_pol)
+
+        # approximation of the transcendental equation allowing closed-from solution
+        # alb_sph[:, ind_pol] = (toa_cor_o3[:, ind_pol] - r[:, ind_pol]) \ 
+        # /(t1[:,ind_pol]*t2[:,ind_pol]*r0[ind_pol] + ratm[:,ind_pol]*(toa_cor_o3[:,ind_pol] - r[:,ind_pol]))
+
+        # solving iteratively the transcendental equation
+        alb_sph[:, ind_pol] = 1
+
+        def solver_wrapper(toa_cor_o3, tau, t1, t2, r0, ak1, ak2, ratm, r):
+            def func_solv(albedo):
+                return toa_cor_o3 - sl.alb2rtoa(albedo, t1, t2, r0, ak1, ak2, ratm, r)
+            # it is assumed that albedo is in the range 0.1-1.0
+            # all the polluted pixels of a channel are solved at once
+
+            return sl.bisection(func_solv, 0.1, 1, 100, 1.e-6)
+
+        # loop over all bands except band 19, 20
+        for i_channel in np.append(np.arange(18), [20]):
+
+            alb_sph[i_channel, ind_pol] = solver_wrapper(
+                toa_cor_o3[i_channel, ind_pol], tau[i_channel, ind_pol], 
+                t1[i_channel, ind_pol], t2[i_channel, ind_pol],
+                r0[ind_pol], ak1[ind_pol], ak2[ind_pol], ratm[i_channel, ind_pol], 
+                r[i_channel, ind_pol])
+
+            ind_bad = alb_sph[i_channel, :, :] == -999
+            alb_sph[i_channel, ind_bad] = np.nan
+            isnow[ind_bad] = -i_channel
+
+        # INTERNal CHECK FOR CLEAN PIXELS
+        # Are reprocessed as clean
+        ind_clear_pol1 = np.logical_and(ind_pol, alb_sph[0, :, :] > 0.98)
+        ind_clear_pol2 = np.logical_and(ind_pol, alb_sph[1, :, :] > 0.98)
+        ind_clear_pol = np.logical_or(ind_clear_pol1, ind_clear_pol2)
+        isnow[ind_clear_pol] = 7
+
+        for i_channel in range(21):
+            alb_sph[i_channel, ind_clear_pol] = np.exp(-np.sqrt(4. * 1000. 
+                                                                * al[ind_clear_pol] 
+                                                                * np.pi * bai[i_channel] 
+                                                                / w[i_channel])) 
+
+        # re-defining polluted pixels
+        ind_pol = np.logical_and(ind_pol, isnow != 7)
+
+        # retrieving snow impurities        
+        ntype, bf, conc = sl.snow_impurities(alb_sph, bal)
+
+        # alex   09.06.2019
+        # reprocessing of albedo to remove gaseous absorption using linear polynomial 
+        # approximation in the range 753-778nm.
+        # Meaning: alb_sph[12],alb_sph[13] and alb_sph[14] are replaced by a linear 
+        # interpolation between alb_sph[11] and alb_sph[15]
+        afirn = (alb_sph[15, ind_pol] - alb_sph[11, ind_pol]) / (w[15] - w[11])
+        bfirn = alb_sph[15, ind_pol] - afirn * w[15]
+        alb_sph[12, ind_pol] = bfirn + afirn * w[12]
+        alb_sph[13, ind_pol] = bfirn + afirn * w[13]
+        alb_sph[14, ind_pol] = bfirn + afirn * w[14]             
+
+        # BAV 09-02-2020: 0.5 to 0.35
+        # pixels that are clean enough in channels 18 19 20 and 21 are not affected 
+        # by pollution, the analytical equation can then be used
+        ind_ok = np.logical_and(ind_pol, toa_cor_o3[20, :, :] > 0.35)
+
+        for i_channel in range(17, 21):
+            alb_sph[i_channel, ind_ok] = np.exp(-np.sqrt(4. * 1000. * al[ind_ok]
+                                                         * np.pi * bai[i_channel] 
+                                                         / w[i_channel]))
+        # Alex, SEPTEMBER 26, 2019
+        # to avoid the influence of gaseous absorption (water vapor) we linearly 
+        # interpolate in the range 885-1020nm for bare ice cases only (low toa[20])
+        # Meaning: alb_sph[18] and alb_sph[19] are replaced by a linear interpolation 
+        # between alb_sph[17] and alb_sph[20]
+        delx = w[20] - w[17]
+        bcoef = (alb_sph[20, ind_pol] - alb_sph[17, ind_pol]) / delx
+        acoef = alb_sph[20, ind_pol] - bcoef * w[20]
+        alb_sph[18, ind_pol] = acoef + bcoef * w[18]
+        alb_sph[19, ind_pol] = acoef + bcoef * w[19]
+
+    # ========= derivation of plane albedo and reflectance =========== 
+
+    rp = np.power(alb_sph, ak1)
+    refl = r0 * np.power(alb_sph, (ak1 * ak2 / r0))
+
+    ind_all_clean = np.logical_or(ind_clean, isnow == 7)
+
+    # CalCULATION OF BBA of clean snow
+
+    # old method: integrating equation
+    # BBA_v = np.vectorize(sl.BBA_calc_clean)
+    # p1, p2, s1, s2 = BBA_v(al[ind_all_clean], ak1[ind_all_clean])
+
+    # visible(0.3-0.7micron)
+    # rp1[ind_all_clean] = p1 / sol1_clean
+    # rs1[ind_all_clean] = s1 / sol1_clean
+    # near-infrared (0.7-2.4micron)
+    # rp2[ind_all_clean] = p2 / sol2
+    # rs2[ind_all_clean] = s2 / sol2
+    # shortwave(0.3-2.4 micron)
+    # rp3[ind_all_clean] = (p1 + p2) / sol3_clean
+    # rs3[ind_all_clean] = (s1 + s2) / sol3_clean
+
+    # approximation
+    # planar albedo
+    # rp1 and rp2 not derived anymore
+    rp3[ind_all_clean] = sl.plane_albedo_sw_approx(D[ind_all_clean], 
+                                                   am1[ind_all_clean])
+    # spherical albedo
+    # rs1 and rs2 not derived anymore
+    rs3[ind_all_clean] = sl.spher_albedo_sw_approx(D[ind_all_clean])
+
+    # calculation of the BBA for the polluted snow
+    rp1[ind_pol], rp2[ind_pol], rp3[ind_pol] = sl.BBA_calc_pol(
+        rp[:, ind_pol], asol, sol1_pol, sol2, sol3_pol)
+    rs1[ind_pol], rs2[ind_pol], rs3[ind_pol] = sl.BBA_calc_pol(
+        alb_sph[:, ind_pol], asol, sol1_pol, sol2, sol3_pol)
+
+    outputs = {'O3_SICE': BXXX,
+               'grain_diameter': D,
+               'snow_specific_surface_area': area,
+               'al': al,
+               'r0': r0,
+               'diagnostic_retrieval': isnow,
+               'conc': conc,
+               'albedo_bb_planar_sw': rp3,
+               'albedo_bb_spherical_sw': rs3}
+
+    for i in np.append(np.arange(11), np.arange(15, 21)):
+
+        outputs['albedo_spectral_spherical_' + str(i + 1).zfill(2)] = alb_sph[i, :, :]
+        outputs['albedo_spectral_planar_' + str(i + 1).zfill(2)] = rp[i, :, :]
+        outputs['rBRR_' + str(i + 1).zfill(2)] = refl[i, :, :]
+
+    return outputs
+
+
+# %% Uncertainty
+
+# OLCI radiometric gains and their standard deviation, by platform and band
+gains_file = './misc/gains_olci.csv'
+
+n_members = 50
+memory_budget = 4000
+
+# bytes per pixel and ensemble member during the retrieval
+bytes_per_member = 3000
+
+uncertainty_variables = ['grain_diameter', 'snow_specific_surface_area',
+                         'albedo_bb_planar_sw']
+
+
+@lru_cache(maxsize=None)
+def read_gains(platform='A'):
+    '''
+    Average gain and standard deviation of the 21 OLCI bands of a platform,
+    0 where no standard deviation is given.
+    '''
+
+    table = genfromtxt(gains_file, delimiter=',', names=True, dtype=None,
+                       encoding='utf-8')
+    table = table[table['platform'] == platform]
+    if len(table) != 21:
+        raise ValueError('no OLCI gains of platform %s in %s'
+                         % (platform, gains_file))
+    table = table[np.argsort(table['band'])]
+
+    return table['average_gain'], np.nan_to_num(table['standard_deviation'])
+
+
+def sample_gains(n=n_members, platform='A', seed=None):
+    '''
+    Samples the radiometric gains of the 21 OLCI bands from the normal
+    distributions of gains_file (no perturbation where no standard deviation
+    is given).
+
+    INPUTS:
+        n: Number of ensemble members. [int]
+        platform: Sentinel-3 platform, 'A' or 'B'. [string]
+        seed: Seed of the random generator. [int]
+
+    OUTPUTS:
+        gains: Gain of each member and band. [(n, 21) array]
+    '''
+
+    mean, std = read_gains(platform)
+    random = np.random.RandomState(seed)
+
+    return (mean + std * random.standard_normal((n, 21))).astype('float32')
+
+
+def ensemble_inputs(inputs, gains):
+    '''
+    Inputs of an ensemble of retrievals, the TOA reflectances of each member
+    being multiplied by its gains. The member axis is stacked on the row
+    axis, so that the whole ensemble runs in one call of the retrieval.
+
+    INPUTS:
+        inputs: Retrieval inputs (see read_inputs). [dict of arrays]
+        gains: Gain of each member and band (see sample_gains). [2D array]
+
+    OUTPUTS:
+        ensemble: Inputs of the members, stacked on the rows. [dict of arrays]
+    '''
+
+    n = len(gains)
+    ensemble = {name: np.tile(data, (n, 1)) for name, data in inputs.items()
+                if name != 'toa'}
+
+    toa = inputs['toa'][:, None, :, :] * gains.T[:, :, None, None]
+    ensemble['toa'] = toa.reshape(21, -1, toa.shape[-1])
+
+    return ensemble
+
+
+def ensemble_std(inputs, gains, atmosphere='analytic'):
+    '''
+    Standard deviation of the uncertainty variables over an ensemble of
+    retrievals with perturbed gains.
+
+    OUTPUTS:
+        std: Standard deviation of each variable, NaN where fewer than two
+             members were retrieved. [dict of arrays]
+    '''
+
+    n = len(gains)
+    outputs = retrieval(**ensemble_inputs(inputs, gains),
+                        atmosphere=atmosphere)
+
+    std = {}
+    for name in uncertainty_variables:
+        members = outputs[name].reshape((n, -1) + outputs[name].shape[1:])
+        valid = np.sum(~np.isnan(members), axis=0)
+        mean = np.nansum(members, axis=0) / valid
+        var = np.nansum((members - mean) ** 2, axis=0) / valid
+        std[name + '_std'] = np.where(valid > 1, np.sqrt(var),
+                                      np.nan).astype('float32')
+
+    return std
+
+
+def uncertainty(InputFolder, n=n_members, platform='A', seed=None,
+                memory=memory_budget, atmosphere='analytic'):
+    '''
+    Monte-Carlo propagation of the OLCI gain uncertainty through the
+    retrieval. The mosaic is read once, by strips of rows sized on the memory
+    budget, and the ensemble of each strip runs in one retrieval.
+
+    INPUTS:
+        InputFolder: Path to the mosaic folder, ending with a separator. [string]
+        n: Number of ensemble members. [int]
+        platform: Sentinel-3 platform of the gains, 'A' or 'B'. [string]
+        seed: Seed of the random generator. [int]
+        memory: Memory budget in MB. [int]
+        atmosphere: Atmospheric coefficients, 'analytic' or 'lut'. [string]
+
+    OUTPUTS:
+        std: Standard deviation of the grain diameter, specific surface area
+             and planar shortwave albedo. [dict of arrays]
+    '''
+
+    gains = sample_gains(n, platform, seed)
+
+    with rio.open(InputFolder + 'r_TOA_01.tif') as src:
+        width, height = src.width, src.height
+
+    rows = max(1, int(memory * 1e6 / (bytes_per_member * n * width)))
+    std = {name + '_std': np.full((height, width), np.nan, dtype='float32')
+           for name in uncertainty_variables}
+
+    for row in range(0, height, rows):
+        window = Window(0, row, width, min(rows, height - row))
+        _, inputs = read_inputs(InputFolder, window)
+        for name, data in ensemble_std(inputs, gains, atmosphere).items():
+            std[name][window.toslices()] = data
+
+    return std
 
-ind_pol = np.logical_or(ind_very_dark, ind_pol)
 
-if np.any(ind_pol):
-    subs_pol = np.argwhere(ind_pol)
-    
-    # approximation of the transcendental equation allowing closed-from solution
-    # alb_sph[:, ind_pol] = (toa_cor_o3[:, ind_pol] - r[:, ind_pol]) \ 
-    # /(t1[:,ind_pol]*t2[:,ind_pol]*r0[ind_pol] + ratm[:,ind_pol]*(toa_cor_o3[:,ind_pol] - r[:,ind_pol]))
-    
-    # solving iteratively the transcendental equation
-    alb_sph[:, ind_pol] = 1
-    
-    def solver_wrapper(toa_cor_o3, tau, t1, t2, r0, ak1, ak2, ratm, r):
-        def func_solv(albedo):
-            return toa_cor_o3 - sl.alb2rtoa(albedo, t1, t2, r0, ak1, ak2, ratm, r)
-        # it is assumed that albedo is in the range 0.1-1.0
-        
-        return sl.zbrent(func_solv, 0.1, 1, 100, 1.e-6)
-    
-    solver_wrapper_v = np.vectorize(solver_wrapper)
-    # loop over all bands except band 19, 20
-    for i_channel in np.append(np.arange(18), [20]):
-        
-        alb_sph[i_channel, ind_pol] = solver_wrapper_v(
-            toa_cor_o3[i_channel, ind_pol], tau[i_channel, ind_pol], 
-            t1[i_channel, ind_pol], t2[i_channel, ind_pol],
-            r0[ind_pol], ak1[ind_pol], ak2[ind_pol], ratm[i_channel, ind_pol], 
-            r[i_channel, ind_pol])
-        
-        ind_bad = alb_sph[i_channel, :, :] == -999
-        alb_sph[i_channel, ind_bad] = np.nan
-        isnow[ind_bad] = -i_channel
-    
-    # INTERNal CHECK FOR CLEAN PIXELS
-    # Are reprocessed as clean
-    ind_clear_pol1 = np.logical_and(ind_pol, alb_sph[0, :, :] > 0.98)
-    ind_clear_pol2 = np.logical_and(ind_pol, alb_sph[1, :, :] > 0.98)
-    ind_clear_pol = np.logical_or(ind_clear_pol1, ind_clear_pol2)
-    isnow[ind_clear_pol] = 7
-    
-    for i_channel in range(21):
-        alb_sph[i_channel, ind_clear_pol] = np.exp(-np.sqrt(4. * 1000. 
-                                                            * al[ind_clear_pol] 
-                                                            * np.pi * bai[i_channel] 
-                                                            / w[i_channel])) 
-        
-    # re-defining polluted pixels
-    ind_pol = np.logical_and(ind_pol, isnow != 7)
-    
-    # retrieving snow impurities        
-    ntype, bf, conc = sl.snow_impurities(alb_sph, bal)
-
-    # alex   09.06.2019
-    # reprocessing of albedo to remove gaseous absorption using linear polynomial 
-    # approximation in the range 753-778nm.
-    # Meaning: alb_sph[12],alb_sph[13] and alb_sph[14] are replaced by a linear 
-    # interpolation between alb_sph[11] and alb_sph[15]
-    afirn = (alb_sph[15, ind_pol] - alb_sph[11, ind_pol]) / (w[15] - w[11])
-    bfirn = alb_sph[15, ind_pol] - afirn * w[15]
-    alb_sph[12, ind_pol] = bfirn + afirn * w[12]
-    alb_sph[13, ind_pol] = bfirn + afirn * w[13]
-    alb_sph[14, ind_pol] = bfirn + afirn * w[14]             
-
-    # BAV 09-02-2020: 0.5 to 0.35
-    # pixels that are clean enough in channels 18 19 20 and 21 are not affected 
-    # by pollution, the analytical equation can then be used
-    ind_ok = np.logical_and(ind_pol, toa_cor_o3[20, :, :] > 0.35)
-    
-    for i_channel in range(17, 21):
-        alb_sph[i_channel, ind_ok] = np.exp(-np.sqrt(4. * 1000. * al[ind_ok]
-                                                     * np.pi * bai[i_channel] 
-                                                     / w[i_channel]))
-    # Alex, SEPTEMBER 26, 2019
-    # to avoid the influence of gaseous absorption (water vapor) we linearly 
-    # interpolate in the range 885-1020nm for bare ice cases only (low toa[20])
-    # Meaning: alb_sph[18] and alb_sph[19] are replaced by a linear interpolation 
-    # between alb_sph[17] and alb_sph[20]
-    delx = w[20] - w[17]
-    bcoef = (alb_sph[20, ind_pol] - alb_sph[17, ind_pol]) / delx
-    acoef = alb_sph[20, ind_pol] - bcoef * w[20]
-    alb_sph[18, ind_pol] = acoef + bcoef * w[18]
-    alb_sph[19, ind_pol] = acoef + bcoef * w[19]
-
-# ========= derivation of plane albedo and reflectance =========== 
-
-rp = np.power(alb_sph, ak1)
-refl = r0 * np.power(alb_sph, (ak1 * ak2 / r0))
-
-ind_all_clean = np.logical_or(ind_clean, isnow == 7)
-
-# CalCULATION OF BBA of clean snow
-
-# old method: integrating equation
-# BBA_v = np.vectorize(sl.BBA_calc_clean)
-# p1, p2, s1, s2 = BBA_v(al[ind_all_clean], ak1[ind_all_clean])
-
-# visible(0.3-0.7micron)
-# rp1[ind_all_clean] = p1 / sol1_clean
-# rs1[ind_all_clean] = s1 / sol1_clean
-# near-infrared (0.7-2.4micron)
-# rp2[ind_all_clean] = p2 / sol2
-# rs2[ind_all_clean] = s2 / sol2
-# shortwave(0.3-2.4 micron)
-# rp3[ind_all_clean] = (p1 + p2) / sol3_clean
-# rs3[ind_all_clean] = (s1 + s2) / sol3_clean
-
-# approximation
-# planar albedo
-# rp1 and rp2 not derived anymore
-rp3[ind_all_clean] = sl.plane_albedo_sw_approx(D[ind_all_clean], 
-                                               am1[ind_all_clean])
-# spherical albedo
-# rs1 and rs2 not derived anymore
-rs3[ind_all_clean] = sl.spher_albedo_sw_approx(D[ind_all_clean])
-    
-# calculation of the BBA for the polluted snow
-rp1[ind_pol], rp2[ind_pol], rp3[ind_pol] = sl.BBA_calc_pol(
-    rp[:, ind_pol], asol, sol1_pol, sol2, sol3_pol)
-rs1[ind_pol], rs2[ind_pol], rs3[ind_pol] = sl.BBA_calc_pol(
-    alb_sph[:, ind_pol], asol, sol1_pol, sol2, sol3_pol)
-               
 # %% Output
 
-WriteOutput(BXXX, 'O3_SICE', InputFolder)
-WriteOutput(D, 'grain_diameter', InputFolder)
-WriteOutput(area, 'snow_specific_surface_area', InputFolder)
-WriteOutput(al, 'al', InputFolder)
-WriteOutput(r0, 'r0', InputFolder)
-WriteOutput(isnow, 'diagnostic_retrieval', InputFolder)
-WriteOutput(conc, 'conc', InputFolder)
-WriteOutput(rp3, 'albedo_bb_planar_sw', InputFolder)
-WriteOutput(rs3, 'albedo_bb_spherical_sw', InputFolder)
-
-for i in np.append(np.arange(11), np.arange(15, 21)):
-    
-    # for i in np.arange(21):
-    WriteOutput(alb_sph[i, :, :], 'albedo_spectral_spherical_' 
-                + str(i + 1).zfill(2), InputFolder)
-    WriteOutput(rp[i, :, :], 'albedo_spectral_planar_' 
-                + str(i + 1).zfill(2), InputFolder)
-    WriteOutput(refl[i, :, :], 'rBRR_' 
-                + str(i + 1).zfill(2), InputFolder)
-
-print("End SICE.py %s --- %s CPU seconds ---" % 
-      (InputFolder, time.process_time() - start_time))
+
+def WriteOutput(var, var_name, in_folder, meta, cog=False,
+                product_codecs=None):
+    # this functions write tif files based on a model file, here "Oa01"
+    # opens a file for writing
+    # cog: cloud-optimized GeoTIFF with overviews (see cog.py)
+    # product_codecs: codec of each product (see sice_codecs.py)
+
+    meta = output_profile(dict(meta, dtype='float32'), var_name,
+                          product_codecs)
+
+    if cog:
+        write_cog(in_folder + var_name + '.tif', var, meta)
+        return
+
+    with rio.open(in_folder + var_name + '.tif', 'w+', **meta) as dst:
+        dst.write(var.astype('float32'), 1)
+
+
+def write_outputs(outputs, meta, OutputFolder, cog=False, n_threads=4,
+                  product_codecs=None):
+
+    def write(var_name):
+        WriteOutput(outputs[var_name], var_name, OutputFolder, meta, cog,
+                    product_codecs)
+
+    # the files are compressed and written concurrently
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(write, outputs))
+
+
+# %% Pipelined execution
+
+# rows of the blocks, a multiple of the rows per strip of the outputs so that
+# each strip is compressed once
+block_rows = 512
+strip_rows = 16
+# blocks read ahead of the retrieval, and blocks waiting to be written
+prefetch_blocks = 2
+pending_blocks = 2
+n_readers = 2
+n_writers = 4
+
+
+def blocks(InputFolder, rows=block_rows):
+    '''
+    Windows of the strips of rows of a mosaic. [list of rasterio Windows]
+    '''
+
+    with rio.open(InputFolder + 'r_TOA_01.tif') as src:
+        width, height = src.width, src.height
+
+    return [Window(0, row, width, min(rows, height - row))
+            for row in range(0, height, rows)]
+
+
+def open_outputs(outputs, meta, OutputFolder, cog=False,
+                 product_codecs=None, zones=()):
+    '''
+    Output state of a mosaic processed by blocks: whole arrays of the
+    outputs needed at the end (all of them for the cloud-optimized GeoTIFFs,
+    those of the zonal statistics otherwise) and, unless cog, output files
+    open for the block writes.
+    '''
+
+    if cog:
+        names = list(outputs)
+    elif zones:
+        names = [name for name in outputs
+                 if name in zonal_variables + ['diagnostic_retrieval']]
+    else:
+        names = []
+
+    shape = (meta['height'], meta['width'])
+    state = dict(folder=OutputFolder, meta=meta,
+                 product_codecs=product_codecs, n_blocks=0, files={},
+                 locks={}, arrays={name: np.full(shape, np.nan, 'float32')
+                                   for name in names})
+
+    if not cog:
+        for name in outputs:
+            state['files'][name] = rio.open(
+                OutputFolder + name + '.tif', 'w+',
+                **output_profile(dict(meta, dtype='float32',
+                                      blockysize=strip_rows),
+                                 name, product_codecs))
+            state['locks'][name] = threading.Lock()
+
+    return state
+
+
+def write_block(state, name, window, data):
+
+    # a file is written by one thread at a time
+    with state['locks'][name]:
+        state['files'][name].write(data.astype('float32'), 1, window=window)
+
+
+def close_outputs(state, zones, writer):
+    '''
+    Closes the output files of a mosaic (or queues its cloud-optimized
+    GeoTIFFs) and computes its zonal statistics.
+
+    OUTPUTS:
+        futures: Writes of the cloud-optimized GeoTIFFs. [list]
+    '''
+
+    for dst in state['files'].values():
+        dst.close()
+
+    futures = []
+    if not state['files']:
+        futures = [writer.submit(WriteOutput, data, name, state['folder'],
+                                 state['meta'], True, state['product_codecs'])
+                   for name, data in state['arrays'].items()]
+
+    folder_stats(state['arrays'], state['meta'], zones, state['folder'])
+
+    return futures
+
+
+def pipelined(InputFolders, rows=block_rows, atmosphere='analytic',
+              cog=False, zones=[], product_codecs=None):
+    '''
+    Runs the retrieval of mosaics by strips of rows, the reads and writes
+    overlapping the retrieval: the inputs of the next blocks (of the next
+    mosaic at the end of a mosaic) are read by background threads, while the
+    outputs of the previous blocks are compressed and written by a pool of
+    writer threads. The number of blocks read ahead and waiting to be written
+    is bounded, the memory use being a few blocks plus the whole outputs of
+    the mosaics in progress.
+
+    INPUTS:
+        InputFolders: Paths to the mosaic folders, ending with a separator.
+                      [list]
+        rows: Rows of the blocks, rounded up to a multiple of strip_rows. [int]
+        atmosphere: Atmospheric coefficients, 'analytic' or 'lut'. [string]
+        cog: Writes cloud-optimized GeoTIFFs once a mosaic is complete. [bool]
+        zones: Label rasters of the zonal statistics. [list]
+        product_codecs: Codec of each product (see sice_codecs.py). [list]
+    '''
+
+    rows = -(-rows // strip_rows) * strip_rows
+    tasks = [(folder, window) for folder in InputFolders
+             for window in blocks(folder, rows)]
+    n_blocks = {folder: sum(f == folder for f, _ in tasks)
+                for folder in InputFolders}
+
+    states = {}
+    reads = {}
+    writes = []
+    cog_writes = []
+
+    with ThreadPoolExecutor(max_workers=n_readers) as reader, \
+            ThreadPoolExecutor(max_workers=n_writers) as writer:
+
+        for i, (folder, window) in enumerate(tasks):
+
+            for j in range(i, min(i + 1 + prefetch_blocks, len(tasks))):
+                if j not in reads:
+                    reads[j] = reader.submit(read_inputs, *tasks[j])
+
+            meta, inputs = reads.pop(i).result()
+            outputs = retrieval(**inputs, atmosphere=atmosphere)
+
+            if folder not in states:
+                states[folder] = open_outputs(outputs, meta, folder, cog,
+                                              product_codecs, zones)
+            state = states[folder]
+
+            block_writes = []
+            for name, data in outputs.items():
+                if name in state['arrays']:
+                    state['arrays'][name][window.toslices()] = data
+                if not cog:
+                    block_writes.append(writer.submit(write_block, state,
+                                                      name, window, data))
+            writes.append((folder, block_writes))
+            state['n_blocks'] += 1
+
+            # write-behind: waits for the oldest blocks beyond the bound
+            while len(writes) > pending_blocks:
+                for future in writes.pop(0)[1]:
+                    future.result()
+
+            if state['n_blocks'] == n_blocks[folder]:
+                for f, block_writes in writes:
+                    if f == folder:
+                        for future in block_writes:
+                            future.result()
+                writes = [(f, w) for f, w in writes if f != folder]
+                cog_writes += close_outputs(states.pop(folder), zones, writer)
+                print('%s: %d blocks' % (folder, n_blocks[folder]))
+
+        for future in cog_writes:
+            future.result()
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser()
+    # mosaic folders, processed one after the other
+    parser.add_argument('folders', nargs='+')
+    parser.add_argument('--cog', action='store_true',
+                        help='write cloud-optimized GeoTIFFs')
+    parser.add_argument('--zones', nargs='*', default=[],
+                        help='label rasters of the zonal statistics')
+    parser.add_argument('--uncertainty', nargs='?', type=int, default=0,
+                        const=n_members,
+                        help='members of the gain uncertainty ensemble')
+    parser.add_argument('--platform', choices=['A', 'B'], default='A',
+                        help='Sentinel-3 platform of the gains')
+    parser.add_argument('--atmosphere', choices=['analytic', 'lut'],
+                        default='analytic',
+                        help='atmospheric coefficients (see sice_lut.py)')
+    parser.add_argument('--codec', nargs='*', default=[],
+                        help='codecs of the outputs, e.g. zstd or '
+                        'albedo_*=lerc_zstd (see sice_codecs.py)')
+    parser.add_argument('--pipeline', nargs='?', type=int, default=0,
+                        const=block_rows,
+                        help='pipelined execution by blocks of rows')
+    args = parser.parse_args(argv)
+
+    start_time = time.process_time()
+
+    InputFolders = [folder + '/' for folder in args.folders]
+    cog, zones, atmosphere = args.cog, args.zones, args.atmosphere
+    n_unc, platform, rows = args.uncertainty, args.platform, args.pipeline
+
+    if atmosphere == 'lut' and not os.path.isfile(sice_lut.lut_file):
+        print('ERROR: %s is missing, build it with python ./sice_lut.py build'
+              % sice_lut.lut_file)
+        sys.exit(1)
+
+    product_codecs = parse_codecs(args.codec)
+
+    if rows > 0:
+        pipelined(InputFolders, rows, atmosphere, cog, zones,
+                  product_codecs)
+
+    for InputFolder in InputFolders:
+
+        if rows == 0:
+            meta, inputs = read_inputs(InputFolder)
+            outputs = retrieval(**inputs, atmosphere=atmosphere)
+            write_outputs(outputs, meta, InputFolder, cog,
+                          product_codecs=product_codecs)
+            folder_stats(outputs, meta, zones, InputFolder)
+
+        if n_unc > 0:
+            # metadata of the outputs
+            meta, _ = read_inputs(InputFolder, Window(0, 0, 1, 1))
+            write_outputs(uncertainty(InputFolder, n_unc, platform,
+                                      atmosphere=atmosphere),
+                          meta, InputFolder, cog,
+                          product_codecs=product_codecs)
+
+    print("End SICE.py %s --- %s CPU seconds ---" %
+          (' '.join(InputFolders), time.process_time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+GeoTIFF codecs of the SICE outputs, selected per product.
+
+A codec is a GDAL compression with its predictor, e.g. DEFLATE or ZSTD with
+the floating point predictor, or LERC (alone or followed by DEFLATE or ZSTD).
+LERC is lossy within a maximum error per pixel: each product has an error
+budget (max_errors, e.g. 1e-4 for the albedos and reflectances, 0 for the
+lossless products). All the codecs compress with all the CPUs.
+
+Codecs are selected with specifications [pattern=]codec[:level][@max_error]:
+    zstd                     ZSTD for all the products,
+    albedo_*=lerc_zstd:9     LERC + ZSTD level 9 for the albedos, within
+                             their error budget,
+    r0=lerc@1e-3             LERC for r0 within 1e-3,
+the first specification whose pattern (fnmatch) matches a product being
+used, and the default codec if none does. Specifications without pattern
+(catch-alls) come after the others whatever their order, so that
+"nrt albedo_*=lerc_zstd" is the nrt preset except for the albedos. A
+pattern given twice is an error, its second codec being never used.
+Presets are named lists of specifications (presets, e.g. nrt or archive),
+chosen with codec_benchmark.py.
+
+"""
+
+from fnmatch import fnmatch
+
+import numpy as np
+
+# GDAL creation options of the codecs
+codecs = {'none': dict(compress='NONE'),
+          'deflate': dict(compress='DEFLATE'),
+          'deflate_fp': dict(compress='DEFLATE', predictor=3),
+          'zstd': dict(compress='ZSTD', predictor=3),
+          'lerc': dict(compress='LERC'),
+          'lerc_deflate': dict(compress='LERC_DEFLATE'),
+          'lerc_zstd': dict(compress='LERC_ZSTD')}
+
+# creation option of the compression level
+level_options = {'DEFLATE': 'zlevel', 'LERC_DEFLATE': 'zlevel',
+                 'ZSTD': 'zstd_level', 'LERC_ZSTD': 'zstd_level'}
+
+# max error of the LERC codecs, first matching pattern
+max_errors = [('albedo_*', 1e-4), ('rBRR_*', 1e-4), ('r0', 1e-4),
+              ('grain_diameter', 1e-3), ('snow_specific_surface_area', 1e-2),
+              ('al', 1e-2), ('O3_SICE', 1e-3), ('*', 0)]
+
+# codec of the products matching no specification, as before the codecs
+# were selectable
+default_codec = 'deflate'
+
+# presets measured with codec_benchmark.py: ZSTD level 1 writes twice as
+# fast as DEFLATE for the same size (NRT), LERC + ZSTD within the error
+# budgets halves the size of the lossless codecs (archive)
+presets = {'default': [default_codec],
+           'nrt': ['zstd:1'],
+           'archive': ['lerc_zstd:9']}
+
+
+def parse(specs):
+    '''
+    Parses codec specifications, or preset names.
+
+    INPUTS:
+        specs: Specifications [pattern=]codec[:level][@max_error]. [list]
+
+    OUTPUTS:
+        product_codecs: (pattern, codec, level, max_error) of the
+                        specifications, level and max_error being None if
+                        not given, the catch-alls last. [list of tuples]
+    '''
+
+    product_codecs = []
+
+    for spec in specs:
+        if spec in presets:
+            product_codecs += parse(presets[spec])
+            continue
+        pattern, _, codec = spec.rpartition('=')
+        codec, _, max_error = codec.partition('@')
+        codec, _, level = codec.partition(':')
+        if codec not in codecs:
+            raise ValueError('unknown codec %s (%s)'
+                             % (codec, ', '.join(codecs)))
+        product_codecs.append((pattern or '*', codec,
+                               int(level) if level else None,
+                               float(max_error) if max_error else None))
+
+    patterns = [pattern for pattern, _, _, _ in product_codecs]
+    for k, pattern in enumerate(patterns):
+        if pattern in patterns[:k]:
+            raise ValueError('codec of %s given twice (%s)'
+                             % (pattern, ' '.join(specs)))
+
+    # stable sort, the explicit patterns first
+    return sorted(product_codecs, key=lambda spec: spec[0] == '*')
+
+
+def max_error(name):
+    '''
+    Error budget of a product. [float]
+    '''
+
+    return next(error for pattern, error in max_errors
+                if fnmatch(name, pattern))
+
+
+def codec_options(name, product_codecs=None, dtype='float32'):
+    '''
+    GDAL creation options of a product.
+
+    INPUTS:
+        name: Product name, e.g. albedo_bb_planar_sw. [string]
+        product_codecs: Parsed specifications (see parse), the default codec
+                        if None. [list]
+        dtype: Data type of the product. [string]
+
+    OUTPUTS:
+        options: compress, predictor, level, max_z_error and num_threads.
+                 [dict]
+    '''
+
+    codec, level, error = default_codec, None, None
+    for pattern, c, l, e in product_codecs or []:
+        if fnmatch(name, pattern):
+            codec, level, error = c, l, e
+            break
+
+    options = dict(codecs[codec], num_threads='ALL_CPUS')
+
+    # the floating point predictor only applies to float bands
+    if options.get('predictor') == 3 and np.dtype(dtype).kind != 'f':
+        options['predictor'] = 2
+    if level is not None and options['compress'] in level_options:
+        options[level_options[options['compress']]] = level
+    if options['compress'].startswith('LERC'):
+        options['max_z_error'] = max_error(name) if error is None else error
+
+    return options
+
+
+def output_profile(profile, name, product_codecs=None):
+    '''
+    rasterio profile of a product, with its codec instead of the codec
+    options of profile.
+    '''
+
+    profile = {key: value for key, value in profile.items()
+               if key.lower() not in ['compress', 'predictor', 'zlevel',
+                                      'zstd_level', 'max_z_error',
+                                      'num_threads']}
+
+    return dict(profile, **codec_options(name, product_codecs,
+                                         profile.get('dtype', 'float32')))
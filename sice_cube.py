@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Time-series cube of the daily SICE products of a region (Zarr).
+
+The daily outputs of sice.py are one folder per date with one GeoTIFF per
+variable, so the albedo time series of a pixel over a season opens hundreds
+of files. The appender writes each day in a region-level Zarr cube:
+    - one (time, y, x) array per variable, on a daily time axis starting on
+      January 1st of the first appended year (a date is an index, days can be
+      appended in any order or re-appended after a reprocessing),
+    - chunks of 16 days x 256 x 256 pixels (4 MB of float32 before
+      compression): a season of one pixel reads ~12 chunks, a daily map of a
+      region a few tens,
+    - time, y and x coordinates with the CF attributes read by xarray
+      (xarray.open_zarr), the CRS and transform of the grid as attributes,
+    - a "processed" flag per day, set after the day is written,
+    - consolidated metadata (.zmetadata), opening the cube reads one file.
+Days never appended are not stored (missing chunks are read as NaN).
+
+The reader functions (open_variable, read_window, read_point) index the Zarr
+arrays lazily: only the chunks intersecting the requested window and dates
+are read.
+
+INPUTS:
+    append folder cube: Path to the sice.py output folder of a date and to
+                        the cube. [strings]
+    point cube variable x y: Cube, variable and coordinates of the pixel, in
+                             the grid CRS or in lon/lat with --lonlat.
+                             [string, string, floats]
+    --date: Date of the folder (YYYY-MM-DD), default the folder name. [string]
+    --variables: Variables to append. [list]
+    --start, --end: Date range of the series (YYYY-MM-DD). [strings]
+    --lonlat: x and y are longitude and latitude. [flag]
+
+OUTPUTS:
+    {cube}/{variable}: (time, y, x) arrays. [Zarr]
+    point: date and value of the processed days. [CSV on stdout]
+
+"""
+
+import argparse
+import datetime
+import os
+import time
+
+import numpy as np
+import rasterio
+import zarr
+from affine import Affine
+from numcodecs import Blosc
+from rasterio.warp import transform as warp_transform
+from rasterio.windows import Window
+
+variables = ['albedo_bb_planar_sw', 'albedo_bb_spherical_sw',
+             'grain_diameter', 'snow_specific_surface_area', 'conc',
+             'diagnostic_retrieval']
+
+time_chunk = 16
+space_chunk = 256
+
+compressor = Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE)
+
+epoch = datetime.date(1970, 1, 1)
+
+
+def to_day(date):
+    '''
+    Days since 1970-01-01 of a YYYY-MM-DD date.
+    '''
+
+    return (datetime.datetime.strptime(date, '%Y-%m-%d').date() - epoch).days
+
+
+def to_dates(days):
+    '''
+    Dates of days since 1970-01-01. [datetime64[D] array]
+    '''
+
+    return np.asarray(days, dtype='int64').astype('datetime64[D]')
+
+
+def create_cube(cube, profile, first_day):
+    '''
+    Creates an empty cube on the grid of a GeoTIFF profile, starting on
+    January 1st of the year of first_day.
+    '''
+
+    root = zarr.open_group(cube, mode='w')
+
+    year = (epoch + datetime.timedelta(days=int(first_day))).year
+    origin = (datetime.date(year, 1, 1) - epoch).days
+
+    transform = profile['transform']
+    root.attrs.update(crs=profile['crs'].to_wkt(), transform=list(transform)[:6],
+                      width=profile['width'], height=profile['height'],
+                      origin=origin)
+
+    x = transform.c + (np.arange(profile['width']) + 0.5) * transform.a
+    y = transform.f + (np.arange(profile['height']) + 0.5) * transform.e
+    for name, values in [('x', x), ('y', y)]:
+        coord = root.array(name, values, chunks=len(values))
+        coord.attrs.update(_ARRAY_DIMENSIONS=[name], units='m',
+                           standard_name='projection_' + name + '_coordinate')
+
+    root.zeros('time', shape=0, chunks=366, dtype='int32')
+    root['time'].attrs.update(_ARRAY_DIMENSIONS=['time'], calendar='standard',
+                              units='days since 1970-01-01')
+    root.zeros('processed', shape=0, chunks=366, dtype='uint8')
+    root['processed'].attrs.update(_ARRAY_DIMENSIONS=['time'])
+
+    return root
+
+
+def require_variable(root, name):
+    '''
+    (time, y, x) array of a variable, created if missing.
+    '''
+
+    if name in root:
+        return root[name]
+
+    array = root.create_dataset(
+        name, shape=(root['time'].shape[0], root.attrs['height'],
+                     root.attrs['width']),
+        chunks=(time_chunk, space_chunk, space_chunk), dtype='float32',
+        fill_value=np.nan, compressor=compressor)
+    array.attrs.update(_ARRAY_DIMENSIONS=['time', 'y', 'x'])
+
+    return array
+
+
+def extend_time(root, n_days):
+    '''
+    Extends the daily time axis of all the arrays to n_days.
+    '''
+
+    n_old = root['time'].shape[0]
+    if n_days <= n_old:
+        return
+
+    for name, array in root.arrays():
+        if array.attrs.get('_ARRAY_DIMENSIONS', [None])[0] == 'time':
+            array.resize((n_days,) + array.shape[1:])
+
+    root['time'][n_old:] = root.attrs['origin'] + np.arange(n_old, n_days)
+
+
+def append(folder, cube, date=None, names=variables):
+    '''
+    Writes the sice.py outputs of a date in the cube, created if missing.
+
+    INPUTS:
+        folder: Path to the sice.py output folder. [string]
+        cube: Path to the cube. [string]
+        date: Date of the outputs (YYYY-MM-DD), default the folder name.
+              [string]
+        names: Variables to write. [list]
+
+    OUTPUTS:
+        number of variables written. [int]
+    '''
+
+    folder = os.path.normpath(folder)
+    if date is None:
+        date = os.path.basename(folder)
+    day = to_day(date)
+
+    files = [(name, folder + os.sep + name + '.tif') for name in names]
+    files = [(name, path) for name, path in files if os.path.isfile(path)]
+    if not files:
+        print('ERROR: no output to append in %s' % folder)
+        return 0
+
+    with rasterio.open(files[0][1]) as src:
+        profile = src.profile
+
+    if os.path.isdir(cube):
+        root = zarr.open_group(cube, mode='r+')
+        if Affine(*root.attrs['transform']) != profile['transform'] \
+                or root.attrs['width'] != profile['width'] \
+                or root.attrs['height'] != profile['height']:
+            print('ERROR: %s is not on the grid of %s' % (folder, cube))
+            return 0
+    else:
+        root = create_cube(cube, profile, day)
+
+    index = day - root.attrs['origin']
+    if index < 0:
+        print('ERROR: %s is before the start of %s' % (date, cube))
+        return 0
+
+    extend_time(root, index + 1)
+    # the day is flagged once all its variables are written
+    root['processed'][index] = 0
+
+    for name, path in files:
+        with rasterio.open(path) as src:
+            data = src.read(1).astype('float32')
+            if src.nodata is not None and not np.isnan(src.nodata):
+                data[data == src.nodata] = np.nan
+        require_variable(root, name)[index] = data
+
+    root['processed'][index] = 1
+    zarr.consolidate_metadata(cube)
+
+    return len(files)
+
+
+def open_variable(cube, name):
+    '''
+    Lazy (time, y, x) array of a variable: indexing it only reads the
+    chunks intersecting the index.
+
+    OUTPUTS:
+        array: Zarr array. [zarr.Array]
+        days: Days since 1970-01-01 of the time axis. [array]
+        processed: True for the days appended. [boolean array]
+        transform: Transform of the grid. [Affine]
+    '''
+
+    root = zarr.open_consolidated(cube, mode='r')
+
+    return (root[name], root['time'][:], root['processed'][:].astype(bool),
+            Affine(*root.attrs['transform']))
+
+
+def time_range(days, processed, start=None, end=None):
+    '''
+    Slice of the time axis between two dates (included) and the processed
+    days in it.
+    '''
+
+    first = 0 if start is None else np.searchsorted(days, to_day(start))
+    last = len(days) if end is None \
+        else np.searchsorted(days, to_day(end), side='right')
+
+    return slice(first, last), processed[first:last]
+
+
+def read_window(cube, name, window, start=None, end=None):
+    '''
+    Time series of a window of the grid, on the processed days.
+
+    INPUTS:
+        cube: Path to the cube. [string]
+        name: Variable. [string]
+        window: Window of the grid. [rasterio.windows.Window]
+        start, end: Date range (YYYY-MM-DD), included. [strings]
+
+    OUTPUTS:
+        dates: Dates of the processed days. [datetime64[D] array]
+        values: (time, rows, cols) values. [3D array]
+    '''
+
+    array, days, processed, _ = open_variable(cube, name)
+    times, keep = time_range(days, processed, start, end)
+    rows, cols = window.toslices()
+
+    return to_dates(days[times][keep]), array[times, rows, cols][keep]
+
+
+def read_point(cube, name, x, y, start=None, end=None, crs=None):
+    '''
+    Time series of the pixel at a location, on the processed days.
+
+    INPUTS:
+        cube: Path to the cube. [string]
+        name: Variable. [string]
+        x, y: Coordinates of the location. [floats]
+        start, end: Date range (YYYY-MM-DD), included. [strings]
+        crs: CRS of x and y (e.g. 'EPSG:4326'), default the grid CRS.
+             [string]
+
+    OUTPUTS:
+        dates: Dates of the processed days. [datetime64[D] array]
+        values: Values of the pixel. [array]
+
+    Raises a ValueError if the location is outside the grid.
+    '''
+
+    root = zarr.open_consolidated(cube, mode='r')
+    if crs is not None:
+        xs, ys = warp_transform(crs, root.attrs['crs'], [x], [y])
+        x, y = xs[0], ys[0]
+
+    _, _, _, transform = open_variable(cube, name)
+    col, row = ~transform * (x, y)
+    col, row = int(np.floor(col)), int(np.floor(row))
+    if not (0 <= col < root.attrs['width']
+            and 0 <= row < root.attrs['height']):
+        raise ValueError('(%s, %s) is outside the grid of %s' % (x, y, cube))
+
+    dates, values = read_window(cube, name, Window(col, row, 1, 1), start,
+                                end)
+
+    return dates, values[:, 0, 0]
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='action')
+
+    parser_append = subparsers.add_parser('append')
+    parser_append.add_argument('folder')
+    parser_append.add_argument('cube')
+    parser_append.add_argument('--date', default=None)
+    parser_append.add_argument('--variables', nargs='+', default=variables)
+
+    parser_point = subparsers.add_parser('point')
+    parser_point.add_argument('cube')
+    parser_point.add_argument('variable')
+    parser_point.add_argument('x', type=float)
+    parser_point.add_argument('y', type=float)
+    parser_point.add_argument('--start', default=None)
+    parser_point.add_argument('--end', default=None)
+    parser_point.add_argument('--lonlat', action='store_true',
+                              help='x and y are longitude and latitude')
+    args = parser.parse_args(argv)
+
+    start_time = time.time()
+
+    if args.action == 'append':
+        n = append(args.folder, args.cube, args.date, args.variables)
+        print('End sice_cube.py append %s, %d variables --- %s seconds ---'
+              % (args.folder, n, time.time() - start_time))
+    elif args.action == 'point':
+        try:
+            dates, values = read_point(args.cube, args.variable, args.x,
+                                       args.y, args.start, args.end,
+                                       'EPSG:4326' if args.lonlat else None)
+        except ValueError as e:
+            print('ERROR: %s' % e)
+            return
+        print('date,%s' % args.variable)
+        for date, value in zip(dates, values):
+            print('%s,%s' % (date, value))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
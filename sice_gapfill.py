@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Gapless daily broadband albedo (SICE_BBA) from the daily SICE mosaics.
+
+For each day of the period, the observed albedo of a pixel is the SICE
+planar shortwave albedo (albedo_bb_planar_sw) or, where the retrieval
+failed on a cloud-free pixel, the empirical broadband albedo (BBA_emp).
+Cloudy and missing days are then filled in time:
+    - linear interpolation between the previous and the next observation of
+      the pixel,
+    - the nearest observation before the first or after the last one,
+and the gapless series is smoothed with a centered moving average.
+
+The interpolation needs the next observation of each pixel, which may be
+weeks later, so the period is not streamed day by day but strip by strip:
+the daily files are read on windows of a few rows, the whole period of a
+strip is filled with vectorized operations along the time axis, and the
+strip is written in the daily outputs. The strip height is derived from the
+memory budget, so a full season at 300 m runs in a few GB.
+
+INPUTS:
+    mosaic_root: Folder of the daily mosaics ({mosaic_root}/{date}). [string]
+    start, end: First and last dates of the period (YYYY-MM-DD). [strings]
+    out: Output folder. [string]
+    --smooth: Length of the moving average in days, 1 for no smoothing.
+              [int]
+    --memory: Memory budget in MB. [int]
+
+OUTPUTS:
+    {out}/{date}.tif: gapless broadband albedo of every day of the period.
+                      [.tif]
+
+"""
+
+import argparse
+import datetime
+import os
+import time
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+smooth_days = 5
+memory_budget = 4000
+
+# rows per strip of the output files, the strips of the gap-filling being
+# multiples of it
+rows_per_strip = 16
+
+# bytes per pixel and day while filling a strip: observations, indices of
+# the previous and next observation, interpolation and moving average
+bytes_per_value = 40
+
+
+def daterange(start, end):
+    '''
+    Dates from start to end, included. [list of YYYY-MM-DD strings]
+    '''
+
+    first = datetime.datetime.strptime(start, '%Y-%m-%d').date()
+    last = datetime.datetime.strptime(end, '%Y-%m-%d').date()
+
+    return [str(first + datetime.timedelta(days=i))
+            for i in range((last - first).days + 1)]
+
+
+def read_albedo(path, window):
+    '''
+    Broadband albedo of a window, NaN outside (0, 1] or if the file is
+    missing.
+    '''
+
+    if not os.path.isfile(path):
+        return None
+
+    with rasterio.open(path) as src:
+        data = src.read(1, window=window).astype('float32')
+
+    with np.errstate(invalid='ignore'):
+        data[~((data > 0) & (data <= 1))] = np.nan
+
+    return data
+
+
+def read_observations(folders, window):
+    '''
+    Daily observed albedo of a window: SICE albedo, else empirical BBA.
+
+    OUTPUTS:
+        obs: (time, rows, cols) albedo, NaN where not observed. [3D array]
+    '''
+
+    obs = np.full((len(folders), window.height, window.width), np.nan,
+                  dtype='float32')
+
+    for i, folder in enumerate(folders):
+        sice_bba = read_albedo(folder + os.sep + 'albedo_bb_planar_sw.tif',
+                               window)
+        emp_bba = read_albedo(folder + os.sep + 'BBA_emp.tif', window)
+        if sice_bba is not None:
+            obs[i] = sice_bba
+        if emp_bba is not None:
+            obs[i] = np.where(np.isnan(obs[i]), emp_bba, obs[i])
+
+    return obs
+
+
+def fill_gaps(obs):
+    '''
+    Linear interpolation in time between the previous and the next
+    observation of each pixel, nearest observation at the ends of the
+    series.
+
+    INPUTS:
+        obs: (time, rows, cols) albedo, NaN where not observed. [3D array]
+
+    OUTPUTS:
+        filled: Gapless albedo, NaN where never observed. [3D array]
+    '''
+
+    n_days = obs.shape[0]
+    days = np.arange(n_days, dtype='int32')[:, None, None]
+    observed = ~np.isnan(obs)
+
+    # index of the previous (next) observation, -1 (n_days) if none
+    previous = np.maximum.accumulate(np.where(observed, days, -1), axis=0)
+    following = np.minimum.accumulate(
+        np.where(observed, days, n_days)[::-1], axis=0)[::-1]
+
+    has_previous = previous >= 0
+    has_following = following < n_days
+    previous = np.where(has_previous, previous, following)
+    following = np.where(has_following, following, previous)
+    previous = np.clip(previous, 0, n_days - 1)
+    following = np.clip(following, 0, n_days - 1)
+
+    v0 = np.take_along_axis(obs, previous, axis=0)
+    v1 = np.take_along_axis(obs, following, axis=0)
+    span = following - previous
+    weight = (days - previous).astype('float32')
+    weight /= np.maximum(span, 1)
+
+    return (v0 + weight * (v1 - v0)).astype('float32')
+
+
+def moving_average(data, length=smooth_days):
+    '''
+    Centered moving average along the time axis, on shorter windows at the
+    ends of the series.
+    '''
+
+    if length <= 1:
+        return data
+
+    half = length // 2
+    n_days = data.shape[0]
+    cumsum = np.concatenate([np.zeros((1,) + data.shape[1:]),
+                             np.cumsum(data, axis=0, dtype='float64')])
+    first = np.clip(np.arange(n_days) - half, 0, n_days)
+    last = np.clip(np.arange(n_days) + half + 1, 0, n_days)
+    count = (last - first)[:, None, None]
+
+    return ((cumsum[last] - cumsum[first]) / count).astype('float32')
+
+
+def strip_height(n_days, width, memory=memory_budget):
+    '''
+    Rows of a strip within the memory budget (in MB).
+    '''
+
+    rows = memory * 1e6 / (bytes_per_value * n_days * width)
+
+    return max(rows_per_strip, int(rows // rows_per_strip) * rows_per_strip)
+
+
+def gapfill(mosaic_root, start, end, out, smooth=smooth_days,
+            memory=memory_budget):
+    '''
+    Writes the gapless daily broadband albedo of a period.
+
+    INPUTS:
+        mosaic_root: Folder of the daily mosaics. [string]
+        start, end: First and last dates of the period (YYYY-MM-DD). [strings]
+        out: Output folder. [string]
+        smooth: Length of the moving average in days. [int]
+        memory: Memory budget in MB. [int]
+
+    OUTPUTS:
+        number of days written. [int]
+    '''
+
+    dates = daterange(start, end)
+    folders = [mosaic_root + os.sep + date for date in dates]
+
+    grid_files = [folder + os.sep + name for folder in folders
+                  for name in ['albedo_bb_planar_sw.tif', 'BBA_emp.tif']
+                  if os.path.isfile(folder + os.sep + name)]
+    if not grid_files:
+        print('ERROR: no mosaic in %s from %s to %s' % (mosaic_root, start,
+                                                        end))
+        return 0
+
+    with rasterio.open(grid_files[0]) as src:
+        profile = src.profile
+    profile.update(driver='GTiff', count=1, dtype='float32', nodata=np.nan,
+                   tiled=False, blockysize=rows_per_strip, compress='DEFLATE',
+                   predictor=3)
+    profile.pop('blockxsize', None)
+
+    os.makedirs(out, exist_ok=True)
+    rows = strip_height(len(dates), profile['width'], memory)
+    tmp_files = [out + os.sep + date + '.tmp.tif' for date in dates]
+    outputs = [rasterio.open(path, 'w', **profile) for path in tmp_files]
+
+    try:
+        for row in range(0, profile['height'], rows):
+            window = Window(0, row, profile['width'],
+                            min(rows, profile['height'] - row))
+            filled = moving_average(
+                fill_gaps(read_observations(folders, window)), smooth)
+            for dst, day in zip(outputs, filled):
+                dst.write(day, 1, window=window)
+    finally:
+        for dst in outputs:
+            dst.close()
+
+    for tmp_file, date in zip(tmp_files, dates):
+        os.replace(tmp_file, out + os.sep + date + '.tif')
+
+    return len(dates)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mosaic_root')
+    parser.add_argument('start')
+    parser.add_argument('end')
+    parser.add_argument('out')
+    parser.add_argument('--smooth', type=int, default=smooth_days,
+                        help='length of the moving average in days')
+    parser.add_argument('--memory', type=int, default=memory_budget,
+                        help='memory budget in MB')
+    args = parser.parse_args()
+
+    start_time = time.time()
+
+    n_days = gapfill(args.mosaic_root, args.start, args.end, args.out,
+                     args.smooth, args.memory)
+
+    print('End sice_gapfill.py %s to %s, %d days --- %s seconds ---'
+          % (args.start, args.end, n_days, time.time() - start_time))
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Incremental run of sice.py on a mosaic that was already processed.
+
+The mosaic is split in tiles and a hash of the inputs of the retrieval
+(r_TOA_01..21, O3, WV, SZA, SAA, OZA, OAA, height) is computed for each
+tile. The hashes are stored next to the outputs, together with a hash of
+the code (sice.py, sice_lib.py, constants.py, the optical depth tables and
+the modules of the atmosphere LUT, codecs and COGs) and of the output
+settings (codecs and --cog). At the next run:
+    - if no tile changed, the mosaic is skipped,
+    - else the retrieval only runs on the changed tiles, which are patched
+      in the existing output files,
+    - without stored hashes, with missing outputs, after a code change or
+      with other output settings, the whole mosaic is processed as by sice.py.
+The retrieval is done pixel by pixel, so the patched tiles are identical to
+a full run. Re-running a mosaic after a late scene only changed a strip of
+pixels, or without any change, is therefore nearly free.
+
+INPUTS:
+    folder: Path to the mosaic folder. [string]
+    --tile: Tile size in pixels. [int]
+    --force: Process the whole mosaic. [flag]
+    --cog: Write cloud-optimized GeoTIFFs (see cog.py). [flag]
+    --codec: Codec specifications of the outputs (see sice_codecs.py).
+             [strings]
+    --zones: Label rasters of the zonal statistics (see sice_zonal.py).
+             [strings]
+
+OUTPUTS:
+    {folder}/{variable}.tif: same outputs as sice.py. [.tif]
+    {folder}/sice_tiles.npz: input hashes of the tiles. [.npz]
+
+"""
+
+import argparse
+import hashlib
+import os
+import time
+
+import numpy as np
+import rasterio as rio
+from rasterio.windows import Window
+
+import sice
+import sice_zonal
+from cog import write_cog
+from sice_codecs import output_profile, parse as parse_codecs
+
+tile_size = 256
+
+state_file = 'sice_tiles.npz'
+
+code_files = ['sice.py', 'sice_lib.py', 'constants.py', 'sice_lut.py',
+              'sice_codecs.py', 'cog.py', 'tg_vod.dat', 'tg_water_vod.dat']
+
+
+def code_hash(cog=False, product_codecs=None):
+    '''
+    sha1 of the code and tables used by the retrieval, and of the output
+    settings, so that a change of codec or of cog reprocesses the mosaic.
+    '''
+
+    sha = hashlib.sha1()
+    code_folder = os.path.dirname(os.path.abspath(__file__))
+
+    for filename in code_files:
+        with open(code_folder + os.sep + filename, 'rb') as f:
+            sha.update(f.read())
+
+    sha.update(repr((bool(cog), list(product_codecs or []))).encode())
+
+    return sha.hexdigest()
+
+
+def tiles(shape, size=tile_size):
+    '''
+    Tiles of a mosaic.
+
+    OUTPUTS:
+        (tile row, tile column, row slice, column slice) of each
+        tile. [list of tuples]
+    '''
+
+    return [(i, j, slice(r, min(r + size, shape[0])),
+             slice(c, min(c + size, shape[1])))
+            for i, r in enumerate(range(0, shape[0], size))
+            for j, c in enumerate(range(0, shape[1], size))]
+
+
+def tile_hashes(inputs, shape, size=tile_size):
+    '''
+    Hash of the retrieval inputs of each tile.
+
+    INPUTS:
+        inputs: Retrieval inputs (see sice.read_inputs). [dict of arrays]
+        shape: Shape of the mosaic. [tuple]
+        size: Tile size in pixels. [int]
+
+    OUTPUTS:
+        hashes: sha1 of each tile. [2D array of strings]
+    '''
+
+    mosaic_tiles = tiles(shape, size)
+    hashes = np.empty((mosaic_tiles[-1][0] + 1, mosaic_tiles[-1][1] + 1),
+                      dtype='<U40')
+
+    for i, j, rows, cols in mosaic_tiles:
+        sha = hashlib.sha1()
+        for name in sorted(inputs):
+            tile = inputs[name][..., rows, cols]
+            sha.update(np.ascontiguousarray(tile, dtype='float32').tobytes())
+        hashes[i, j] = sha.hexdigest()
+
+    return hashes
+
+
+def stack_tiles(inputs, selected, size=tile_size):
+    '''
+    Stacks the selected tiles of the inputs on top of each other, padded
+    with NaN, so that the retrieval runs on them in one call.
+
+    INPUTS:
+        inputs: Retrieval inputs. [dict of arrays]
+        selected: Tiles to stack (see tiles). [list of tuples]
+        size: Tile size in pixels. [int]
+
+    OUTPUTS:
+        stacked: Inputs of the selected tiles. [dict of arrays]
+    '''
+
+    stacked = {}
+
+    for name, data in inputs.items():
+        out = np.full(data.shape[:-2] + (len(selected) * size, size), np.nan,
+                      dtype=data.dtype)
+        for k, (_, _, rows, cols) in enumerate(selected):
+            out[..., k * size:k * size + rows.stop - rows.start,
+                :cols.stop - cols.start] = data[..., rows, cols]
+        stacked[name] = out
+
+    return stacked
+
+
+def load_state(folder):
+    '''
+    Tile hashes and code hash of the previous run, None if missing.
+    '''
+
+    filename = folder + state_file
+
+    if not os.path.isfile(filename):
+        return None, None, []
+
+    with np.load(filename) as state:
+        return (state['hashes'], str(state['code']),
+                list(state['outputs']))
+
+
+def save_state(folder, hashes, code, outputs):
+
+    # written through a temporary file, not to leave a partial state
+    tmp_file = folder + state_file + '.tmp.npz'
+    np.savez(tmp_file, hashes=hashes, code=code, outputs=np.array(outputs))
+    os.replace(tmp_file, folder + state_file)
+
+
+def patch_outputs(outputs, selected, folder, size=tile_size, cog=False,
+                  product_codecs=None):
+    '''
+    Writes the retrieval outputs of the selected tiles in the existing
+    output files. COGs are rewritten whole, so that their overviews are
+    recomputed.
+    '''
+
+    for var_name, var in outputs.items():
+        if cog:
+            with rio.open(folder + var_name + '.tif') as src:
+                data = src.read(1)
+                profile = src.profile
+            for k, (_, _, rows, cols) in enumerate(selected):
+                height = rows.stop - rows.start
+                width = cols.stop - cols.start
+                data[rows, cols] = var[k * size:k * size + height, :width]
+            write_cog(folder + var_name + '.tif', data,
+                      output_profile(profile, var_name, product_codecs))
+            continue
+        with rio.open(folder + var_name + '.tif', 'r+') as dst:
+            for k, (_, _, rows, cols) in enumerate(selected):
+                height = rows.stop - rows.start
+                width = cols.stop - cols.start
+                dst.write(var[k * size:k * size + height, :width]
+                          .astype('float32'), 1,
+                          window=Window(cols.start, rows.start, width, height))
+
+
+def update(InputFolder, size=tile_size, force=False, cog=False, zones=(),
+           product_codecs=None):
+    '''
+    Runs the retrieval on the tiles of a mosaic whose inputs changed since
+    the previous run.
+
+    INPUTS:
+        InputFolder: Path to the mosaic folder, ending with a separator. [string]
+        size: Tile size in pixels. [int]
+        force: If True, the whole mosaic is processed. [boolean]
+        cog: If True, the outputs are cloud-optimized GeoTIFFs. [boolean]
+        zones: Label rasters of the zonal statistics. [list]
+        product_codecs: Codec of each product (see sice_codecs.py). [list]
+
+    OUTPUTS:
+        number of processed tiles. [int]
+    '''
+
+    meta, inputs = sice.read_inputs(InputFolder)
+    shape = inputs['sza'].shape
+
+    hashes = tile_hashes(inputs, shape, size)
+    code = code_hash(cog, product_codecs)
+    old_hashes, old_code, output_names = load_state(InputFolder)
+
+    outputs_exist = len(output_names) > 0 and all(
+        os.path.isfile(InputFolder + name + '.tif') for name in output_names)
+
+    if force or old_hashes is None or old_hashes.shape != hashes.shape \
+            or old_code != code or not outputs_exist:
+        outputs = sice.retrieval(**inputs)
+        sice.write_outputs(outputs, meta, InputFolder, cog,
+                           product_codecs=product_codecs)
+        sice_zonal.folder_stats(outputs, meta, zones, InputFolder)
+        save_state(InputFolder, hashes, code, list(outputs))
+        return hashes.size
+
+    changed = hashes != old_hashes
+    if not changed.any():
+        print('%s: inputs unchanged, mosaic skipped' % InputFolder)
+        return 0
+
+    selected = [t for t in tiles(shape, size) if changed[t[0], t[1]]]
+    outputs = sice.retrieval(**stack_tiles(inputs, selected, size))
+    patch_outputs(outputs, selected, InputFolder, size, cog, product_codecs)
+    if zones:
+        # statistics of the whole mosaic, from the patched files
+        sice_zonal.folder_stats(*sice_zonal.read_outputs(InputFolder), zones,
+                                InputFolder)
+    save_state(InputFolder, hashes, code, list(outputs))
+
+    return len(selected)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('folder')
+    parser.add_argument('--tile', type=int, default=tile_size)
+    parser.add_argument('--force', action='store_true',
+                        help='process the whole mosaic')
+    parser.add_argument('--cog', action='store_true',
+                        help='write cloud-optimized GeoTIFFs')
+    parser.add_argument('--zones', nargs='*', default=[],
+                        help='label rasters of the zonal statistics')
+    parser.add_argument('--codec', nargs='*', default=[],
+                        help='codecs of the outputs, e.g. zstd or '
+                        'albedo_*=lerc_zstd (see sice_codecs.py)')
+    args = parser.parse_args(argv)
+
+    start_time = time.process_time()
+
+    InputFolder = args.folder + '/'
+    n_tiles = update(InputFolder, size=args.tile, force=args.force,
+                     cog=args.cog, zones=args.zones,
+                     product_codecs=parse_codecs(args.codec))
+
+    print("End sice_incremental.py %s, %d tiles --- %s CPU seconds ---" %
+          (InputFolder, n_tiles, time.process_time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
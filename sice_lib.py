@@ -8,6 +8,7 @@ Update 07032019
      alb2rtoa                  calculates TOA reflectance from surface albedo
      salbed                    calculates ratm for albedo correction (?)
      zbrent                    equation solver
+     bisection                 vectorized equation solver
      quad_func                 calculation of quadratic parameters
      funp                      snow spectral planar and spherical albedo function
 
@@ -446,6 +447,39 @@ def zbrent(f, x0, x1, max_iter=100, tolerance=1e-6):
  
     return x1
 
+# %% =====================================================================
+
+
+def bisection(f, x0, x1, max_iter=100, tolerance=1e-6):
+    # Vectorized equation solver: bisection of the equations f(x) = 0 of a
+    # set of pixels, f returning one value per pixel. All the intervals are
+    # halved at once, so solving n pixels takes about log2((x1 - x0) / tolerance)
+    # vectorized evaluations of f instead of n calls of zbrent.
+    # Returns -999 where the root is not bracketed by [x0, x1].
+
+    fx0 = f(x0)
+    fx1 = f(x1)
+
+    lo = np.full(np.shape(fx0), x0, dtype='float64')
+    hi = np.full(np.shape(fx0), x1, dtype='float64')
+    flo = fx0
+
+    for i in range(max_iter):
+        if np.all(hi - lo <= tolerance):
+            break
+        mid = (lo + hi) / 2
+        fmid = f(mid)
+        # root in [lo, mid]
+        left = flo * fmid <= 0
+        hi = np.where(left, mid, hi)
+        lo = np.where(left, lo, mid)
+        flo = np.where(left, flo, fmid)
+
+    root = (lo + hi) / 2
+    root[~(fx0 * fx1 <= 0)] = -999
+
+    return root
+
 # %% =====================================================================     
 
 
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Lookup table (LUT) of the atmospheric coefficients of the retrieval, used by
+sice.py with --atmosphere lut instead of sice_lib.aerosol_properties and
+sice_lib.prepare_coef.
+
+With the aerosol optical thickness fixed (aot = 0.1), the coefficients of a
+channel only depend on the surface height and the geometry, and split into
+tables of at most three dimensions:
+    - tau, ratm: height,
+    - t1, t2: height and solar (viewing) air mass 1 / cos(sza) (1 / cos(vza)),
+      the same table serving both,
+    - p: height and scattering angle arccos(co) (co: cosine of the
+      scattering angle, see sice_lib.view_geometry), the aerosol phase
+      function being too peaked in co for a linear interpolation,
+    - astra, rms: height, 1 / cos(sza) and 1 / cos(vza),
+with r = p * astra + rms. The tables are computed once with the sice_lib
+functions, saved in lut_file and interpolated (multilinear, on regular
+grids) for the 21 channels at once.
+
+The interpolation error of each table is measured when the LUT is built, at
+the cell centres and on random points of the grids, and saved with the LUT
+(max absolute error per coefficient, all channels). Values out of the grids
+are clipped to the grids: height in [-200, 5000] m, sza and vza below 75
+degrees.
+
+INPUTS:
+    build: Computes and saves the LUT. [action]
+        --lut: Path to the LUT file. [string]
+    check mosaic: Compares the retrieval with the LUT and the analytic
+                  coefficients on a mosaic folder. [action]
+
+OUTPUTS:
+    {lut}: Tables, grids and interpolation errors. [.npz]
+
+"""
+
+import argparse
+import os
+import time
+from functools import lru_cache
+
+import numpy as np
+
+import sice_lib as sl
+
+lut_file = './atmosphere_lut.npz'
+
+aot = 0.1
+
+# regular grids: height (m), air masses and scattering angle (degrees). The
+# height grid has a node at 0 m, where the pressure correction of
+# sice_lib.aerosol_properties starts
+height_grid = (-200., 5000., 27)
+airmass_grid = (1., 1. / np.cos(np.deg2rad(75.)), 41)
+angle_grid = (0., 180., 361)
+
+# tables and the coefficients they hold, channel last
+tables_coefficients = {'h': ['tau', 'ratm'], 't': ['t'], 'p': ['p'],
+                       'hmm': ['astra', 'rms']}
+
+
+def grid(bounds):
+
+    return np.linspace(*bounds)
+
+
+def axes(name):
+    '''
+    Grids of the dimensions of a table.
+    '''
+
+    return {'h': [height_grid], 't': [height_grid, airmass_grid],
+            'p': [height_grid, angle_grid],
+            'hmm': [height_grid, airmass_grid, airmass_grid]}[name]
+
+
+def scattering_angle(co):
+
+    return np.rad2deg(np.arccos(np.clip(co, -1, 1)))
+
+
+def analytic(height, m1, m2, co):
+    '''
+    Atmospheric coefficients of the 21 channels computed by sice_lib.
+
+    INPUTS:
+        height: Surface height in m. [array]
+        m1, m2: Solar and viewing air masses. [arrays]
+        co: Cosine term of the scattering angle. [array]
+
+    OUTPUTS:
+        coefs: tau, ratm, t1, t2, p, astra, rms, shaped input shape + (21,).
+               [dict of arrays]
+    '''
+
+    height, m1, m2, co = np.broadcast_arrays(height, m1, m2, co)
+    shape = height.shape
+    height, m1, m2, co = [np.reshape(x.astype('float64'), (-1, 1))
+                          for x in (height, m1, m2, co)]
+    am1 = 1. / m1
+    am2 = 1. / m2
+    amf = m1 + m2
+
+    tau, p, g, gaer, taumol, tauaer = sl.aerosol_properties(aot, height, co)
+    t1, t2, ratm, r, astra, rms = sl.prepare_coef(tau, g, p, am1, am2, amf,
+                                                  gaer, taumol, tauaer)
+
+    coefs = dict(tau=tau, ratm=ratm, t1=t1, t2=t2, p=p, astra=astra, rms=rms)
+
+    return {name: np.moveaxis(v[:, :, 0], 0, -1).reshape(shape + (21,))
+            for name, v in coefs.items()}
+
+
+def build_tables():
+    '''
+    Computes the tables of the coefficients on their grids.
+
+    OUTPUTS:
+        tables: Tables, the coefficients they hold being stacked on the last
+                (channel) axis. [dict of arrays]
+    '''
+
+    tables = {}
+
+    for name, coefs in tables_coefficients.items():
+        nodes = np.meshgrid(*[grid(bounds) for bounds in axes(name)],
+                            indexing='ij')
+        h = nodes[0]
+        m1 = nodes[1] if name in ['t', 'hmm'] else 1
+        m2 = nodes[2] if name == 'hmm' else m1
+        co = np.cos(np.deg2rad(nodes[1])) if name == 'p' else 0
+        values = analytic(h, m1, m2, co)
+        values['t'] = values['t1']
+        tables[name] = np.concatenate([values[c] for c in coefs],
+                                      axis=-1).astype('float32')
+
+    return tables
+
+
+def interpolate(table, bounds, points):
+    '''
+    Multilinear interpolation of a table on regular grids, for all the
+    channels at once.
+
+    INPUTS:
+        table: Values on the grids, channels on the last axis. [array]
+        bounds: (first, last, number of values) of each grid. [list]
+        points: Coordinates of the points on each grid, clipped to the
+                grids. [list of 1D arrays]
+
+    OUTPUTS:
+        values: Interpolated values. [(n_points, n_channels) array]
+    '''
+
+    flat_table = table.reshape(-1, table.shape[-1])
+    strides = np.cumprod((table.shape[1:-1] + (1,))[::-1])[::-1]
+
+    base = 0
+    weights = []
+    for (first, last, n), x, stride in zip(bounds, points, strides):
+        step = (last - first) / (n - 1)
+        position = np.clip((x - first) / step, 0, n - 1)
+        i = np.minimum(position.astype('int32'), n - 2)
+        base = base + i * stride
+        weights.append((position - i).astype('float32')[:, None])
+
+    values = 0
+    for corner in range(2 ** len(bounds)):
+        weight = 1
+        offset = 0
+        for d, stride in enumerate(strides):
+            if (corner >> d) & 1:
+                weight = weight * weights[d]
+                offset += stride
+            else:
+                weight = weight * (1 - weights[d])
+        values = values + weight * np.take(flat_table, base + offset, axis=0)
+
+    return values
+
+
+@lru_cache(maxsize=None)
+def load(filename=lut_file):
+    '''
+    Loads the LUT, built beforehand with "sice_lut.py build".
+
+    OUTPUTS:
+        tables: Tables of the coefficients. [dict of arrays]
+    '''
+
+    if not os.path.isfile(filename):
+        raise FileNotFoundError('%s is missing, build it with python '
+                                './sice_lut.py build --lut %s'
+                                % (filename, filename))
+
+    with np.load(filename) as f:
+        if float(f['aot']) != aot:
+            raise ValueError('%s is built for aot = %s' % (filename, f['aot']))
+        return {name: f[name] for name in tables_coefficients}
+
+
+def interpolate_coefficients(tables, h, m1, m2, angle):
+    '''
+    tau, ratm, t1, t2 and r of a set of points. [(n_points, 21) arrays]
+    '''
+
+    tau_ratm = interpolate(tables['h'], axes('h'), [h])
+    astra_rms = interpolate(tables['hmm'], axes('hmm'), [h, m1, m2])
+    p = interpolate(tables['p'], axes('p'), [h, angle])
+
+    return dict(tau=tau_ratm[:, :21], ratm=tau_ratm[:, 21:],
+                t1=interpolate(tables['t'], axes('t'), [h, m1]),
+                t2=interpolate(tables['t'], axes('t'), [h, m2]),
+                r=p * astra_rms[:, :21] + astra_rms[:, 21:])
+
+
+def coefficients_lut(am1, am2, co, height, filename=None):
+    '''
+    Atmospheric coefficients of the retrieval interpolated in the LUT.
+
+    INPUTS:
+        am1, am2: Cosines of the solar and viewing zenith angles. [arrays]
+        co: Cosine term of the scattering angle. [array]
+        height: Surface height in m. [array]
+        filename: Path to the LUT, lut_file if None. [string]
+
+    OUTPUTS:
+        tau, t1, t2, ratm, r: Coefficients of the 21 channels, NaN where an
+                              input is NaN. [3D arrays]
+    '''
+
+    tables = load(filename or lut_file)
+    shape = (21,) + np.shape(am1)
+
+    valid = ~(np.isnan(am1) | np.isnan(am2) | np.isnan(co)
+              | np.isnan(height))
+    coefs = interpolate_coefficients(tables, height[valid], 1. / am1[valid],
+                                     1. / am2[valid],
+                                     scattering_angle(co[valid]))
+
+    out = {}
+    for name, values in coefs.items():
+        out[name] = np.full(shape, np.nan, dtype='float32')
+        out[name][:, valid] = values.T
+
+    return out['tau'], out['t1'], out['t2'], out['ratm'], out['r']
+
+
+def interpolation_errors(tables, n_random=20000, seed=0):
+    '''
+    Max absolute interpolation error of each coefficient (all channels), at
+    the cell centres and on random points of the grids.
+    '''
+
+    random = np.random.RandomState(seed)
+
+    def points(bounds):
+        g = grid(bounds)
+        centres = (g[:-1] + g[1:]) / 2
+        return np.concatenate([random.choice(centres, n_random),
+                               random.uniform(bounds[0], bounds[1],
+                                              n_random)])
+
+    h = points(height_grid)
+    m1 = points(airmass_grid)
+    m2 = points(airmass_grid)
+    angle = points(angle_grid)
+
+    exact = analytic(h, m1, m2, np.cos(np.deg2rad(angle)))
+    exact['r'] = exact['p'] * exact['astra'] + exact['rms']
+    values = interpolate_coefficients(tables, h, m1, m2, angle)
+
+    return {name: float(np.nanmax(np.abs(values[name] - exact[name])))
+            for name in values}
+
+
+def save(filename=lut_file):
+    '''
+    Builds the LUT and saves it with its interpolation errors.
+
+    OUTPUTS:
+        errors: Max absolute error of each coefficient. [dict]
+    '''
+
+    tables = build_tables()
+    errors = interpolation_errors(tables)
+
+    # temporary file of the process, concurrent builds replacing the LUT
+    # with complete files only
+    tmp_file = '%s.%d.tmp.npz' % (filename, os.getpid())
+    np.savez(tmp_file, aot=aot,
+             errors=np.array([errors[name] for name in sorted(errors)]),
+             error_names=np.array(sorted(errors)), **tables)
+    os.replace(tmp_file, filename)
+
+    return errors
+
+
+def check(InputFolder, filename=lut_file):
+    '''
+    Max absolute difference of the retrieval outputs computed with the LUT
+    and with the analytic coefficients on a mosaic.
+
+    OUTPUTS:
+        differences: Max absolute difference of each output. [dict]
+    '''
+
+    # imported here, sice importing this module (also as sice_lut when this
+    # file runs as a script)
+    import sice
+    import sice_lut
+    sice_lut.lut_file = filename
+
+    outputs = []
+    for atmosphere in ['analytic', 'lut']:
+        _, inputs = sice.read_inputs(InputFolder)
+        outputs.append(sice.retrieval(**inputs, atmosphere=atmosphere))
+
+    return {name: float(np.nanmax(np.abs(outputs[1][name] - outputs[0][name])))
+            for name in outputs[0]
+            if np.any(~np.isnan(outputs[0][name]))}
+
+
+def main(argv=None):
+
+    global lut_file
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='action')
+    parser_build = subparsers.add_parser('build')
+    parser_build.add_argument('--lut', default=lut_file)
+    parser_check = subparsers.add_parser('check')
+    parser_check.add_argument('mosaic')
+    parser_check.add_argument('--lut', default=lut_file)
+    args = parser.parse_args(argv)
+
+    # the retrieval reads the LUT of lut_file
+    lut_file = args.lut
+    start_time = time.time()
+
+    if args.action == 'build':
+        errors = save(args.lut)
+        print('max interpolation errors:')
+        for name, error in sorted(errors.items()):
+            print('    %s: %.2e' % (name, error))
+    elif args.action == 'check':
+        differences = check(args.mosaic + '/', args.lut)
+        print('max differences LUT - analytic:')
+        for name, difference in differences.items():
+            print('    %s: %.2e' % (name, difference))
+    else:
+        parser.print_help()
+
+    print('End sice_lut.py --- %s seconds ---' % (time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
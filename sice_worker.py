@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Long-lived worker running the Python steps of the SICE chain from a local
+job queue, instead of one cold-start process per step.
+
+The worker imports NumPy, rasterio, GDAL and the SICE modules once. Each job
+calls the main function of a script in the same process, with the same
+command line as the script, so the caches of the modules stay warm from one
+job to the next: VOD and gain tables (sice.py), ArcticDEM slope and aspect
+(get_ITOAR.py), region grids (dm_stream.py), zone indices (sice_zonal.py).
+
+The queue is a spool directory:
+    {spool}/queue/{job}.json: jobs waiting, run in the order of submission,
+    {spool}/running/{pid}_{job}.json: jobs claimed by a worker (atomic
+                                      rename, so several workers can serve
+                                      the same spool),
+    {spool}/done/{job}.json, {spool}/failed/{job}.json: jobs with their
+                                                         report,
+    {spool}/logs/{job}.log: output of the job,
+    {spool}/jobs.csv: one line per job (status, wall and CPU seconds).
+Jobs left in running/ by a worker that died are queued again when a worker
+starts.
+
+INPUTS:
+    serve spool: Runs the jobs of the spool. [string]
+        --poll: Seconds between two looks at an empty queue. [float]
+        --once: Exits when the queue is empty. [flag]
+    submit spool script [args ...]: Queues a job, e.g.
+        submit --wait /sice-data/SICE/worker sice.py /path/to/mosaic/2020-07-01
+        --wait: Waits for the job, prints its output and exits with 1 if it
+                failed. [flag]
+
+OUTPUTS:
+    {spool}/done/{job}.json, {spool}/failed/{job}.json: job and report
+        (status, start, seconds, cpu_seconds, error). [.json]
+    {spool}/jobs.csv: job log. [.csv]
+
+"""
+
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import socket
+import time
+import traceback
+import uuid
+
+# scripts run by the worker, each with a main(argv=None) function
+scripts = ['SCDA.py', 'get_ITOAR.py', 'dm_stream.py', 'sice.py',
+           'sice_incremental.py', 'sice_cube.py', 'sice_zonal.py']
+
+folders = ['queue', 'running', 'done', 'failed', 'logs']
+
+poll_interval = 2.
+
+
+def init_spool(spool):
+
+    for folder in folders:
+        os.makedirs(spool + os.sep + folder, exist_ok=True)
+
+
+def write_json(filename, data):
+
+    # written through a temporary file, not to leave a partial job
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp_file, filename)
+
+
+def submit(spool, script, argv, cwd=None):
+    '''
+    Queues a job.
+
+    INPUTS:
+        spool: Path to the spool directory. [string]
+        script: Script to run (see scripts). [string]
+        argv: Command line arguments of the script. [list]
+        cwd: Working directory of the job, the current one if None. [string]
+
+    OUTPUTS:
+        job: Job name. [string]
+    '''
+
+    script = os.path.basename(script)
+    if script not in scripts:
+        raise ValueError('%s is not run by the worker (%s)'
+                         % (script, ', '.join(scripts)))
+
+    init_spool(spool)
+
+    # names sort in the order of submission
+    job = '%d_%s' % (time.time() * 1e6, uuid.uuid4().hex[:8])
+    write_json(spool + os.sep + 'queue' + os.sep + job + '.json',
+               dict(job=job, script=script, argv=list(argv),
+                    cwd=cwd or os.getcwd(), submitted=time.time()))
+
+    return job
+
+
+def wait(spool, job, poll=1.):
+    '''
+    Waits for a job to complete.
+
+    OUTPUTS:
+        report: Job and its report. [dict]
+    '''
+
+    while True:
+        for status in ['done', 'failed']:
+            filename = spool + os.sep + status + os.sep + job + '.json'
+            if os.path.isfile(filename):
+                with open(filename) as f:
+                    return json.load(f)
+        time.sleep(poll)
+
+
+def pid_alive(pid):
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def recover(spool):
+    '''
+    Queues again the jobs claimed by workers of this host that died.
+    '''
+
+    running = spool + os.sep + 'running'
+
+    for name in os.listdir(running):
+        pid, _, job = name.partition('_')
+        if not pid.isdigit() or pid_alive(int(pid)):
+            continue
+        try:
+            os.rename(running + os.sep + name,
+                      spool + os.sep + 'queue' + os.sep + job)
+            print('%s: queued again (worker %s died)' % (job, pid))
+        except FileNotFoundError:
+            # recovered by another worker
+            pass
+
+
+def claim(spool):
+    '''
+    Claims the oldest queued job.
+
+    OUTPUTS:
+        filename: Path to the claimed job in running/, None if the queue is
+                  empty. [string]
+    '''
+
+    queue = spool + os.sep + 'queue'
+
+    for name in sorted(n for n in os.listdir(queue) if n.endswith('.json')):
+        filename = '%s%srunning%s%d_%s' % (spool, os.sep, os.sep, os.getpid(),
+                                           name)
+        try:
+            os.rename(queue + os.sep + name, filename)
+            return filename
+        except FileNotFoundError:
+            # claimed by another worker
+            continue
+
+    return None
+
+
+def run_job(spool, filename):
+    '''
+    Runs a claimed job in the worker process and files its report.
+
+    OUTPUTS:
+        report: Job and its report. [dict]
+    '''
+
+    with open(filename) as f:
+        report = json.load(f)
+
+    job = report['job']
+    report.update(worker='%s:%d' % (socket.gethostname(), os.getpid()),
+                  start=time.time(), error=None)
+    start_time = time.time()
+    start_cpu = time.process_time()
+    cwd = os.getcwd()
+
+    with open(spool + os.sep + 'logs' + os.sep + job + '.log', 'w') as log, \
+            contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            os.chdir(report['cwd'])
+            module = importlib.import_module(report['script'][:-3])
+            module.main(report['argv'])
+            report['status'] = 'done'
+        except SystemExit as e:
+            # argparse errors and sys.exit of the scripts
+            report['status'] = 'done' if not e.code else 'failed'
+            report['error'] = None if not e.code else 'exit %s' % e.code
+        except Exception as e:
+            traceback.print_exc()
+            report['status'] = 'failed'
+            report['error'] = '%s: %s' % (type(e).__name__, e)
+        finally:
+            os.chdir(cwd)
+
+    report['seconds'] = time.time() - start_time
+    report['cpu_seconds'] = time.process_time() - start_cpu
+
+    write_json(spool + os.sep + report['status'] + os.sep + job + '.json',
+               report)
+    os.remove(filename)
+
+    log_file = spool + os.sep + 'jobs.csv'
+    new_log = not os.path.isfile(log_file)
+    with open(log_file, 'a') as f:
+        if new_log:
+            f.write('job,script,folder,status,seconds,cpu_seconds,worker\n')
+        f.write('%s,%s,%s,%s,%.2f,%.2f,%s\n' % (
+            job, report['script'],
+            report['argv'][0] if report['argv'] else '', report['status'],
+            report['seconds'], report['cpu_seconds'], report['worker']))
+
+    print('%s %s %s: %s in %.1f s (%.1f CPU s)%s' % (
+        job, report['script'], ' '.join(report['argv']), report['status'],
+        report['seconds'], report['cpu_seconds'],
+        ', ' + report['error'] if report['error'] else ''), flush=True)
+
+    return report
+
+
+def serve(spool, poll=poll_interval, once=False):
+    '''
+    Runs the queued jobs, one at a time, until interrupted (or until the
+    queue is empty if once).
+
+    OUTPUTS:
+        n_jobs: Number of jobs run. [int]
+    '''
+
+    init_spool(spool)
+    recover(spool)
+    n_jobs = 0
+
+    # loaded once for all the jobs
+    for script in scripts:
+        try:
+            importlib.import_module(script[:-3])
+        except ImportError as e:
+            print('WARNING: %s not available (%s)' % (script, e))
+
+    print('sice_worker %d serving %s' % (os.getpid(), spool), flush=True)
+
+    while True:
+        filename = claim(spool)
+        if filename is None:
+            if once:
+                return n_jobs
+            time.sleep(poll)
+            continue
+        run_job(spool, filename)
+        n_jobs += 1
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='action')
+
+    parser_serve = subparsers.add_parser('serve')
+    parser_serve.add_argument('spool')
+    parser_serve.add_argument('--poll', type=float, default=poll_interval)
+    parser_serve.add_argument('--once', action='store_true',
+                              help='exit when the queue is empty')
+
+    parser_submit = subparsers.add_parser('submit')
+    parser_submit.add_argument('--wait', action='store_true',
+                               help='wait for the job and print its output')
+    parser_submit.add_argument('spool')
+    parser_submit.add_argument('script', choices=scripts)
+    parser_submit.add_argument('argv', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    if args.action == 'serve':
+        start_time = time.time()
+        n_jobs = serve(args.spool, args.poll, args.once)
+        print('End sice_worker.py %s, %d jobs --- %s seconds ---'
+              % (args.spool, n_jobs, time.time() - start_time))
+    elif args.action == 'submit':
+        job = submit(args.spool, args.script, args.argv)
+        if not args.wait:
+            print(job)
+        else:
+            report = wait(args.spool, job)
+            with open(args.spool + os.sep + 'logs' + os.sep + job
+                      + '.log') as f:
+                print(f.read(), end='')
+            print('%s: %s in %.1f s' % (job, report['status'],
+                                        report['seconds']))
+            if report['status'] != 'done':
+                raise SystemExit(1)
+    else:
+        parser.print_help()
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: GEUS (Geological Survey of Denmark and Greenland)
+
+Zonal statistics of the SICE products, computed on the output arrays before
+they are written (S3_pipeline.py, sice.py, sice_incremental.py).
+
+Zones are given by label rasters: the region masks of masks/ (land cover
+classes, e.g. 220 for permanent snow and ice) or any other label raster on
+the same CRS (drainage basins...). Each label raster is resampled once on
+the output grid and turned into a flat index (pixel -> zone number), kept in
+memory. The statistics of a day are then bincount reductions over that
+index:
+    - number of pixels and area of the zone,
+    - number of retrievals, mean and standard deviation of the planar
+      shortwave albedo, the specific surface area and the grain diameter,
+    - bare ice area (albedo below 0.565),
+    - area of the classes of diagnostic_retrieval (isnow),
+for every zone and for the whole label raster (zone "all").
+
+INPUTS:
+    folder: Path to a SICE output folder. [string]
+    zones: Paths to label rasters. [strings]
+
+OUTPUTS:
+    {folder}/zonal_stats.csv: one row per label raster and zone. [.csv]
+
+"""
+
+import argparse
+import os
+import time
+from functools import lru_cache
+
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.crs import CRS
+
+from dm_stream import read_on_grid
+
+variables = ['albedo_bb_planar_sw', 'snow_specific_surface_area',
+             'grain_diameter']
+
+# bare ice: planar shortwave albedo below 0.565
+bare_ice_albedo = 0.565
+
+# classes of diagnostic_retrieval (see sice.py)
+isnow_classes = [0, 1, 6, 7, 100, 102, 104]
+
+stats_file = 'zonal_stats.csv'
+
+
+@lru_cache(maxsize=16)
+def _zone_index(zone_file, crs_wkt, transform, width, height):
+
+    grid = dict(crs=CRS.from_wkt(crs_wkt), transform=Affine(*transform),
+                width=width, height=height)
+    labels = read_on_grid(zone_file, grid).ravel()
+
+    pixels = np.flatnonzero(~np.isnan(labels) & (labels != 0))
+    codes, zones = np.unique(labels[pixels], return_inverse=True)
+
+    return pixels, zones.astype('int32'), codes
+
+
+def zone_index(zone_file, grid):
+    '''
+    Flat index of the zones of a label raster on a grid, computed once per
+    label raster and grid.
+
+    INPUTS:
+        zone_file: Path to the label raster, 0 and nodata outside the zones.
+                   [string]
+        grid: Output grid (see dm_stream.region_grid). [dict]
+
+    OUTPUTS:
+        pixels: Flat indices of the pixels in a zone. [array]
+        zones: Zone number of these pixels. [array]
+        codes: Label of each zone number. [array]
+    '''
+
+    return _zone_index(zone_file, grid['crs'].to_wkt(),
+                       tuple(grid['transform'])[:6], grid['width'],
+                       grid['height'])
+
+
+def reduce_zones(zones, n_zones, values=None):
+    '''
+    Sums (counts without values) per zone, the last element being the
+    total.
+    '''
+
+    sums = np.bincount(zones, values, minlength=n_zones)
+
+    return np.append(sums, sums.sum())
+
+
+def zonal_stats(outputs, grid, zone_files):
+    '''
+    Zonal statistics of the SICE outputs.
+
+    INPUTS:
+        outputs: SICE outputs on the grid. [dict of arrays]
+        grid: Output grid. [dict]
+        zone_files: Paths to the label rasters. [list]
+
+    OUTPUTS:
+        rows: Statistics of each label raster and zone. [list of dicts]
+    '''
+
+    pixel_area = abs(grid['transform'].a * grid['transform'].e) / 1e6
+    rows = []
+
+    for zone_file in zone_files:
+        pixels, zones, codes = zone_index(zone_file, grid)
+        n_zones = len(codes)
+
+        n_pixels = reduce_zones(zones, n_zones)
+        stats = {'zones': [os.path.splitext(os.path.basename(zone_file))[0]]
+                 * (n_zones + 1),
+                 'zone': ['%g' % code for code in codes] + ['all'],
+                 'n_pixels': n_pixels,
+                 'area_km2': n_pixels * pixel_area}
+
+        for name in variables:
+            if name not in outputs:
+                continue
+            values = outputs[name].ravel()[pixels]
+            valid = np.isfinite(values)
+            n = reduce_zones(zones[valid], n_zones)
+            total = reduce_zones(zones[valid], n_zones, values[valid])
+            squares = reduce_zones(zones[valid], n_zones, values[valid] ** 2)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = total / n
+                std = np.sqrt(np.maximum(squares / n - mean ** 2, 0))
+            stats.update({name + '_n': n, name + '_mean': mean,
+                          name + '_std': std})
+
+        if 'albedo_bb_planar_sw' in outputs:
+            albedo = outputs['albedo_bb_planar_sw'].ravel()[pixels]
+            with np.errstate(invalid='ignore'):
+                bare_ice = albedo < bare_ice_albedo
+            stats['bare_ice_area_km2'] = reduce_zones(
+                zones[bare_ice], n_zones) * pixel_area
+
+        if 'diagnostic_retrieval' in outputs:
+            isnow = outputs['diagnostic_retrieval'].ravel()[pixels]
+            for isnow_class in isnow_classes:
+                stats['isnow_%d_area_km2' % isnow_class] = reduce_zones(
+                    zones[isnow == isnow_class], n_zones) * pixel_area
+
+        rows += [{key: values[k] for key, values in stats.items()}
+                 for k in range(n_zones + 1)]
+
+    return rows
+
+
+def write_stats(rows, filename, date=''):
+    '''
+    Writes the zonal statistics of a day in a CSV file.
+    '''
+
+    if not rows:
+        return
+
+    columns = list(rows[0])
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write('date,' + ','.join(columns) + '\n')
+        for row in rows:
+            f.write(date + ',' + ','.join(
+                '%.6g' % row[c] if isinstance(row[c], (float, np.floating))
+                else str(row[c])
+                for c in columns) + '\n')
+    os.replace(tmp_file, filename)
+
+
+def folder_stats(outputs, grid, zone_files, folder):
+    '''
+    Computes and writes the zonal statistics of an output folder.
+    '''
+
+    if not zone_files:
+        return
+
+    date = os.path.basename(os.path.normpath(folder))
+    write_stats(zonal_stats(outputs, grid, zone_files),
+                folder + os.sep + stats_file, date)
+
+
+def read_outputs(folder):
+    '''
+    SICE outputs used by the statistics and their grid, from the files of
+    an output folder.
+    '''
+
+    outputs = {}
+    grid = None
+
+    for name in variables + ['diagnostic_retrieval']:
+        path = folder + os.sep + name + '.tif'
+        if not os.path.isfile(path):
+            continue
+        with rasterio.open(path) as src:
+            outputs[name] = src.read(1).astype('float32')
+            grid = dict(crs=src.crs, transform=src.transform,
+                        width=src.width, height=src.height)
+
+    return outputs, grid
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('folder')
+    parser.add_argument('zones', nargs='+')
+    args = parser.parse_args(argv)
+
+    start_time = time.time()
+
+    outputs, grid = read_outputs(args.folder)
+    if grid is None:
+        print('ERROR: no SICE output in %s' % args.folder)
+    else:
+        folder_stats(outputs, grid, args.zones, args.folder)
+
+    print('End sice_zonal.py %s --- %s seconds ---'
+          % (args.folder, time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()